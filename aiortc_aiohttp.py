@@ -1,63 +1,123 @@
-import asyncio
 import logging
-from aiortc_connection import AiortcConnection
+import os
+import tracing
 from aiohttp import web
 from constants import IP_ADDRESS
+from metrics import CONTENT_TYPE, StatsSampler, instrument_codecs, registry
+from session_manager import SessionManager, SessionExistsError, SessionLimitError, SessionNotFoundError
+from warm_pool import WarmPool
 
 logging.basicConfig(level=logging.INFO)
 
 HOST = IP_ADDRESS["localhost"]
-# connection = AiortcConnection(HOST)
-connection = AiortcConnection()
-is_calling = False
+ROOT = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_PEER_ID = "1"
+MAX_SESSIONS = 32
+WARM_POOL_SIZE = 2
+
+SESSIONS = web.AppKey("sessions")
+POOL = web.AppKey("pool")
+STATS_SAMPLER = web.AppKey("stats_sampler")
+
+
+async def get_peer_id(request):
+    # the bundled web page posts without a body, so fall back to the default peer
+    data = await request.json() if request.can_read_body else {}
+    return str(data.get("peer_id", DEFAULT_PEER_ID)), data
 
 
 async def index(request):
-    return web.FileResponse("./static/index.html")
+    return web.FileResponse(os.path.join(ROOT, "static", "index.html"))
 
 
 async def call(request):
-    global connection, is_calling
-    if is_calling:
-        logging.info("Already calling")
+    peer_id, _ = await get_peer_id(request)
+    try:
+        await request.app[SESSIONS].call(peer_id)
+    except SessionExistsError:
+        logging.info(f"Peer {peer_id} already calling")
         return web.Response(text="Already calling")
-    await connection.connect_to_websocket()
-    connection.start_signaling()
-    connection.create_peer_connection()
-    connection.create_data_channel()
-    connection.get_media()
-    await connection.send_offer()
-    is_calling = True
+    except SessionLimitError as e:
+        logging.info(e)
+        return web.Response(status=503, text="Too many sessions")
     return web.Response(text="ok")
 
 
 async def hangup(request):
-    global connection, is_calling
-    connection.stop_signaling()
-    await connection.disconnect_from_websocket()
-    await connection.clear()
-    is_calling = False
+    peer_id, _ = await get_peer_id(request)
+    try:
+        await request.app[SESSIONS].hangup(peer_id)
+    except SessionNotFoundError as e:
+        logging.info(e)
     return web.Response(text="ok")
 
 
 async def send_message(request):
-    global connection
-    data = await request.json()
+    peer_id, data = await get_peer_id(request)
     try:
-        connection.send_message(data["message"])
+        request.app[SESSIONS].send_message(peer_id, data["message"])
     except Exception as e:
         logging.error(f"Send message via data channel error: {e}")
     return web.Response(text="ok")
 
 
+async def metrics(request):
+    # aiohttp rejects a charset inside content_type, so the header is set as is
+    return web.Response(body=registry.render().encode("utf-8"), headers={"Content-Type": CONTENT_TYPE})
+
+
+async def trace(request):
+    if not tracing.enabled:
+        return web.Response(status=404, text="Tracing is off, set TRACE_FRAMES to turn it on")
+    return web.json_response(tracing.chrome_trace())
+
+
+async def on_startup(app):
+    # before the pool creates any encoder
+    instrument_codecs()
+    if os.getenv("TRACE_FRAMES"):
+        tracing.enable()
+    app[STATS_SAMPLER].start()
+    if app[POOL] is not None:
+        # prepared in the background so the server starts listening straight away
+        app[POOL].refill()
+
+
+async def on_shutdown(app):
+    app[STATS_SAMPLER].stop()
+    if app[POOL] is not None:
+        await app[POOL].close()
+    await app[SESSIONS].close_all()
+
+
+def create_app(sessions=None, pool=None):
+    """
+    The control API. Every session lives on the loop running the app, so
+    calls, signaling and media of all peers proceed concurrently.
+
+    sessions: SessionManager to serve, by default one using pool
+    pool: WarmPool used by sessions, refilled and closed with the app. A
+        default one is made if neither sessions nor pool is given
+    """
+    if sessions is None:
+        if pool is None:
+            pool = WarmPool(size=WARM_POOL_SIZE)
+        sessions = SessionManager(max_sessions=MAX_SESSIONS, pool=pool)
+    app = web.Application()
+    app[SESSIONS] = sessions
+    app[POOL] = pool
+    app[STATS_SAMPLER] = StatsSampler(sessions)
+    app.on_startup.append(on_startup)
+    app.on_shutdown.append(on_shutdown)
+    app.router.add_static("/static", os.path.join(ROOT, "static"))
+    app.router.add_get("/", index)
+    app.router.add_post("/send_message", send_message)
+    app.router.add_post("/call", call)
+    app.router.add_post("/hangup", hangup)
+    app.router.add_get("/metrics", metrics)
+    app.router.add_get("/trace", trace)
+    return app
+
+
 if __name__ == "__main__":
-    try:
-        app = web.Application()
-        app.router.add_static("/static", "./static")
-        app.router.add_get("/", index)
-        app.router.add_post("/send_message", send_message)
-        app.router.add_post("/call", call)
-        app.router.add_post("/hangup", hangup)
-        web.run_app(app, host=HOST, port=5000)
-    except KeyboardInterrupt:
-        asyncio.run(connection.clear())
+    web.run_app(create_app(), host=HOST, port=5000)
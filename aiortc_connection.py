@@ -1,55 +1,156 @@
 import asyncio
+import functools
 import logging
 import os
 import platform
-import re
-import subprocess
+import tracing
 import websockets
-from aiortc import RTCPeerConnection, RTCConfiguration, RTCIceServer, RTCSessionDescription, RTCIceCandidate
-from aiortc.contrib.media import MediaPlayer, MediaRelay
+from aiortc import RTCPeerConnection, RTCConfiguration, RTCIceServer, RTCSessionDescription, sdp
+from aiortc.contrib.media import MediaPlayer
 from aiortc.rtcrtpsender import RTCRtpSender
+from bitrate_controller import AdaptiveVideoTrack, BitrateController
+from broadcast import DEFAULT_CODEC as DEFAULT_BROADCAST_CODEC, EncodedTrack, hub as broadcast_hub, route_keyframe_requests
+from capture_hub import hub as capture_hub
+from capture_sources import registry as capture_sources
 from constants import IP_ADDRESS
+from datachannel_messaging import MessageChannel
 from dotenv import load_dotenv
+from low_latency import MAX_DELAY as LOW_LATENCY_MAX_DELAY, LowLatencyTrack, Pacer
+from media_index import IndexedPacketTrack, open_source_async
+from metrics import SIGNALING_MESSAGES
+from packet_cache import cache_sent_packets
+from signaling_codec import Candidate, decode_message, encode_candidates, encode_description
+from simulcast import SimulcastTrack, hub as simulcast_hub, policy as simulcast_policy
 
 load_dotenv()
 
+# max signaling messages waiting to be handled before the websocket stops being read
+SIGNALING_QUEUE_SIZE = 64
+# telemetry is dropped rather than queued beyond this many bytes
+TELEMETRY_MAX_PENDING = 64 * 1024
+
+
 class AiortcConnection:
-    def __init__(self, ip=""):
+    def __init__(self, ip="", uid="1", websocket_uri=None, trickle=False):
+        # uid can be changed until the websocket is connected, e.g. for pooled connections
+        self.uid = uid
+        # send the offer before ICE gathering is done and the candidates after it
+        self.trickle = trickle
+        self._ip = ip
         self._pc = None
         self._dc = None
-        self._relay = None
-        self._media_player = None
+        self._messages = None
+        self._telemetry = None
+        # called with each message received on the data channel
+        self.message_handler = None
+        self._media_tracks = []
+        self._bitrate_controller = None
         self._signaling = None
+        self._signaling_queue = None
+        self._trickle_task = None
+        self._gathering = None
         self._websocket = None
-        # self._websocket_uri = f"ws://{ip}:5011/ws?type=w&uid=1&token=1234567890"
-        self._websocket_uri = "wss://tom-bridge.nusssi.com/wsbridge/?type=w&uid=1&token=1234567890"
+        self._custom_websocket_uri = websocket_uri
+
+    @property
+    def _websocket_uri(self):
+        if self._custom_websocket_uri:
+            return self._custom_websocket_uri.format(uid=self.uid)
+        # return f"ws://{self._ip}:5011/ws?type=w&uid={self.uid}&token=1234567890"
+        return f"wss://tom-bridge.nusssi.com/wsbridge/?type=w&uid={self.uid}&token=1234567890"
+
+    @property
+    def is_active(self):
+        return self._pc is not None
+
+    @property
+    def has_prepared_offer(self):
+        return self._pc is not None and self._pc.signalingState == "have-local-offer"
+
+    @property
+    def signaling_queue_depth(self):
+        return self._signaling_queue.qsize() if self._signaling_queue else 0
+
+    async def get_stats(self):
+        """
+        The peer connection's RTCStatsReport, or None without one.
+        """
+        return await self._pc.getStats() if self._pc else None
 
     async def _consume_signaling(self):
-        message = await self._websocket.recv()
-        logging.info("Received:", message)
-        sdp_type, sdp = message.split("~")[:2]
+        """
+        Read signaling messages for as long as the websocket is open and hand
+        them to the dispatcher through a bounded queue.
+        """
+        queue = self._signaling_queue = asyncio.Queue(maxsize=SIGNALING_QUEUE_SIZE)
+        dispatcher = asyncio.create_task(self._dispatch_signaling(queue))
+        try:
+            async for message in self._websocket:
+                # waits while the dispatcher is behind, so the websocket stops
+                # being read and the sender is throttled instead of the loop
+                await queue.put(message)
+        except websockets.ConnectionClosed:
+            logging.info("Signaling websocket closed")
+        finally:
+            dispatcher.cancel()
+
+    async def _dispatch_signaling(self, queue):
+        handlers = {
+            "offer": self._handle_offer,
+            "answer": self._handle_answer,
+            "candidate": self._handle_candidate,
+            "pcnull": self._handle_pcnull,
+        }
+        while True:
+            message = await queue.get()
+            # not formatted unless info logging is on
+            logging.info("Received: %s", message)
+            try:
+                message = decode_message(message)
+            except ValueError as e:
+                SIGNALING_MESSAGES.inc(("received", "malformed"))
+                logging.error(f"Malformed signaling message: {e}")
+                continue
+            handler = handlers.get(message.type)
+            # unknown types share one label so peers cannot grow the metrics
+            SIGNALING_MESSAGES.inc(("received", message.type if handler else "unknown"))
+            if handler is None:
+                logging.warning(f"Unknown signaling message type: {message.type}")
+                continue
+            if not self._pc:
+                logging.info(f"No peer connection. Dropping {message.type} message")
+                continue
+            try:
+                await handler(message)
+            except Exception as e:
+                logging.error(f"Handling {message.type} message failed: {e}")
+
+    async def _handle_offer(self, message):
+        offer = RTCSessionDescription(sdp=message.sdp, type=message.type)
+        await self._pc.setRemoteDescription(offer)
+        answer = await self._pc.createAnswer()
+        await self._pc.setLocalDescription(answer)
+        answer = encode_description(
+            self._pc.localDescription.type, self._pc.localDescription.sdp, version=message.version)
+        await self._websocket.send(answer)
+        SIGNALING_MESSAGES.inc(("sent", "answer"))
+
+    async def _handle_answer(self, message):
+        answer = RTCSessionDescription(sdp=message.sdp, type=message.type)
+        # aiortc only sets the local description once gathering is done, and
+        # a trickled offer can be answered before that
+        if self._gathering:
+            await self._gathering
+        await self._pc.setRemoteDescription(answer)
+
+    async def _handle_candidate(self, message):
+        for candidate in message.candidates:
+            await self._pc.addIceCandidate(candidate.to_rtc())
+
+    async def _handle_pcnull(self, message):
         # TODO: Not needed after fixing Unity client
-        if sdp_type == "pcnull":
-            await self.clear()
-            logging.info("Remote PC is null. Hanging up...")
-            return
-        if sdp_type == "offer":
-            offer = RTCSessionDescription(sdp=sdp, type=sdp_type)
-            await self._pc.setRemoteDescription(offer)
-            answer = await self._pc.createAnswer()
-            await self._pc.setLocalDescription(answer)
-            answer = self._pc.localDescription.type + "~" + self._pc.localDescription.sdp
-            await self._websocket.send(answer)
-        elif sdp_type == "answer":
-            sdp = RTCSessionDescription(sdp=sdp, type=sdp_type)
-            await self._pc.setRemoteDescription(sdp)
-        elif sdp_type == "candidate":
-            sdp_type, candidate, sdp_mid, sdp_mline_index = message.split("~")
-            foundation, component, protocol, priority, ip, port, _, _type = candidate.split()[
-                :8]
-            candidate = RTCIceCandidate(foundation=foundation, component=component, protocol=protocol,
-                                        priority=priority, ip=ip, port=port, type=_type, sdpMid=sdp_mid, sdpMLineIndex=sdp_mline_index)
-            await self._pc.addIceCandidate(candidate)
+        await self.clear()
+        logging.info("Remote PC is null. Hanging up...")
 
     async def connect_to_websocket(self):
         # if websocket is already connected, restart it
@@ -81,131 +182,154 @@ class AiortcConnection:
         if self._pc:
             raise Exception(
                 "Peer connection already created. Clear it before creating a new one")
-        self._pc = RTCPeerConnection(
-            configuration=RTCConfiguration(
-                iceServers=[
-                    RTCIceServer(
-                        # TODO: set as env variable
-                        # urls=["stun:stun.l.google.com:19302"],
-                        urls=[os.getenv("TURN_SERVER")],
-                        username=os.getenv("TURN_SERVER_USERNAME"),
-                        credential=os.getenv("TURN_SERVER_CREDENTIAL")
-                    )
-                ]
+        ice_servers = []
+        # host candidates only when no TURN server is configured, e.g. on localhost
+        if os.getenv("TURN_SERVER"):
+            ice_servers.append(
+                RTCIceServer(
+                    # TODO: set as env variable
+                    # urls=["stun:stun.l.google.com:19302"],
+                    urls=[os.getenv("TURN_SERVER")],
+                    username=os.getenv("TURN_SERVER_USERNAME"),
+                    credential=os.getenv("TURN_SERVER_CREDENTIAL")
+                )
             )
+        self._pc = RTCPeerConnection(
+            configuration=RTCConfiguration(iceServers=ice_servers)
         )
         logging.info("Peer connection created")
 
-    def create_data_channel(self):
+    def create_data_channel(self, framed=False, telemetry=False):
+        """
+        Create the "chat" data channel.
+
+        framed: coalesce messages into binary frames, only for peers that
+            read them with datachannel_messaging as well
+        telemetry: also create an unordered, unreliable "telemetry" channel
+            for send_telemetry
+        """
         if not self._pc:
             raise Exception(
                 "Peer connection not created. Cannot create data channel")
         self._dc = self._pc.createDataChannel("chat")
+        self._messages = MessageChannel(self._dc, framed=framed, on_message=self._on_message)
+        if telemetry:
+            channel = self._pc.createDataChannel("telemetry", ordered=False, maxRetransmits=0)
+            self._telemetry = MessageChannel(
+                channel, framed=True, drop_when_full=True, max_pending=TELEMETRY_MAX_PENDING)
+        logging.info("Data channel created")
 
-        @self._dc.on("message")
-        def on_message(message):
-            # convert bytes to string
+    def _on_message(self, message):
+        if isinstance(message, bytes) and not self._messages.framed:
+            # the Unity client sends its text as bytes
             message = message.decode("utf-8")
-            logging.info("<<< " + message)
-        logging.info("Data channel created")
+        if self.message_handler:
+            self.message_handler(message)
 
     def clear_media(self):
-        if self._media_player:
-            if self._media_player.video:
-                self._media_player.video.stop()
-            if self._media_player.audio:
-                self._media_player.audio.stop()
-            self._media_player = None
-        if self._relay:
-            # NOTE: Dereferencing relay does not stop the relay from running
-            #      Unable to find a way to clear tracks in the relay
-            self._relay = None
+        if self._bitrate_controller:
+            self._bitrate_controller.stop()
+            self._bitrate_controller = None
+        # stopping a shared track releases it from its capture or broadcast
+        for track in self._media_tracks:
+            track.stop()
+        self._media_tracks = []
         logging.info("Media cleared")
 
-    def get_media(self, audio_src=None, video_src=None, audio_codec=None, video_codec=None, play_without_decoding=False, play_from=None):
+    async def get_media(self, audio_src=None, video_src=None, audio_codec=None, video_codec=None, play_without_decoding=False, play_from=None, broadcast=False, adaptive=False, simulcast=False, low_latency=False, max_delay=LOW_LATENCY_MAX_DELAY):
         """
         Get media from the specified sources.
 
-        audio_src: name of the audio device on the system
-        video_src: name of the video device on the system
+        audio_src: name or file of the audio source in capture_sources,
+            e.g. a device name, "hw:0" or "sine"
+        video_src: name or file of the video source in capture_sources,
+            e.g. a device name, "/dev/video2" or "testsrc"
         audio_codec: audio codec to use
         video_codec: video codec to use
-        play_without_decoding: play media without decoding
+        play_without_decoding: play media without decoding, video only,
+            from a sidecar index built on first use
         play_from: path to the media file to play
+        broadcast: share one encoder for the video across all connections
+            using the same device and codec
+        adaptive: adapt the video bitrate, frame rate and resolution to the
+            link, for video encoded by this connection only
+        simulcast: encode the video once per layer of resolution across all
+            connections using the same device and codec, and send each
+            connection the layer its link can carry
+        low_latency: send the latest video frame, timestamped at capture,
+            pace its packets and skip frames that would be sent later than
+            max_delay, for video encoded by this connection only
+        max_delay: seconds from capture until a frame reaches the receiver
+            in low_latency mode
         """
-        def get_devices():
-            """
-            Get the list of audio and video devices available on the system.
-            """
-            def list_video_devices():
-                result = subprocess.run(
-                    "ffmpeg -list_devices true -f dshow -i dummy".split(),
-                    capture_output=True,
-                    text=True)
-                output = result.stderr
-                return output
-
-            def extract_device_names(output):
-                pattern = r'"([^"]+)"\s+\((video|audio)\)'
-                matches = re.findall(pattern, output)
-                return matches
-
-            devices = {"video": [], "audio": []}
-            try:
-                names = extract_device_names(list_video_devices())
-            except FileNotFoundError:
-                logging.info("ffmpeg not found. Please install ffmpeg.")
-                return devices
-            for name, media in names:
-                devices[media].append(name)
-            return devices
-
-        def create_local_tracks(play_from, decode, audio_src, video_src):
-            if play_from:
-                player = MediaPlayer(play_from, decode=decode, loop=True)
+        async def find_source(kind, name):
+            source = await capture_sources.find(kind, name)
+            if source is None:
+                # any name used to open the first camera outside Windows
+                source = await capture_sources.find(kind)
+                logging.warning(f"No {kind} source named {name}, using {source.name if source else None}")
+            return source
+
+        async def create_local_tracks(play_from, decode, audio_src, video_src, broadcast, simulcast):
+            loop = asyncio.get_running_loop()
+            if play_from and not decode:
+                # packets come straight from the sidecar index, no demuxer per call
+                video = IndexedPacketTrack(await open_source_async(play_from))
+                self._media_tracks = [video]
+                return None, video
+            elif play_from:
+                player = await loop.run_in_executor(
+                    None, functools.partial(MediaPlayer, play_from, decode=decode, loop=True))
+                # stopping both tracks stops the player's thread
+                self._media_tracks = [track for track in (player.audio, player.video) if track]
+                if player.video and tracing.enabled:
+                    return player.audio, tracing.TracedTrack(player.video, "capture", self.uid)
                 return player.audio, player.video
             else:
-                options = {"framerate": "30",
-                           "video_size": "640x480"}
-                if self._relay is None:
-                    if platform.system() == "Darwin":
-                        self._media_player = MediaPlayer(
-                            "default:none", format="avfoundation", options=options
-                        )
-                    elif platform.system() == "Windows":
-                        # get first audio and video devices if not specified
-                        if not audio_src and not video_src:
-                            devices = get_devices()
-                            if devices["audio"]:
-                                audio_src = devices["audio"][0]
-                            if devices["video"]:
-                                video_src = devices["video"][0]
-                            logging.info(
-                                "No audio or video device specified using the first available devices")
-                            logging.info(
-                                f"Audio device: {audio_src}, Video device: {video_src}")
-                        file = ""
-                        if audio_src:
-                            file += f"audio={audio_src}:"
-                        if video_src:
-                            file += f"video={video_src}:"
-                        options["pixel_format"] = "yuyv422"
-                        self._media_player = MediaPlayer(
-                            file=file[:-1], format="dshow", options=options
-                        )
-                    else:
-                        self._media_player = MediaPlayer(
-                            "/dev/video0", format="v4l2", options=options)
-                    self._relay = MediaRelay()
+                if platform.system() == "Windows" and not audio_src and not video_src:
+                    # get first audio and video devices if not specified
+                    audio_source = await capture_sources.find("audio")
+                    video_source = await capture_sources.find("video")
+                    logging.info(
+                        "No audio or video device specified using the first available devices")
+                else:
+                    audio_source = await find_source("audio", audio_src) if audio_src else None
+                    video_source = await find_source("video", video_src) if video_src else None
+                logging.info(
+                    f"Audio source: {audio_source}, Video source: {video_source}")
+                # the device is opened once per process, off the event loop, and shared by all connections
                 media = [None, None]
-                if audio_src:
-                    media[0] = self._relay.subscribe(
-                        self._media_player.audio)
-                if video_src:
-                    media[1] = self._relay.subscribe(
-                        self._media_player.video)
+                try:
+                    await subscribe_sources(media, audio_source, video_source, broadcast, simulcast)
+                except Exception:
+                    # stopping a track releases its capture
+                    for track in media:
+                        if track:
+                            track.stop()
+                    raise
+                self._media_tracks = [track for track in media if track]
+                if media[1] and not broadcast and not simulcast and tracing.enabled:
+                    media[1] = tracing.TracedTrack(media[1], "relay", self.uid)
                 return media
 
+        async def subscribe_sources(media, audio_source, video_source, broadcast, simulcast):
+            if audio_source:
+                await capture_sources.open(audio_source)
+                media[0] = await capture_hub.subscribe(
+                    audio_source.file, "audio", format=audio_source.format, options=audio_source.options)
+            if video_source:
+                file, format, options = video_source.file, video_source.format, video_source.options
+                await capture_sources.open(video_source)
+                if simulcast:
+                    media[1] = await simulcast_hub.subscribe(
+                        file, format=format, options=options, codec=video_codec)
+                elif broadcast:
+                    media[1] = await broadcast_hub.subscribe(
+                        file, format=format, options=options, codec=video_codec)
+                else:
+                    media[1] = await capture_hub.subscribe(
+                        file, "video", format=format, options=options)
+
         def force_codec(pc, sender, forced_codec):
             kind = forced_codec.split("/")[0]
             codecs = RTCRtpSender.getCapabilities(kind).codecs
@@ -225,9 +349,13 @@ class AiortcConnection:
         # clear media if already present
         self.clear_media()
 
+        # the shared encoder produces packets, so the codec has to be fixed
+        if (broadcast or simulcast) and not play_from:
+            video_codec = video_codec or DEFAULT_BROADCAST_CODEC
+
         # open media source
-        audio, video = create_local_tracks(
-            play_from, decode=not play_without_decoding, audio_src=audio_src, video_src=video_src
+        audio, video = await create_local_tracks(
+            play_from, decode=not play_without_decoding, audio_src=audio_src, video_src=video_src, broadcast=broadcast, simulcast=simulcast
         )
 
         if audio:
@@ -238,15 +366,55 @@ class AiortcConnection:
                 raise Exception(
                     "You must specify the audio codec using audio_codec")
 
+        # pre-encoded video is sent as it is, so there is nothing to adapt
+        encoded = isinstance(video, (EncodedTrack, SimulcastTrack))
+        low_latency = low_latency and video is not None and not play_without_decoding and not encoded
+        if low_latency:
+            video = latency_track = LowLatencyTrack(video, max_delay)
+
+        adaptive = adaptive and video is not None and not play_without_decoding and not encoded
+        if adaptive:
+            video = AdaptiveVideoTrack(video)
+
+        traced = tracing.enabled and video is not None and not play_without_decoding and not encoded
+        if traced:
+            video = tracing.TracedTrack(video, "encode", self.uid)
+
         if video:
             video_sender = self._pc.addTrack(video)
+            # NACKs are answered from the shared cache, seconds deep
+            cache_sent_packets(video_sender)
+            if low_latency:
+                Pacer(video_sender, latency_track)
+            if traced:
+                tracing.trace_sender(video_sender, video, self.uid)
+            if adaptive:
+                self._bitrate_controller = BitrateController(video_sender, video)
+                self._bitrate_controller.start()
+            elif isinstance(video, SimulcastTrack):
+                # the layer follows the link instead of the encoder
+                self._bitrate_controller = BitrateController(video_sender, video, policy=simulcast_policy())
+                self._bitrate_controller.start()
             if video_codec:
                 force_codec(self._pc, video_sender, video_codec)
+                if encoded:
+                    route_keyframe_requests(video_sender, video)
             elif play_without_decoding:
                 raise Exception(
                     "You must specify the video codec using video_codec")
         logging.info("Media added")
 
+    async def prepare_offer(self):
+        """
+        Create the offer and gather ICE candidates ahead of time so that
+        send_offer can send it straight away.
+        """
+        if not self._pc:
+            raise Exception("Peer connection not created. Cannot prepare offer")
+        offer = await self._pc.createOffer()
+        await self._pc.setLocalDescription(offer)
+        logging.info("Offer prepared")
+
     async def send_offer(self):
         # NOTE: Call this after creating pc, dc and adding media
         if not self._pc:
@@ -254,27 +422,102 @@ class AiortcConnection:
         if not self._websocket:
             raise Exception(
                 "Websocket connection not created. Cannot send offer")
-        offer = await self._pc.createOffer()
-        await self._pc.setLocalDescription(offer)
-        offer_message = self._pc.localDescription.type + \
-            "~" + self._pc.localDescription.sdp
+        if self.trickle and not self.has_prepared_offer:
+            await self._send_trickle_offer()
+            return
+        if not self.has_prepared_offer:
+            await self.prepare_offer()
+        offer_message = encode_description(
+            self._pc.localDescription.type, self._pc.localDescription.sdp)
         await self._websocket.send(offer_message)
+        SIGNALING_MESSAGES.inc(("sent", "offer"))
         logging.info("Offer sent")
 
+    async def _send_trickle_offer(self):
+        # the offer carries the ICE credentials but no candidates yet
+        offer = await self._pc.createOffer()
+        # gathers candidates, which can take seconds with an unreachable TURN server
+        self._gathering = asyncio.ensure_future(self._pc.setLocalDescription(offer))
+        await self._websocket.send(encode_description(offer.type, offer.sdp))
+        SIGNALING_MESSAGES.inc(("sent", "offer"))
+        logging.info("Offer sent, candidates follow")
+        self._trickle_task = asyncio.create_task(self._send_candidates(self._gathering))
+
+    async def _send_candidates(self, gathering):
+        """
+        Send the local candidates as candidate messages once gathering is
+        done. aioice reports all candidates of a transport at once, so they
+        are sent together.
+        """
+        try:
+            await gathering
+            description = sdp.SessionDescription.parse(self._pc.localDescription.sdp)
+        except Exception as e:
+            logging.error(f"Gathering candidates failed: {e}")
+            return
+        candidates = []
+        seen = set()
+        for index, media in enumerate(description.media):
+            for candidate in media.ice_candidates:
+                candidate.sdpMid = media.rtp.muxId
+                candidate.sdpMLineIndex = index
+                candidate = Candidate.from_rtc(candidate)
+                # bundled media sections list the same candidates again
+                key = (candidate.ip, candidate.port, candidate.protocol)
+                if key not in seen:
+                    seen.add(key)
+                    candidates.append(candidate)
+        try:
+            for message in encode_candidates(candidates):
+                await self._websocket.send(message)
+                SIGNALING_MESSAGES.inc(("sent", "candidate"))
+        except websockets.ConnectionClosed:
+            logging.info("Signaling websocket closed before the candidates were sent")
+            return
+        logging.info(f"{len(candidates)} candidates sent")
+
     def send_message(self, message):
-        if not self._dc:
+        """
+        Queue a message on the data channel. Raises MessageChannelFull if
+        the peer is not keeping up, see drain.
+        """
+        if not self._messages:
             raise Exception("Data channel not created. Cannot send message")
-        self._dc.send(message)
-        logging.info(">>> " + message)
+        self._messages.send(message)
+        logging.debug(">>> %s", message)
+
+    async def drain(self):
+        """
+        Wait until the data channel has room for more messages.
+        """
+        if self._messages:
+            await self._messages.drain()
+
+    def send_telemetry(self, message):
+        """
+        Send a message that may be dropped or reordered, e.g. a pose update
+        superseded by the next one.
+        """
+        if not self._telemetry:
+            raise Exception("Telemetry channel not created. Cannot send telemetry")
+        self._telemetry.send(message)
 
     async def clear(self):
         self.clear_media()
+        if self._trickle_task:
+            self._trickle_task.cancel()
+            self._trickle_task = None
+        self._gathering = None
         if self._pc:
             await self._pc.close()
         if self._dc:
             self._dc.close()
+        if self._telemetry:
+            self._telemetry.channel.close()
         self._pc = None
         self._dc = None
+        self._messages = None
+        self._telemetry = None
         logging.info("Resources cleaned up")
 
 
@@ -289,8 +532,8 @@ async def main():
     connection.start_signaling()
     connection.create_peer_connection()
     connection.create_data_channel()
-    connection.get_media()
-    # connection.get_media(play_from="./big_buck_bunny_720p_1mb.mp4")
+    await connection.get_media()
+    # await connection.get_media(play_from="./big_buck_bunny_720p_1mb.mp4")
     await connection.send_offer()
     logging.basicConfig(level=logging.info)
 
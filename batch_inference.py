@@ -0,0 +1,196 @@
+"""
+A pipeline stage that runs a model over frames from many received video
+tracks at once.
+
+Each BatchedTrack hands its frames to a shared BatchStage, which gathers
+them into one NumPy batch until the batch is full or the oldest frame has
+waited max_delay seconds, runs the model over the whole batch off the event
+loop and returns each result to the track it came from. A track asks for
+its next frame only after getting the previous one back, so results reach
+each track in order.
+"""
+import asyncio
+import concurrent.futures
+import time
+import numpy as np
+from aiortc import MediaStreamTrack
+from av import VideoFrame
+
+DEFAULT_BATCH_SIZE = 8
+# longest a frame waits for others to join its batch, in seconds
+DEFAULT_MAX_DELAY = 0.02
+
+
+class BatchModel:
+    """
+    A model run over batches of frames. Frames are scaled to size and
+    converted to format before being stacked, and infer returns a batch of
+    images of the same shape and format.
+
+    size: (width, height) of the model input
+    format: pixel format of the input and output images, e.g. "gray" or "rgb24"
+    """
+
+    size = (320, 240)
+    format = "gray"
+
+    def infer(self, batch):
+        raise NotImplementedError
+
+
+class SobelEdgesModel(BatchModel):
+    """
+    Gradient magnitude of the luma, computed with NumPy over the whole batch.
+    """
+
+    def infer(self, batch):
+        images = batch.astype(np.int16)
+        edges = np.zeros_like(images)
+        edges[:, 1:-1, 1:-1] = (
+            np.abs(images[:, 1:-1, 2:] - images[:, 1:-1, :-2])
+            + np.abs(images[:, 2:, 1:-1] - images[:, :-2, 1:-1]))
+        return np.clip(edges * 2, 0, 255).astype(np.uint8)
+
+
+class BatchMetrics:
+    """
+    batches: batches run
+    frames: frames run
+    wait_ms: average time frames waited for their batch to start
+    infer_ms: average time the model took per batch
+    """
+
+    def __init__(self):
+        self.batches = 0
+        self.frames = 0
+        self.wait_ms = 0.0
+        self.infer_ms = 0.0
+
+    def add(self, size, wait_ms, infer_ms):
+        self.batches += 1
+        self.frames += size
+        # running means over every batch so far
+        self.wait_ms += (wait_ms - self.wait_ms) * size / self.frames
+        self.infer_ms += (infer_ms - self.infer_ms) / self.batches
+
+    def as_dict(self):
+        return {
+            "batches": self.batches,
+            "frames": self.frames,
+            "mean_batch_size": round(self.frames / self.batches, 2) if self.batches else 0,
+            "wait_ms": round(self.wait_ms, 2),
+            "infer_ms": round(self.infer_ms, 2),
+        }
+
+
+class BatchStage:
+    """
+    Gathers frames from any number of tracks into batches for a BatchModel.
+
+    model: BatchModel to run
+    batch_size: most frames in one batch
+    max_delay: longest the first frame of a batch waits for more, in seconds
+    """
+
+    def __init__(self, model, batch_size=DEFAULT_BATCH_SIZE, max_delay=DEFAULT_MAX_DELAY):
+        self._model = model
+        self._batch_size = batch_size
+        self._max_delay = max_delay
+        self.metrics = BatchMetrics()
+        width, height = model.size
+        channels = () if model.format == "gray" else (3,)
+        # filled in place for every batch
+        self._batch = np.empty((batch_size, height, width) + channels, np.uint8)
+        self._pending = []
+        self._arrived = asyncio.Event()
+        self._task = None
+        # one batch at a time, the model need not be thread safe
+        self._executor = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix="batch")
+
+    def submit(self, frame):
+        """
+        Queue a frame and return a future for the model's result as a frame
+        of the same size and timing.
+        """
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((time.perf_counter(), frame, future))
+        self._arrived.set()
+        return future
+
+    async def _next_batch(self):
+        while not self._pending:
+            self._arrived.clear()
+            await self._arrived.wait()
+        deadline = self._pending[0][0] + self._max_delay
+        while len(self._pending) < self._batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            self._arrived.clear()
+            try:
+                await asyncio.wait_for(self._arrived.wait(), remaining)
+            except asyncio.TimeoutError:
+                break
+        batch, self._pending = self._pending[:self._batch_size], self._pending[self._batch_size:]
+        return batch
+
+    def _infer(self, frames):
+        # conversions run here too, off the event loop
+        width, height = self._model.size
+        for i, frame in enumerate(frames):
+            self._batch[i] = frame.reformat(width=width, height=height, format=self._model.format).to_ndarray()
+        results = []
+        for frame, result in zip(frames, self._model.infer(self._batch[:len(frames)])):
+            new_frame = VideoFrame.from_ndarray(result, format=self._model.format).reformat(
+                width=frame.width, height=frame.height, format="yuv420p")
+            new_frame.pts = frame.pts
+            new_frame.time_base = frame.time_base
+            results.append(new_frame)
+        return results
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._next_batch()
+            frames = [frame for _, frame, _ in batch]
+            start = time.perf_counter()
+            try:
+                results = await loop.run_in_executor(self._executor, self._infer, frames)
+            except Exception as e:
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.metrics.add(len(batch), sum((start - arrived) * 1000 for arrived, _, _ in batch) / len(batch),
+                             (time.perf_counter() - start) * 1000)
+            for (_, _, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+    def close(self):
+        if self._task:
+            self._task.cancel()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+class BatchedTrack(MediaStreamTrack):
+    """
+    A video track returning the BatchStage's results for another track's
+    frames.
+
+    track: video track to read from
+    stage: BatchStage shared with other tracks
+    """
+
+    kind = "video"
+
+    def __init__(self, track, stage):
+        super().__init__()
+        self.track = track
+        self._stage = stage
+
+    async def recv(self):
+        frame = await self.track.recv()
+        return await self._stage.submit(frame)
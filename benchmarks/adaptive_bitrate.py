@@ -0,0 +1,109 @@
+"""
+Run bitrate policies offline against a simulated lossy link whose capacity
+changes over time, and compare how much of the link they use against the
+loss and queueing delay they cause.
+
+    python benchmarks/adaptive_bitrate.py --seconds 120 --loss 0.01
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from bitrate_controller import LinkStats, LossBasedPolicy, Settings, StaticPolicy  # noqa: E402
+
+# (seconds, capacity in bits per second), repeated until the run ends
+CAPACITY_TRACE = [(20, 2000000), (20, 600000), (20, 250000), (20, 1200000)]
+
+
+class SimulatedLink:
+    """
+    A bottleneck with a drop-tail queue, random loss and an optional REMB
+    estimate from the receiver.
+
+    base_rtt: round trip time of the empty link in seconds
+    loss: random loss rate on top of queue overflow
+    queue_seconds: queue size in seconds of the current capacity
+    remb: whether the receiver sends an estimate of the capacity
+    """
+
+    def __init__(self, base_rtt=0.05, loss=0.01, queue_seconds=0.5, remb=False, seed=0):
+        self._base_rtt = base_rtt
+        self._loss = loss
+        self._queue_seconds = queue_seconds
+        self._remb = remb
+        self._random = random.Random(seed)
+        self._queued = 0
+
+    def step(self, bitrate, capacity, interval):
+        sent = bitrate * interval
+        self._queued += sent
+        delivered = min(self._queued, capacity * interval)
+        self._queued -= delivered
+        dropped = max(0, self._queued - capacity * self._queue_seconds)
+        self._queued -= dropped
+        fraction_lost = min(1.0, dropped / sent + self._random.uniform(0, 2 * self._loss))
+        rtt = self._base_rtt + self._queued / capacity
+        estimate = capacity * self._random.uniform(0.85, 1.0) if self._remb else None
+        stats = LinkStats(rtt=rtt, fraction_lost=fraction_lost, estimate=estimate, send_rate=bitrate)
+        return stats, delivered * (1 - fraction_lost) / interval
+
+
+def capacity_at(second):
+    second %= sum(duration for duration, _ in CAPACITY_TRACE)
+    for duration, capacity in CAPACITY_TRACE:
+        if second < duration:
+            return capacity
+        second -= duration
+
+
+def simulate(policy, link, seconds, interval):
+    settings = policy.initial()
+    utilisation, losses, rtts, switches = [], [], [], 0
+    for tick in range(int(seconds / interval)):
+        capacity = capacity_at(tick * interval)
+        stats, goodput = link.step(settings.bitrate, capacity, interval)
+        utilisation.append(goodput / capacity)
+        losses.append(stats.fraction_lost)
+        rtts.append(stats.rtt)
+        new_settings = policy.update(stats, settings)
+        if (new_settings.scale, new_settings.framerate) != (settings.scale, settings.framerate):
+            switches += 1
+        settings = new_settings
+    return {
+        "utilisation": round(statistics.mean(utilisation), 3),
+        "mean_loss": round(statistics.mean(losses), 3),
+        "mean_rtt_ms": round(statistics.mean(rtts) * 1000, 1),
+        "p95_rtt_ms": round(sorted(rtts)[int(len(rtts) * 0.95)] * 1000, 1),
+        "resolution_switches": switches,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Adaptive bitrate policy simulation")
+    parser.add_argument("--seconds", type=int, default=160)
+    parser.add_argument("--interval", type=float, default=1.0, help="Seconds between stats samples")
+    parser.add_argument("--loss", type=float, default=0.01, help="Random loss rate of the link")
+    parser.add_argument("--rtt", type=float, default=0.05, help="Round trip time of the empty link in seconds")
+    parser.add_argument("--remb", action="store_true", help="Receiver sends REMB estimates")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    policies = {
+        "static_500k": lambda: StaticPolicy(Settings(bitrate=500000)),
+        "static_1500k": lambda: StaticPolicy(Settings(bitrate=1500000)),
+        "loss_based": LossBasedPolicy,
+    }
+    results = {}
+    for name, policy in policies.items():
+        link = SimulatedLink(base_rtt=args.rtt, loss=args.loss, remb=args.remb, seed=args.seed)
+        results[name] = simulate(policy(), link, args.seconds, args.interval)
+    print(json.dumps({"trace": CAPACITY_TRACE, "loss": args.loss, "remb": args.remb, "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""
+Compare running a model frame by frame against batching frames from many
+tracks through a BatchStage, with every track sending as fast as results
+come back.
+
+    python benchmarks/batch_inference.py --tracks 8 --batch-sizes 1 4 8
+"""
+import argparse
+import asyncio
+import fractions
+import json
+import os
+import statistics
+import sys
+import time
+
+import av
+from aiortc import MediaStreamTrack
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from batch_inference import BatchedTrack, BatchStage, SobelEdgesModel  # noqa: E402
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+
+
+class OverheadModel(SobelEdgesModel):
+    """
+    Adds a fixed cost per call, like the dispatch and transfer cost of a
+    DNN runtime or accelerator, which is what batching amortises.
+    """
+
+    def __init__(self, overhead_ms):
+        self._overhead = overhead_ms / 1000
+
+    def infer(self, batch):
+        time.sleep(self._overhead)
+        return super().infer(batch)
+
+
+class LoopTrack(MediaStreamTrack):
+    """
+    Returns decoded frames in a loop, as fast as they are asked for.
+    """
+
+    kind = "video"
+
+    def __init__(self, frames):
+        super().__init__()
+        self._frames = frames
+        self._index = 0
+
+    async def recv(self):
+        frame = self._frames[self._index % len(self._frames)]
+        frame.pts = self._index
+        frame.time_base = fractions.Fraction(1, 30)
+        self._index += 1
+        # a real track waits for the network, letting other tracks run
+        await asyncio.sleep(0)
+        return frame
+
+
+async def consume(track, seconds):
+    latencies = []
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        start = time.perf_counter()
+        await track.recv()
+        latencies.append((time.perf_counter() - start) * 1000)
+    return latencies
+
+
+async def run_batch_size(frames, batch_size, args):
+    stage = BatchStage(OverheadModel(args.call_overhead_ms), batch_size=batch_size, max_delay=args.max_delay)
+    tracks = [BatchedTrack(LoopTrack(frames), stage) for _ in range(args.tracks)]
+    latencies = await asyncio.gather(*[consume(track, args.seconds) for track in tracks])
+    stage.close()
+    latencies = [latency for track in latencies for latency in track]
+    return {
+        "batch_size": batch_size,
+        "frames_per_second": round(len(latencies) / args.seconds, 1),
+        "latency_ms": round(statistics.mean(latencies), 2),
+        **stage.metrics.as_dict(),
+    }
+
+
+def load_frames(path, count, width, height):
+    frames = []
+    with av.open(path) as container:
+        for frame in container.decode(video=0):
+            frames.append(frame.reformat(width=width, height=height, format="yuv420p"))
+            if len(frames) == count:
+                break
+    return frames
+
+
+async def run(args):
+    width, height = map(int, args.size.split("x"))
+    frames = load_frames(args.file, 30, width, height)
+    return [await run_batch_size(frames, batch_size, args) for batch_size in args.batch_sizes]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Batched inference benchmark")
+    parser.add_argument("--file", default=os.path.join(ROOT, "big_buck_bunny_720p_1mb.mp4"))
+    parser.add_argument("--size", default="640x480")
+    parser.add_argument("--tracks", type=int, default=8)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 4, 8])
+    parser.add_argument("--max-delay", type=float, default=0.02)
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--call-overhead-ms", type=float, default=0,
+                        help="Fixed cost added to every model call")
+    args = parser.parse_args()
+    print(json.dumps({"tracks": args.tracks, "size": args.size, "call_overhead_ms": args.call_overhead_ms, "results": asyncio.run(run(args))}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
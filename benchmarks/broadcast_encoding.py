@@ -0,0 +1,83 @@
+"""
+Compare CPU cost per viewer of per-peer encoding against the shared
+EncodedBroadcast encoder.
+
+    python benchmarks/broadcast_encoding.py --viewers 1 2 4 8
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import av
+from aiortc.codecs import get_encoder
+from aiortc.rtcrtpparameters import RTCRtpCodecParameters
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from broadcast import EncodedBroadcast  # noqa: E402
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+CODECS = {
+    "video/H264": RTCRtpCodecParameters(mimeType="video/H264", clockRate=90000, payloadType=102),
+    "video/VP8": RTCRtpCodecParameters(mimeType="video/VP8", clockRate=90000, payloadType=96),
+}
+
+
+def load_frames(path, count, width, height):
+    frames = []
+    with av.open(path) as container:
+        for frame in container.decode(video=0):
+            frames.append(frame.reformat(width=width, height=height, format="yuv420p"))
+            if len(frames) == count:
+                break
+    return frames
+
+
+def per_peer(frames, codec, viewers):
+    encoders = [get_encoder(CODECS[codec]) for _ in range(viewers)]
+    start = time.process_time()
+    for frame in frames:
+        for encoder in encoders:
+            encoder.encode(frame)
+    return time.process_time() - start
+
+
+def shared(frames, codec, viewers):
+    broadcast = EncodedBroadcast(None, codec=codec)
+    packers = [get_encoder(CODECS[codec]) for _ in range(viewers)]
+    start = time.process_time()
+    for frame in frames:
+        for packet in broadcast._encode(frame, False):
+            for packer in packers:
+                packer.pack(packet)
+    return time.process_time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Broadcast encoding benchmark")
+    parser.add_argument("--file", default=os.path.join(ROOT, "big_buck_bunny_720p_1mb.mp4"))
+    parser.add_argument("--frames", type=int, default=120)
+    parser.add_argument("--size", default="640x480")
+    parser.add_argument("--codec", default="video/H264", choices=sorted(CODECS))
+    parser.add_argument("--viewers", type=int, nargs="+", default=[1, 2, 4, 8])
+    args = parser.parse_args()
+
+    width, height = map(int, args.size.split("x"))
+    frames = load_frames(args.file, args.frames, width, height)
+    results = []
+    for viewers in args.viewers:
+        for mode, run in (("per_peer", per_peer), ("broadcast", shared)):
+            cpu = run(frames, args.codec, viewers)
+            results.append({
+                "mode": mode,
+                "viewers": viewers,
+                "cpu_ms_per_frame": round(cpu * 1000 / len(frames), 3),
+                "cpu_ms_per_frame_per_viewer": round(cpu * 1000 / len(frames) / viewers, 3),
+            })
+    print(json.dumps({"codec": args.codec, "size": args.size, "frames": len(frames), "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+"""
+Measure what finding and opening a capture source costs a call, before and
+after capture_sources.
+
+Before, get_media spawned ffmpeg to list devices on every call and opened
+the device on the event loop. Here the spawn is of --list-command, ffmpeg
+itself where it is installed, and the devices are synthetic lavfi sources,
+each call opening its own so that none is already open. While calls run,
+a task ticking every millisecond records the longest the event loop was
+blocked, which is how long every other session stalled.
+
+    python benchmarks/capture_sources.py --calls 1 8 --lookups 1000
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+from aiortc.contrib.media import MediaPlayer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from capture_hub import hub as capture_hub  # noqa: E402
+from capture_sources import CaptureRegistry, CaptureSource  # noqa: E402
+
+
+def default_list_command():
+    if shutil.which("ffmpeg"):
+        return "ffmpeg -hide_banner -list_devices true -f lavfi -i dummy"
+    return "true"
+
+
+def source(index):
+    # a source of its own per call, so every call opens one
+    return CaptureSource(f"testsrc{index}", ("video",), f"testsrc=size=640x480:rate={30 + index}", "lavfi",
+                         type="synthetic")
+
+
+async def ticker(stalls):
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(0.001)
+        stalls.append(time.perf_counter() - start - 0.001)
+
+
+async def call_before(index, args):
+    # what get_media did: list devices, then open the device on the loop
+    subprocess.run(args.list_command.split(), capture_output=True, text=True)
+    opened = source(index)
+    return MediaPlayer(opened.file, format=opened.format, options=opened.options).video
+
+
+async def call_after(index, args, registry):
+    await registry.find("video", None)
+    opened = source(index)
+    await registry.open(opened)
+    return await capture_hub.subscribe(opened.file, "video", format=opened.format, options=opened.options)
+
+
+async def run_calls(mode, calls, args):
+    registry = CaptureRegistry()
+    await registry.sources()
+    stalls = []
+    tick = asyncio.ensure_future(ticker(stalls))
+    await asyncio.sleep(0.05)
+    stalls.clear()
+    start = time.perf_counter()
+    if mode == "before":
+        tracks = await asyncio.gather(*[call_before(index, args) for index in range(calls)])
+    else:
+        tracks = await asyncio.gather(*[call_after(index, args, registry) for index in range(calls)])
+    elapsed = time.perf_counter() - start
+    # the ticker records a stall only once it runs again
+    await asyncio.sleep(0.01)
+    tick.cancel()
+    for track in tracks:
+        # releases the capture of subscribed tracks, stops the player of the others
+        track.stop()
+    return {
+        "mode": mode,
+        "calls": calls,
+        "total_ms": round(elapsed * 1000, 1),
+        "loop_blocked_max_ms": round(max(stalls, default=0) * 1000, 1),
+    }
+
+
+async def enumeration(args):
+    start = time.perf_counter()
+    for _ in range(args.spawns):
+        subprocess.run(args.list_command.split(), capture_output=True, text=True)
+    spawn = (time.perf_counter() - start) / args.spawns
+
+    registry = CaptureRegistry()
+    start = time.perf_counter()
+    await registry.sources()
+    cold = time.perf_counter() - start
+    start = time.perf_counter()
+    for _ in range(args.lookups):
+        await registry.find("video", "testsrc")
+    cached = (time.perf_counter() - start) / args.lookups
+    return {
+        "list_command": args.list_command,
+        "spawn_ms": round(spawn * 1000, 2),
+        "registry_first_listing_ms": round(cold * 1000, 2),
+        "registry_cached_lookup_us": round(cached * 1e6, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Capture source lookup and open benchmark")
+    parser.add_argument("--calls", type=int, nargs="+", default=[1, 8])
+    parser.add_argument("--list-command", default=default_list_command(),
+                        help="Command standing in for ffmpeg's device listing")
+    parser.add_argument("--spawns", type=int, default=20)
+    parser.add_argument("--lookups", type=int, default=1000)
+    args = parser.parse_args()
+
+    results = [asyncio.run(run_calls(mode, calls, args)) for calls in args.calls for mode in ("before", "after")]
+    print(json.dumps({"enumeration": asyncio.run(enumeration(args)), "calls": results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+"""
+Drive the aiohttp control API with many simultaneous /call, /send_message
+and /hangup requests against stand-ins for the Unity client, and check
+that every call connects and every message arrives.
+
+The remote peers share a loop on their own thread, signaling through an
+in-process websocket.py relay, so the app's loop only runs the sessions.
+Exits with status 1 if any call or message fails.
+
+    python benchmarks/control_api.py --calls 16
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+
+import aiohttp
+import websockets
+from aiohttp import web
+from aiortc import RTCPeerConnection, RTCSessionDescription
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import websocket as relay  # noqa: E402
+from aiortc_aiohttp import create_app  # noqa: E402
+from aiortc_connection import AiortcConnection  # noqa: E402
+from session_manager import SessionManager  # noqa: E402
+from signaling_codec import decode_message, encode_description  # noqa: E402
+
+
+class RemotePeer:
+    """
+    Answers the offer like the Unity client and records when the data
+    channel opens and which messages arrive on it.
+    """
+
+    def __init__(self, uri, uid):
+        self.uri = uri
+        self.uid = uid
+        self.opened = None
+        self.messages = []
+
+    async def run(self, stop):
+        pc = RTCPeerConnection()
+
+        @pc.on("datachannel")
+        def on_datachannel(channel):
+            self.opened = time.perf_counter()
+            channel.on("message", self.messages.append)
+
+        async with websockets.connect(f"{self.uri}?type=u&uid={self.uid}&token=bench") as ws:
+            message = decode_message(await ws.recv())
+            await pc.setRemoteDescription(RTCSessionDescription(sdp=message.sdp, type=message.type))
+            await pc.setLocalDescription(await pc.createAnswer())
+            await ws.send(encode_description(pc.localDescription.type, pc.localDescription.sdp))
+            await stop.wait()
+        await pc.close()
+
+
+def run_remote_peers(peers, ready, stop_holder):
+    async def main():
+        stop = asyncio.Event()
+        stop_holder.append((asyncio.get_running_loop(), stop))
+        tasks = [asyncio.ensure_future(peer.run(stop)) for peer in peers]
+        # every peer has to be in its room before the calls are made
+        while len(relay.rooms) < len(peers):
+            await asyncio.sleep(0.01)
+        ready.set()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    asyncio.run(main())
+
+
+async def post_all(session, base, path, bodies):
+    async def post(body):
+        start = time.perf_counter()
+        async with session.post(base + path, json=body) as response:
+            await response.read()
+            return response.status, (time.perf_counter() - start) * 1000
+    return await asyncio.gather(*[post(body) for body in bodies])
+
+
+def summary(results):
+    latencies = sorted(latency for _, latency in results)
+    return {
+        "ok": sum(1 for status, _ in results if status == 200),
+        "latency_p50_ms": round(latencies[len(latencies) // 2], 1),
+        "latency_max_ms": round(latencies[-1], 1),
+        "latency_mean_ms": round(statistics.mean(latencies), 1),
+    }
+
+
+async def run(args):
+    server = await websockets.serve(relay.handle_connection, "127.0.0.1", 0)
+    uri = f"ws://127.0.0.1:{server.sockets[0].getsockname()[1]}/ws"
+    sessions = SessionManager(
+        max_sessions=args.calls,
+        connection_factory=lambda peer_id: AiortcConnection(uid=peer_id, websocket_uri=uri + "?type=w&uid={uid}&token=bench"))
+    runner = web.AppRunner(create_app(sessions))
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    base = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+
+    peers = [RemotePeer(uri, f"peer{i}") for i in range(args.calls)]
+    ready = threading.Event()
+    stop_holder = []
+    remote = threading.Thread(target=run_remote_peers, args=(peers, ready, stop_holder))
+    remote.start()
+    await asyncio.to_thread(ready.wait, 30)
+
+    async with aiohttp.ClientSession() as session:
+        start = time.perf_counter()
+        calls = await post_all(session, base, "/call", [{"peer_id": peer.uid} for peer in peers])
+        deadline = time.monotonic() + args.timeout
+        while any(peer.opened is None for peer in peers) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        connected = [peer for peer in peers if peer.opened is not None]
+        all_connected = (max(peer.opened for peer in connected) - start) * 1000 if connected else None
+
+        messages = await post_all(session, base, "/send_message",
+                                  [{"peer_id": peer.uid, "message": f"hello {peer.uid}"} for peer in peers])
+        deadline = time.monotonic() + args.timeout
+        while any(not peer.messages for peer in connected) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        delivered = sum(1 for peer in peers if peer.messages == [f"hello {peer.uid}"])
+        hangups = await post_all(session, base, "/hangup", [{"peer_id": peer.uid} for peer in peers])
+
+    loop, stop = stop_holder[0]
+    loop.call_soon_threadsafe(stop.set)
+    await asyncio.to_thread(remote.join)
+    await runner.cleanup()
+    server.close()
+    await server.wait_closed()
+    return {
+        "calls": args.calls,
+        "call": summary(calls),
+        "connected": len(connected),
+        "all_connected_ms": round(all_connected, 1) if all_connected else None,
+        "send_message": summary(messages),
+        "delivered": delivered,
+        "hangup": summary(hangups),
+        "sessions_left": len(sessions),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Control API concurrency check")
+    parser.add_argument("--calls", type=int, default=16, help="Simultaneous calls, one per peer")
+    parser.add_argument("--timeout", type=float, default=30)
+    args = parser.parse_args()
+    report = asyncio.run(run(args))
+    print(json.dumps(report, indent=2))
+    ok = report["call"]["ok"] == report["connected"] == report["delivered"] == args.calls
+    sys.exit(0 if ok and report["sessions_left"] == 0 else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""
+Measure data channel messages/s and latency over a loopback peer pair, for
+plain RTCDataChannel.send and for MessageChannel with and without framing,
+plus the unordered, unreliable telemetry channel.
+
+    python benchmarks/datachannel.py --messages 20000 --size 64
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import struct
+import sys
+import time
+
+from aiortc import RTCPeerConnection
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from datachannel_messaging import MessageChannel  # noqa: E402
+
+STAMP = struct.Struct("!dI")
+# messages sent between waits for the channel to drain
+BURST = 100
+
+
+async def connect(pc1, pc2):
+    await pc1.setLocalDescription(await pc1.createOffer())
+    await pc2.setRemoteDescription(pc1.localDescription)
+    await pc2.setLocalDescription(await pc2.createAnswer())
+    await pc1.setRemoteDescription(pc2.localDescription)
+
+
+async def run_mode(mode, args):
+    pc1, pc2 = RTCPeerConnection(), RTCPeerConnection()
+    if mode == "telemetry":
+        channel = pc1.createDataChannel("telemetry", ordered=False, maxRetransmits=0)
+    else:
+        channel = pc1.createDataChannel("chat")
+    framed = mode in ("framed", "telemetry")
+    sender = None if mode == "raw" else MessageChannel(channel, framed=framed, drop_when_full=mode == "telemetry")
+
+    latencies = []
+    done = asyncio.Event()
+    peak_buffered = 0
+
+    def on_message(message):
+        sent, index = STAMP.unpack_from(message)
+        latencies.append((time.perf_counter() - sent) * 1000)
+        if index == args.messages - 1:
+            done.set()
+
+    @pc2.on("datachannel")
+    def on_datachannel(remote):
+        if mode == "raw":
+            remote.on("message", on_message)
+        else:
+            MessageChannel(remote, framed=framed, on_message=on_message)
+
+    opened = asyncio.Event()
+    channel.on("open", opened.set)
+    await connect(pc1, pc2)
+    await opened.wait()
+
+    padding = b"x" * max(0, args.size - STAMP.size)
+    start = time.perf_counter()
+    for i in range(args.messages):
+        message = STAMP.pack(time.perf_counter(), i) + padding
+        if sender:
+            sender.send(message)
+        else:
+            channel.send(message)
+        if i % BURST == BURST - 1:
+            if sender and not sender.drop_when_full:
+                await sender.drain()
+            else:
+                await asyncio.sleep(0)
+            peak_buffered = max(peak_buffered, channel.bufferedAmount)
+    try:
+        await asyncio.wait_for(done.wait(), args.timeout)
+    except asyncio.TimeoutError:
+        # the last message of an unreliable channel may be lost
+        pass
+    elapsed = time.perf_counter() - start
+    await pc1.close()
+    await pc2.close()
+
+    return {
+        "mode": mode,
+        "received": len(latencies),
+        "messages_per_second": round(len(latencies) / elapsed),
+        "latency_mean_ms": round(statistics.mean(latencies), 2),
+        "latency_p95_ms": round(sorted(latencies)[int(len(latencies) * 0.95)], 2),
+        "peak_buffered_bytes": peak_buffered,
+    }
+
+
+async def run(args):
+    return [await run_mode(mode, args) for mode in args.modes]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Data channel messaging benchmark")
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--size", type=int, default=64, help="Message size in bytes")
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--modes", nargs="+", default=["raw", "unframed", "framed", "telemetry"])
+    args = parser.parse_args()
+    print(json.dumps({"messages": args.messages, "size": args.size, "results": asyncio.run(run(args))}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""
+Compare ms/frame of the previous BGR VideoTransformTrack transforms against
+the yuv420p TransformEngine, per transform and resolution.
+
+    python benchmarks/frame_transforms.py --sizes 640x480 1280x720
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import av
+import cv2
+from av import VideoFrame
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from frame_transforms import TransformEngine, parse_chain  # noqa: E402
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+
+
+def bgr_cartoon(img, frame):
+    img_color = cv2.pyrDown(cv2.pyrDown(img))
+    for _ in range(6):
+        img_color = cv2.bilateralFilter(img_color, 9, 9, 7)
+    img_color = cv2.pyrUp(cv2.pyrUp(img_color))
+    img_edges = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
+    img_edges = cv2.adaptiveThreshold(
+        cv2.medianBlur(img_edges, 7), 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY, 9, 2)
+    img_edges = cv2.cvtColor(img_edges, cv2.COLOR_GRAY2RGB)
+    return cv2.bitwise_and(img_color, img_edges)
+
+
+def bgr_edges(img, frame):
+    return cv2.cvtColor(cv2.Canny(img, 100, 200), cv2.COLOR_GRAY2BGR)
+
+
+def bgr_rotate(img, frame):
+    rows, cols, _ = img.shape
+    M = cv2.getRotationMatrix2D((cols / 2, rows / 2), frame.time * 45, 1)
+    return cv2.warpAffine(img, M, (cols, rows))
+
+
+def bgr_chain(*transforms):
+    def run(img, frame):
+        for transform in transforms:
+            img = transform(img, frame)
+        return img
+    return run
+
+
+BGR_TRANSFORMS = {
+    "cartoon": bgr_cartoon,
+    "edges": bgr_edges,
+    "rotate": bgr_rotate,
+    "edges+rotate": bgr_chain(bgr_edges, bgr_rotate),
+}
+
+
+def load_frames(path, count, width, height):
+    frames = []
+    with av.open(path) as container:
+        for frame in container.decode(video=0):
+            frames.append(frame.reformat(width=width, height=height, format="yuv420p"))
+            if len(frames) == count:
+                break
+    return frames
+
+
+def run_bgr(frames, transform):
+    # what VideoTransformTrack.recv did for every frame
+    start = time.perf_counter()
+    for frame in frames:
+        img = transform(frame.to_ndarray(format="bgr24"), frame)
+        new_frame = VideoFrame.from_ndarray(img, format="bgr24")
+        new_frame.pts = frame.pts
+        new_frame.time_base = frame.time_base
+        # the encoder converts back to yuv420p
+        new_frame.reformat(format="yuv420p")
+    return time.perf_counter() - start
+
+
+def run_engine(frames, names):
+    engine = TransformEngine(parse_chain(names))
+    start = time.perf_counter()
+    for frame in frames:
+        engine.process(frame)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Frame transform benchmark")
+    parser.add_argument("--file", default=os.path.join(ROOT, "big_buck_bunny_720p_1mb.mp4"))
+    parser.add_argument("--frames", type=int, default=60)
+    parser.add_argument("--sizes", nargs="+", default=["640x480", "1280x720"])
+    parser.add_argument("--transforms", nargs="+", default=list(BGR_TRANSFORMS))
+    args = parser.parse_args()
+
+    results = []
+    for size in args.sizes:
+        width, height = map(int, size.split("x"))
+        frames = load_frames(args.file, args.frames, width, height)
+        for name in args.transforms:
+            bgr = run_bgr(frames, BGR_TRANSFORMS[name])
+            yuv = run_engine(frames, name)
+            results.append({
+                "size": size,
+                "transform": name,
+                "bgr_ms_per_frame": round(bgr * 1000 / len(frames), 2),
+                "yuv_ms_per_frame": round(yuv * 1000 / len(frames), 2),
+            })
+    print(json.dumps({"frames": args.frames, "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+"""
+Measure how much video transforms stall the event loop when run inline, as
+VideoTransformTrack does, and on a thread or process WorkerPool, with
+several tracks fed at a fixed frame rate.
+
+    python benchmarks/frame_workers.py --tracks 2 --transform cartoon
+"""
+import argparse
+import asyncio
+import fractions
+import json
+import os
+import statistics
+import sys
+import time
+
+import av
+from aiortc import MediaStreamTrack
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from frame_transforms import TransformEngine, parse_chain  # noqa: E402
+from frame_workers import OffloadedTransformTrack, WorkerPool  # noqa: E402
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+
+
+class PacedTrack(MediaStreamTrack):
+    """
+    Replays decoded frames at a fixed frame rate, like a camera.
+    """
+
+    kind = "video"
+
+    def __init__(self, frames, fps):
+        super().__init__()
+        self._frames = frames
+        self._fps = fps
+        self._index = 0
+        self._start = None
+
+    async def recv(self):
+        if self._start is None:
+            self._start = time.perf_counter()
+        due = self._start + self._index / self._fps
+        await asyncio.sleep(max(0, due - time.perf_counter()))
+        frame = self._frames[self._index % len(self._frames)]
+        frame.pts = self._index
+        frame.time_base = fractions.Fraction(1, self._fps)
+        self._index += 1
+        return frame
+
+
+class InlineTrack(MediaStreamTrack):
+    kind = "video"
+
+    def __init__(self, track, transform):
+        super().__init__()
+        self._track = track
+        self._engine = TransformEngine(parse_chain(transform))
+
+    async def recv(self):
+        return self._engine.process(await self._track.recv())
+
+
+async def loop_lag(stop, interval=0.005):
+    # how late a timer fires is how long anything else on the loop had to wait
+    lags = []
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append((time.perf_counter() - start - interval) * 1000)
+    return lags
+
+
+async def consume(track, seconds):
+    # stands in for the sender, which encodes each frame before asking for the next
+    sent = 0
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        await track.recv()
+        sent += 1
+    return sent
+
+
+async def run_mode(mode, frames, args):
+    pool = WorkerPool(mode, args.workers) if mode != "inline" else None
+    tracks = []
+    for _ in range(args.tracks):
+        source = PacedTrack(frames, args.fps)
+        if pool:
+            tracks.append(OffloadedTransformTrack(source, args.transform, pool))
+        else:
+            tracks.append(InlineTrack(source, args.transform))
+
+    stop = asyncio.Event()
+    lag_task = asyncio.create_task(loop_lag(stop))
+    sent = await asyncio.gather(*[consume(track, args.seconds) for track in tracks])
+    stop.set()
+    lags = await lag_task
+    for track in tracks:
+        track.stop()
+    if pool:
+        pool.close()
+
+    result = {
+        "mode": mode,
+        "fps_per_track": round(statistics.mean(sent) / args.seconds, 1),
+        "loop_lag_mean_ms": round(statistics.mean(lags), 2),
+        "loop_lag_max_ms": round(max(lags), 2),
+    }
+    if pool:
+        metrics = [track.metrics_dict() for track in tracks]
+        result["dropped"] = sum(m["dropped"] for m in metrics)
+        result["processing_ms"] = round(statistics.mean(m["processing_ms"] for m in metrics), 2)
+        result["latency_ms"] = round(statistics.mean(m["latency_ms"] for m in metrics), 2)
+    return result
+
+
+def load_frames(path, count, width, height):
+    frames = []
+    with av.open(path) as container:
+        for frame in container.decode(video=0):
+            frames.append(frame.reformat(width=width, height=height, format="yuv420p"))
+            if len(frames) == count:
+                break
+    return frames
+
+
+async def run(args):
+    width, height = map(int, args.size.split("x"))
+    frames = load_frames(args.file, 30, width, height)
+    return [await run_mode(mode, frames, args) for mode in args.modes]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Off-loop frame transform benchmark")
+    parser.add_argument("--file", default=os.path.join(ROOT, "big_buck_bunny_720p_1mb.mp4"))
+    parser.add_argument("--size", default="640x480")
+    parser.add_argument("--transform", default="cartoon")
+    parser.add_argument("--tracks", type=int, default=2)
+    parser.add_argument("--fps", type=int, default=30)
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--modes", nargs="+", default=["inline", "thread", "process"])
+    args = parser.parse_args()
+    print(json.dumps({"transform": args.transform, "size": args.size, "tracks": args.tracks,
+                      "results": asyncio.run(run(args))}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,263 @@
+"""
+End to end benchmark of two AiortcConnection peers signaling through a local
+websocket.py relay, one streaming a file with get_media(play_from=...) and
+the other receiving it like the Unity client.
+
+Each peer runs in its own process so that CPU time and RSS can be told
+apart; the relay runs in this one. The sender stamps the send time into
+the pixels of every frame and the receiver reads it back after decoding,
+which gives glass-to-glass latency through encode, network, jitter buffer
+and decode. Results are printed as JSON, with the current commit, so runs
+can be compared between commits:
+
+    python benchmarks/loopback.py --seconds 10 --output results.json
+
+With --trace-to, the sender also traces every frame through its pipeline,
+reports the mean time spent in each stage and writes a Chrome trace.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+# the stamp is two rows of BITS blocks, the second row inverted as a check
+BITS = 32
+BLOCK = 16
+
+
+def stamp(frame, value):
+    # draw value into the top left of the luma plane, one block per bit
+    from frame_transforms import planes
+    y = planes(frame)[0]
+    for bit in range(BITS):
+        on = (value >> bit) & 1
+        x = bit * BLOCK
+        y[0:BLOCK, x:x + BLOCK] = 235 if on else 16
+        y[BLOCK:2 * BLOCK, x:x + BLOCK] = 16 if on else 235
+
+
+def read_stamp(frame):
+    y = frame.to_ndarray(format="gray")
+    value = 0
+    for bit in range(BITS):
+        x = bit * BLOCK + BLOCK // 2
+        on = int(y[BLOCK // 2, x] > 128)
+        if on == int(y[BLOCK + BLOCK // 2, x] > 128):
+            # blocks did not survive encoding, e.g. on the first keyframe
+            return None
+        value |= on << bit
+    return value
+
+
+def now_ms():
+    # CLOCK_MONOTONIC is shared by all processes on the machine
+    return int(time.monotonic() * 1000) & 0xFFFFFFFF
+
+
+def usage():
+    rusage = resource.getrusage(resource.RUSAGE_SELF)
+    return {"cpu_s": round(rusage.ru_utime + rusage.ru_stime, 2), "max_rss_mb": round(rusage.ru_maxrss / 1024, 1)}
+
+
+async def send(uri, uid, file, seconds, trace_to, results):
+    import tracing
+    from aiortc import MediaStreamTrack
+    from aiortc_connection import AiortcConnection
+
+    class StampedTrack(MediaStreamTrack):
+        kind = "video"
+
+        def __init__(self, track):
+            super().__init__()
+            self._track = track
+
+        async def recv(self):
+            frame = await self._track.recv()
+            if frame.format.name != "yuv420p":
+                frame = frame.reformat(format="yuv420p")
+            stamp(frame, now_ms())
+            return frame
+
+    if trace_to:
+        tracing.enable()
+    connection = AiortcConnection(uid=uid, websocket_uri=uri + "?type=w&uid={uid}&token=bench")
+    connected = asyncio.Event()
+    start = time.monotonic()
+    await connection.connect_to_websocket()
+    connection.start_signaling()
+    connection.create_peer_connection()
+    pc = connection._pc
+
+    @pc.on("connectionstatechange")
+    def on_connectionstatechange():
+        if pc.connectionState == "connected":
+            connected.set()
+
+    connection.create_data_channel()
+    await connection.get_media(play_from=file)
+    for sender in pc.getSenders():
+        if sender.track and sender.track.kind == "video":
+            # stamped as the frame leaves the player, wrapped by the encode trace point if tracing
+            track = sender.track
+            if isinstance(track, tracing.TracedTrack):
+                track._track = StampedTrack(track._track)
+            else:
+                sender.replaceTrack(StampedTrack(track))
+    await connection.send_offer()
+    await connected.wait()
+    setup = time.monotonic() - start
+    await asyncio.sleep(seconds)
+
+    result = {"peer": "sender", "start": start, "setup_ms": round(setup * 1000, 1), **usage()}
+    if trace_to:
+        result["stage_ms"] = tracing.stage_summary()
+        tracing.dump(trace_to)
+    results.put(result)
+    connection.stop_signaling()
+    await connection.disconnect_from_websocket()
+    await connection.clear()
+
+
+async def receive(uri, uid, seconds, ready, results):
+    from aiortc.mediastreams import MediaStreamError
+    from aiortc_connection import AiortcConnection
+
+    connection = AiortcConnection(uid=uid, websocket_uri=uri + "?type=u&uid={uid}&token=bench")
+    await connection.connect_to_websocket()
+    connection.start_signaling()
+    connection.create_peer_connection()
+    first_frame = None
+    frames = 0
+    latencies = []
+    done = asyncio.Event()
+
+    async def read(track):
+        nonlocal first_frame, frames
+        while True:
+            try:
+                frame = await track.recv()
+            except MediaStreamError:
+                return
+            received = now_ms()
+            if first_frame is None:
+                first_frame = time.monotonic()
+                asyncio.get_running_loop().call_later(seconds, done.set)
+            frames += 1
+            sent = read_stamp(frame)
+            if sent is not None:
+                latencies.append((received - sent) & 0xFFFFFFFF)
+
+    @connection._pc.on("track")
+    def on_track(track):
+        if track.kind == "video":
+            asyncio.ensure_future(read(track))
+
+    ready.set()
+    await done.wait()
+    latencies.sort()
+    results.put({
+        "peer": "receiver",
+        "first_frame": first_frame,
+        "frames_per_second": round(frames / seconds, 1),
+        "stamped_frames": len(latencies),
+        "glass_to_glass_mean_ms": round(statistics.mean(latencies), 1) if latencies else None,
+        "glass_to_glass_p50_ms": latencies[len(latencies) // 2] if latencies else None,
+        "glass_to_glass_p95_ms": latencies[int(len(latencies) * 0.95)] if latencies else None,
+        **usage(),
+    })
+    connection.stop_signaling()
+    await connection.disconnect_from_websocket()
+    await connection.clear()
+
+
+def run_peer(role, args, ready, results):
+    if role == "sender":
+        asyncio.run(send(*args, results))
+    else:
+        asyncio.run(receive(*args, ready, results))
+
+
+def commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(args):
+    import websockets
+    import websocket as relay
+
+    server = await websockets.serve(relay.handle_connection, "127.0.0.1", 0)
+    uri = f"ws://127.0.0.1:{server.sockets[0].getsockname()[1]}/ws"
+    context = multiprocessing.get_context("spawn")
+    ready = context.Event()
+    results = context.Queue()
+    # the receiver settles longer than the sender streams for, so it sees the whole stream
+    receiver = context.Process(target=run_peer, args=("receiver", (uri, "bench", args.seconds), ready, results))
+    sender = context.Process(target=run_peer, args=("sender", (uri, "bench", args.file, args.seconds + 5, args.trace_to), ready, results))
+    receiver.start()
+    await asyncio.to_thread(ready.wait, 30)
+    sender.start()
+
+    peers = {}
+    for _ in range(2):
+        result = await asyncio.to_thread(results.get, True, args.seconds + 60)
+        peers[result.pop("peer")] = result
+    await asyncio.to_thread(receiver.join)
+    await asyncio.to_thread(sender.join)
+    server.close()
+    await server.wait_closed()
+
+    start = peers["sender"].pop("start")
+    first_frame = peers["receiver"].pop("first_frame")
+    report = {
+        "commit": commit(),
+        "file": os.path.basename(args.file),
+        "seconds": args.seconds,
+        "setup_ms": peers["sender"]["setup_ms"],
+        "time_to_first_frame_ms": round((first_frame - start) * 1000, 1) if first_frame else None,
+        "frames_per_second": peers["receiver"]["frames_per_second"],
+        "glass_to_glass_mean_ms": peers["receiver"]["glass_to_glass_mean_ms"],
+        "glass_to_glass_p50_ms": peers["receiver"]["glass_to_glass_p50_ms"],
+        "glass_to_glass_p95_ms": peers["receiver"]["glass_to_glass_p95_ms"],
+        "peers": {
+            "sender": {"cpu_s": peers["sender"]["cpu_s"], "max_rss_mb": peers["sender"]["max_rss_mb"]},
+            "receiver": {"cpu_s": peers["receiver"]["cpu_s"], "max_rss_mb": peers["receiver"]["max_rss_mb"]},
+            "relay": usage(),
+        },
+    }
+    if args.trace_to:
+        report["sender_stage_ms"] = peers["sender"]["stage_ms"]
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Loopback end to end benchmark")
+    parser.add_argument("--file", default=os.path.join(ROOT, "big_buck_bunny_720p_1mb.mp4"))
+    parser.add_argument("--seconds", type=float, default=10, help="How long to measure after the first frame")
+    parser.add_argument("--output", help="Also write the results to this file")
+    parser.add_argument("--trace-to", help="Trace the sender's frames and write a Chrome trace to this file")
+    args = parser.parse_args()
+    args.file = os.path.abspath(args.file)
+    if args.trace_to:
+        args.trace_to = os.path.abspath(args.trace_to)
+    report = asyncio.run(run(args))
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,228 @@
+"""
+Check that low latency mode holds its delay target over a loopback
+connection, against the default sender.
+
+A thread stands in for a camera: it produces frames at a fixed rate
+whatever the encoder does, and queues them for the sender as MediaPlayer
+does. Each frame carries its number in a row of black and white blocks,
+which the receiver reads back after decoding to tell how long the frame
+took from capture. The packets the receiver gets are binned by time to
+show how bursty sending is.
+
+Modes:
+    default: the capture track added to the sender as it is
+    low_latency: LowLatencyTrack and Pacer on the sender
+    low_latency_receiver: the same, and tune_receiver on the receiver
+
+    python benchmarks/low_latency.py --sizes 640x480 1280x720 --max-delay 0.1
+"""
+import argparse
+import asyncio
+import fractions
+import json
+import os
+import sys
+import threading
+import time
+
+import av
+import numpy
+from aiortc import MediaStreamTrack, RTCPeerConnection
+from aiortc.mediastreams import MediaStreamError
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from low_latency import LowLatencyTrack, Pacer, tune_receiver  # noqa: E402
+from metrics import LOW_LATENCY_FRAMES_SKIPPED  # noqa: E402
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+# bits of the frame number, drawn as blocks of this many pixels
+BITS = 16
+BLOCK = 32
+# width of the bins packets are counted in, in seconds
+BIN = 0.002
+
+
+def load_pictures(path, count, width, height):
+    pictures = []
+    with av.open(path) as container:
+        for frame in container.decode(video=0):
+            pictures.append(frame.to_ndarray(width=width, height=height, format="yuv420p"))
+            if len(pictures) == count:
+                break
+    return pictures
+
+
+def stamp(picture, number):
+    picture = picture.copy()
+    for bit in range(BITS):
+        picture[:BLOCK, bit * BLOCK:(bit + 1) * BLOCK] = 235 if number >> bit & 1 else 16
+    return picture
+
+
+def read_stamp(frame):
+    plane = frame.planes[0]
+    luma = numpy.frombuffer(plane, numpy.uint8).reshape(-1, plane.line_size)
+    return sum(1 << bit for bit in range(BITS) if luma[BLOCK // 2, bit * BLOCK + BLOCK // 2] > 128)
+
+
+class CaptureTrack(MediaStreamTrack):
+    """
+    Frames produced by a thread at fps, queued until read, like a
+    MediaPlayer capturing a device. captured maps frame numbers to the
+    time they were produced.
+    """
+
+    kind = "video"
+
+    def __init__(self, pictures, fps):
+        super().__init__()
+        self.captured = {}
+        self._pictures = pictures
+        self._fps = fps
+        self._queue = asyncio.Queue()
+        self._loop = asyncio.get_running_loop()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._capture, daemon=True)
+        self._thread.start()
+
+    def _capture(self):
+        start = time.monotonic()
+        number = 0
+        while True:
+            wait = start + number / self._fps - time.monotonic()
+            if self._stopped.wait(max(wait, 0)):
+                break
+            frame = av.VideoFrame.from_ndarray(
+                stamp(self._pictures[number % len(self._pictures)], number), format="yuv420p")
+            frame.pts = number * 3000
+            frame.time_base = fractions.Fraction(1, 90000)
+            self.captured[number] = time.monotonic()
+            self._loop.call_soon_threadsafe(self._queue.put_nowait, frame)
+            number += 1
+
+    async def recv(self):
+        if self.readyState != "live":
+            raise MediaStreamError
+        return await self._queue.get()
+
+    def stop(self):
+        super().stop()
+        self._stopped.set()
+
+    async def join(self):
+        await self._loop.run_in_executor(None, self._thread.join)
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 1)
+
+
+async def run_mode(mode, pictures, args):
+    source = CaptureTrack(pictures, args.fps)
+    pc1, pc2 = RTCPeerConnection(), RTCPeerConnection()
+    if mode == "default":
+        pc1.addTrack(source)
+    else:
+        track = LowLatencyTrack(source, args.max_delay)
+        Pacer(pc1.addTrack(track), track)
+
+    latencies = []
+    arrivals = []
+    tasks = []
+    measuring = False
+
+    @pc2.on("track")
+    def on_track(remote):
+        receiver = next(t.receiver for t in pc2.getTransceivers() if t.receiver.track is remote)
+        if mode == "low_latency_receiver":
+            tune_receiver(receiver)
+        handle_rtp_packet = receiver._handle_rtp_packet
+
+        async def arrived(packet, arrival_time_ms):
+            if measuring:
+                arrivals.append((time.monotonic(), len(packet.payload)))
+            await handle_rtp_packet(packet, arrival_time_ms)
+
+        receiver._handle_rtp_packet = arrived
+
+        async def consume():
+            try:
+                while True:
+                    frame = await remote.recv()
+                    now = time.monotonic()
+                    captured = source.captured.get(read_stamp(frame))
+                    if measuring and captured is not None:
+                        latencies.append(now - captured)
+            except MediaStreamError:
+                pass
+        tasks.append(asyncio.ensure_future(consume()))
+
+    await pc1.setLocalDescription(await pc1.createOffer())
+    await pc2.setRemoteDescription(pc1.localDescription)
+    await pc2.setLocalDescription(await pc2.createAnswer())
+    await pc1.setRemoteDescription(pc2.localDescription)
+
+    await asyncio.sleep(args.warmup)
+    skipped = {reason: LOW_LATENCY_FRAMES_SKIPPED._values.get((reason,), 0) for reason in ("replaced", "late")}
+    measuring = True
+    start = time.monotonic()
+    await asyncio.sleep(args.seconds)
+    measuring = False
+    elapsed = time.monotonic() - start
+    for task in tasks:
+        task.cancel()
+    source.stop()
+    await source.join()
+    await pc1.close()
+    await pc2.close()
+
+    # the busiest bin, as a rate, shows how much of a frame goes out at once
+    bins = {}
+    for arrival, size in arrivals:
+        bins[int(arrival / BIN)] = bins.get(int(arrival / BIN), 0) + size
+    return {
+        "mode": mode,
+        "frames_per_second": round(len(latencies) / elapsed, 1),
+        "latency_ms_p50": ms(percentile(latencies, 0.5)),
+        "latency_ms_p95": ms(percentile(latencies, 0.95)),
+        "latency_ms_max": ms(max(latencies) if latencies else None),
+        "within_max_delay": round(sum(1 for latency in latencies if latency <= args.max_delay) / len(latencies), 3)
+        if latencies else None,
+        "frames_skipped": {reason: LOW_LATENCY_FRAMES_SKIPPED._values.get((reason,), 0) - count
+                           for reason, count in skipped.items()},
+        "peak_mbps": round(max(bins.values(), default=0) * 8 / BIN / 1e6, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Low latency loopback conformance test")
+    parser.add_argument("--file", default=os.path.join(ROOT, "big_buck_bunny_720p_1mb.mp4"))
+    parser.add_argument("--sizes", nargs="+", default=["640x480", "1280x720"])
+    parser.add_argument("--fps", type=float, default=30)
+    parser.add_argument("--modes", nargs="+", default=["default", "low_latency", "low_latency_receiver"])
+    parser.add_argument("--max-delay", type=float, default=0.1, help="Delay target in seconds")
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--warmup", type=float, default=2)
+    args = parser.parse_args()
+
+    results = []
+    for size in args.sizes:
+        width, height = map(int, size.split("x"))
+        pictures = load_pictures(args.file, 60, width, height)
+        for mode in args.modes:
+            result = asyncio.run(run_mode(mode, pictures, args))
+            result["size"] = size
+            results.append(result)
+    print(json.dumps({"fps": args.fps, "max_delay": args.max_delay, "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+"""
+Measure storing and looking up RTP packets for retransmission in
+packet_cache.PacketCache, against keeping RtpPacket objects in a dict by
+SSRC and sequence number, trimmed to the same window, and in a list ring
+per stream like the one the SFU used before.
+
+Packets are stored for many streams in turn, as a server sending to many
+peers does, then looked up at random within the window, as NACKs would.
+Packets are made as they are stored, so the memory tracemalloc sees
+allocated at the end, and the objects the garbage collector tracks, are
+what each cache keeps alive.
+
+    python benchmarks/packet_cache.py --streams 8 64 --packets 200000
+"""
+import argparse
+import gc
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+from aiortc.rtp import RtpPacket
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from packet_cache import PacketCache  # noqa: E402
+
+
+class DictCache:
+    """
+    RtpPacket objects by (ssrc, sequence number), the oldest dropped once a
+    stream has more than size.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._packets = {}
+
+    def put(self, packet):
+        self._packets[(packet.ssrc, packet.sequence_number)] = packet
+        self._packets.pop((packet.ssrc, (packet.sequence_number - self.size) & 0xFFFF), None)
+
+    def get(self, ssrc, sequence_number):
+        return self._packets.get((ssrc, sequence_number))
+
+
+class RingCache:
+    """
+    A list of RtpPacket objects per stream, by sequence number modulo size.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._rings = {}
+
+    def put(self, packet):
+        ring = self._rings.get(packet.ssrc)
+        if ring is None:
+            ring = self._rings[packet.ssrc] = [None] * self.size
+        ring[packet.sequence_number % self.size] = packet
+
+    def get(self, ssrc, sequence_number):
+        ring = self._rings.get(ssrc)
+        packet = ring[sequence_number % self.size] if ring else None
+        if packet is not None and packet.sequence_number == sequence_number:
+            return packet
+        return None
+
+
+class NoCache:
+    """
+    Keeps nothing, for the cost of making the packets alone.
+    """
+
+    def put(self, packet):
+        pass
+
+    def get(self, ssrc, sequence_number):
+        return None
+
+
+def store(cache, streams, ssrcs, count, payload):
+    # packets are made as they are sent, each with its own payload, from
+    # every stream in turn
+    for index in range(count):
+        cache.put(RtpPacket(payload_type=96, marker=index % 10 == 0, sequence_number=(index // streams) & 0xFFFF,
+                            timestamp=index // streams * 3000 & 0xFFFFFFFF, ssrc=ssrcs[index % streams],
+                            payload=payload[:len(payload) - index % 200]))
+
+
+def run(name, create, streams, args):
+    rng = random.Random(0)
+    ssrcs = [rng.getrandbits(32) for _ in range(streams)]
+    payload = bytes(rng.getrandbits(8) for _ in range(args.payload))
+
+    cache = create()
+    start = time.perf_counter()
+    store(cache, streams, ssrcs, args.packets, payload)
+    put_seconds = time.perf_counter() - start
+
+    # what the cache allocated and keeps alive once the window is full, in
+    # a second run as tracing slows allocation down
+    gc.collect()
+    objects = len(gc.get_objects())
+    tracemalloc.start()
+    memory_cache = create()
+    store(memory_cache, streams, ssrcs, args.packets, payload)
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    # objects the garbage collector has to walk on every full collection
+    objects = len(gc.get_objects()) - objects
+    start = time.perf_counter()
+    gc.collect()
+    collect_seconds = time.perf_counter() - start
+    del memory_cache
+
+    last = (args.packets - 1) // streams
+    window = min(args.size, last + 1)
+    keys = [(rng.choice(ssrcs), (last - rng.randrange(window)) & 0xFFFF) for _ in range(args.lookups)]
+    start = time.perf_counter()
+    hits = sum(1 for ssrc, sequence_number in keys if cache.get(ssrc, sequence_number) is not None)
+    get_seconds = time.perf_counter() - start
+    return {
+        "cache": name,
+        "streams": streams,
+        "puts_per_second": round(args.packets / put_seconds),
+        "gets_per_second": round(args.lookups / get_seconds),
+        "hit_rate": round(hits / args.lookups, 3),
+        "memory_mb": round(memory / 1e6, 1),
+        "gc_objects": objects,
+        "full_collection_ms": round(collect_seconds * 1000, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Retransmission cache benchmark")
+    parser.add_argument("--streams", type=int, nargs="+", default=[8, 64])
+    parser.add_argument("--packets", type=int, default=200000)
+    parser.add_argument("--payload", type=int, default=1100, help="Largest payload in bytes")
+    parser.add_argument("--size", type=int, default=1024, help="Packets kept per stream")
+    parser.add_argument("--lookups", type=int, default=100000)
+    args = parser.parse_args()
+
+    results = []
+    for streams in args.streams:
+        caches = (
+            ("none", NoCache),
+            ("dict", lambda: DictCache(args.size)),
+            ("ring", lambda: RingCache(args.size)),
+            # enough bytes for the window of every stream
+            ("packet_cache", lambda: PacketCache(
+                args.size, max_age=60, capacity=streams * args.size * args.payload, max_streams=streams)),
+        )
+        results += [run(name, create, streams, args) for name, create in caches]
+    print(json.dumps({"packets": args.packets, "payload": args.payload, "size": args.size, "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+"""
+Compare recording a received track with MediaRecorder, which decodes and
+re-encodes on the event loop, against recording.Recorder, which copies
+the encoded frames on a writer thread, while the live track is consumed
+as the example server would.
+
+    python benchmarks/recording.py --seconds 10 --modes none media_recorder copy
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import statistics
+import sys
+import tempfile
+import time
+
+import av
+from aiortc import RTCPeerConnection
+from aiortc.contrib.media import MediaPlayer, MediaRecorder, MediaRelay
+from aiortc.mediastreams import MediaStreamError
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from recording import Recorder  # noqa: E402
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+
+
+async def connect(pc1, pc2):
+    await pc1.setLocalDescription(await pc1.createOffer())
+    await pc2.setRemoteDescription(pc1.localDescription)
+    await pc2.setLocalDescription(await pc2.createAnswer())
+    await pc1.setRemoteDescription(pc2.localDescription)
+
+
+async def consume(track, frames):
+    try:
+        while True:
+            await track.recv()
+            frames.append(time.perf_counter())
+    except MediaStreamError:
+        pass
+
+
+async def loop_lag(lags, interval=0.01):
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append((time.perf_counter() - start - interval) * 1000)
+
+
+def cpu_seconds():
+    rusage = resource.getrusage(resource.RUSAGE_SELF)
+    return rusage.ru_utime + rusage.ru_stime
+
+
+def count_frames(paths):
+    frames = 0
+    for path in paths:
+        with av.open(path) as container:
+            frames += sum(1 for _ in container.demux(video=0) if _.size)
+    return frames
+
+
+async def run_mode(mode, args, directory):
+    pc1, pc2 = RTCPeerConnection(), RTCPeerConnection()
+    player = MediaPlayer(args.file, loop=True)
+    pc1.addTrack(player.video)
+    relay = MediaRelay()
+    live_frames = []
+    tasks = []
+    recorder = None
+
+    @pc2.on("track")
+    def on_track(track):
+        nonlocal recorder
+        tasks.append(asyncio.ensure_future(consume(relay.subscribe(track), live_frames)))
+        if mode == "media_recorder":
+            recorder = MediaRecorder(os.path.join(directory, "media_recorder.mp4"))
+            recorder.addTrack(relay.subscribe(track))
+        elif mode == "copy":
+            receiver = next(t.receiver for t in pc2.getTransceivers() if t.receiver.track is track)
+            recorder = Recorder(os.path.join(directory, "copy-{segment:03}.mkv"), args.segment_seconds)
+            recorder.tap(receiver)
+
+    await connect(pc1, pc2)
+    if mode == "media_recorder":
+        await recorder.start()
+    lags = []
+    lag_task = asyncio.ensure_future(loop_lag(lags))
+    cpu = cpu_seconds()
+    await asyncio.sleep(args.seconds)
+    cpu = cpu_seconds() - cpu
+    lag_task.cancel()
+
+    recorded = None
+    if mode == "media_recorder":
+        await recorder.stop()
+        recorded = count_frames([os.path.join(directory, "media_recorder.mp4")])
+    elif mode == "copy":
+        await asyncio.to_thread(recorder.stop)
+        recorded = count_frames(recorder.segments)
+    for task in tasks:
+        task.cancel()
+    await pc1.close()
+    await pc2.close()
+    player.video.stop()
+
+    intervals = [(b - a) * 1000 for a, b in zip(live_frames, live_frames[1:])]
+    lags.sort()
+    return {
+        "mode": mode,
+        "live_frames_per_second": round(len(live_frames) / args.seconds, 1),
+        "live_frame_interval_p95_ms": round(sorted(intervals)[int(len(intervals) * 0.95)], 1) if intervals else None,
+        "loop_lag_mean_ms": round(statistics.mean(lags), 2),
+        "loop_lag_p99_ms": round(lags[int(len(lags) * 0.99)], 2),
+        "cpu_percent": round(cpu / args.seconds * 100),
+        "recorded_frames": recorded,
+        "segments": len(recorder.segments) if mode == "copy" else None,
+        "dropped_frames": recorder.dropped if mode == "copy" else None,
+    }
+
+
+async def run(args):
+    with tempfile.TemporaryDirectory() as directory:
+        return [await run_mode(mode, args, directory) for mode in args.modes]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recording benchmark")
+    parser.add_argument("--file", default=os.path.join(ROOT, "big_buck_bunny_720p_1mb.mp4"))
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--segment-seconds", type=float, default=4)
+    parser.add_argument("--modes", nargs="+", default=["none", "media_recorder", "copy"])
+    args = parser.parse_args()
+    print(json.dumps({"seconds": args.seconds, "results": asyncio.run(run(args))}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,234 @@
+"""
+Compare the server CPU of relaying one publisher's video to many
+subscribers by decoding and re-encoding it for each, as the example
+server does, against forwarding its RTP packets with sfu.ForwardingHub.
+
+The publisher and the subscribers run in a child process, so the CPU
+measured is the server's alone. Subscribers count the frames they
+reassemble without decoding them. --loss drops that fraction of the
+packets sent to each subscriber, which they recover with NACKs answered
+from the publisher's packet cache.
+
+    python benchmarks/sfu.py --subscribers 1 4 8 --seconds 10
+"""
+import argparse
+import asyncio
+import fractions
+import json
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import time
+
+import av
+from aiortc import MediaStreamTrack, RTCPeerConnection, RTCSessionDescription
+from aiortc.contrib.media import MediaRelay
+from aiortc.rtp import is_rtcp
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from metrics import SFU_KEYFRAME_REQUESTS, SFU_RETRANSMISSIONS  # noqa: E402
+from sfu import ForwardingHub  # noqa: E402
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+
+
+class ReplayTrack(MediaStreamTrack):
+    """
+    Frames decoded once and replayed at 30 fps with increasing timestamps,
+    so the publisher never sees the file loop.
+    """
+
+    kind = "video"
+
+    def __init__(self, path, scale, count=150):
+        super().__init__()
+        self._frames = []
+        with av.open(path) as container:
+            for frame in container.decode(video=0):
+                self._frames.append(frame.reformat(
+                    width=int(frame.width * scale) & ~1, height=int(frame.height * scale) & ~1, format="yuv420p"))
+                if len(self._frames) == count:
+                    break
+        self._index = 0
+        self._start = None
+
+    async def recv(self):
+        if self._start is None:
+            self._start = time.monotonic()
+        wait = self._start + self._index / 30 - time.monotonic()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        frame = self._frames[self._index % len(self._frames)]
+        frame.pts = self._index * 3000
+        frame.time_base = fractions.Fraction(1, 90000)
+        self._index += 1
+        return frame
+
+
+def cpu_seconds():
+    rusage = resource.getrusage(resource.RUSAGE_SELF)
+    return rusage.ru_utime + rusage.ru_stime
+
+
+def counts(counter, results):
+    return {result: counter._values.get((result,), 0) for result in results}
+
+
+def description(pc):
+    return pc.localDescription.sdp, pc.localDescription.type
+
+
+async def answer(pc, sdp):
+    await pc.setRemoteDescription(RTCSessionDescription(*sdp))
+    await pc.setLocalDescription(await pc.createAnswer())
+    return description(pc)
+
+
+def count_frames(receiver, frames):
+    # the subscriber reassembles frames but does not spend CPU decoding them
+    decoder_queue = receiver._RTCRtpReceiver__decoder_queue
+    put = decoder_queue.put
+
+    def counted(task, *args, **kwargs):
+        if task is None:
+            put(task, *args, **kwargs)
+        else:
+            frames.append(time.monotonic())
+
+    decoder_queue.put = counted
+
+
+def peers(conn, file, scale):
+    """
+    The publisher and subscribers, driven by messages from the server.
+    """
+    async def main():
+        loop = asyncio.get_running_loop()
+        publisher = RTCPeerConnection()
+        publisher.addTrack(ReplayTrack(file, scale))
+        await publisher.setLocalDescription(await publisher.createOffer())
+        conn.send(description(publisher))
+        await publisher.setRemoteDescription(RTCSessionDescription(*await loop.run_in_executor(None, conn.recv)))
+
+        subscribers = []
+        frames = []
+        while True:
+            message = await loop.run_in_executor(None, conn.recv)
+            if message == "stop":
+                break
+            pc = RTCPeerConnection()
+            subscribers.append(pc)
+            counted = []
+            frames.append(counted)
+
+            @pc.on("track")
+            def on_track(track, pc=pc, counted=counted):
+                count_frames(next(t.receiver for t in pc.getTransceivers() if t.receiver.track is track), counted)
+
+            conn.send(await answer(pc, message))
+        conn.send(frames)
+        for pc in subscribers + [publisher]:
+            await pc.close()
+    asyncio.run(main())
+
+
+def lossy(pc, loss, rng):
+    # drop RTP, not RTCP, on the way to the subscriber
+    transport = pc.getTransceivers()[0].sender.transport
+    send_rtp = transport._send_rtp
+
+    async def send(data):
+        if not is_rtcp(data) and rng.random() < loss:
+            return
+        await send_rtp(data)
+
+    transport._send_rtp = send
+
+
+async def run_mode(mode, subscribers, args):
+    loop = asyncio.get_running_loop()
+    conn, child_conn = multiprocessing.Pipe()
+    child = multiprocessing.Process(target=peers, args=(child_conn, args.file, args.scale))
+    child.start()
+
+    hub = ForwardingHub()
+    relay = MediaRelay()
+    published = asyncio.Event()
+    tracks = []
+    publisher = RTCPeerConnection()
+
+    @publisher.on("track")
+    def on_track(track):
+        tracks.append(track)
+        if mode == "forward":
+            hub.publish("bench", next(t.receiver for t in publisher.getTransceivers() if t.receiver.track is track), "video")
+        published.set()
+
+    conn.send(await answer(publisher, await loop.run_in_executor(None, conn.recv)))
+    await published.wait()
+
+    # keyframe requests are counted from the first subscriber on, as most come when joining
+    requests = counts(SFU_KEYFRAME_REQUESTS, ("sent", "aggregated"))
+    pcs = []
+    rng = random.Random(0)
+    for _ in range(subscribers):
+        pc = RTCPeerConnection()
+        pcs.append(pc)
+        if mode == "forward":
+            hub.subscribe(pc, "bench", "video")
+        else:
+            pc.addTrack(relay.subscribe(tracks[0]))
+        await pc.setLocalDescription(await pc.createOffer())
+        conn.send(description(pc))
+        await pc.setRemoteDescription(RTCSessionDescription(*await loop.run_in_executor(None, conn.recv)))
+        if args.loss:
+            lossy(pc, args.loss, rng)
+
+    await asyncio.sleep(args.warmup)
+    retransmissions = counts(SFU_RETRANSMISSIONS, ("hit", "miss"))
+    start, cpu = time.monotonic(), cpu_seconds()
+    await asyncio.sleep(args.seconds)
+    end, cpu = time.monotonic(), cpu_seconds() - cpu
+    conn.send("stop")
+    frames = await loop.run_in_executor(None, conn.recv)
+    await loop.run_in_executor(None, child.join)
+    for pc in pcs + [publisher]:
+        await pc.close()
+
+    # frames each subscriber completed in the measured window, the
+    # monotonic clock being the same in both processes
+    rates = [sum(1 for t in counted if start <= t < end) / (end - start) for counted in frames]
+    result = {
+        "mode": mode,
+        "subscribers": subscribers,
+        "server_cpu_percent": round(cpu / (end - start) * 100, 1),
+        "subscriber_frames_per_second_min": round(min(rates), 1),
+    }
+    if mode == "forward":
+        result["keyframe_requests"] = {
+            name: count - requests[name] for name, count in counts(SFU_KEYFRAME_REQUESTS, requests).items()}
+        result["retransmissions"] = {
+            name: count - retransmissions[name] for name, count in counts(SFU_RETRANSMISSIONS, retransmissions).items()}
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SFU forwarding benchmark")
+    parser.add_argument("--file", default=os.path.join(ROOT, "big_buck_bunny_720p_1mb.mp4"))
+    parser.add_argument("--scale", type=float, default=0.5, help="Scale of the published video")
+    parser.add_argument("--subscribers", type=int, nargs="+", default=[1, 4, 8])
+    parser.add_argument("--modes", nargs="+", default=["transcode", "forward"])
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--warmup", type=float, default=3)
+    parser.add_argument("--loss", type=float, default=0.0, help="Fraction of packets dropped to each subscriber")
+    args = parser.parse_args()
+    results = [asyncio.run(run_mode(mode, subscribers, args))
+               for subscribers in args.subscribers for mode in args.modes]
+    print(json.dumps({"scale": args.scale, "loss": args.loss, "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+"""
+Compare the shared signaling codec against the split-based candidate parsing
+it replaced.
+
+    python benchmarks/signaling_codec.py --number 100000
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+
+from aiortc import RTCIceCandidate
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from signaling_codec import decode_message, encode_candidates  # noqa: E402
+
+MESSAGE = ("candidate~candidate:842163049 1 udp 1677729535 203.0.113.7 61234 typ srflx "
+           "raddr 192.168.1.20 rport 61234 generation 0 ufrag sTg3 network-cost 999~0~0")
+
+
+def split_based(message):
+    sdp_type, candidate, sdp_mid, sdp_mline_index = message.split("~")
+    foundation, component, protocol, priority, ip, port, _, _type = candidate.split()[:8]
+    return RTCIceCandidate(foundation=foundation, component=component, protocol=protocol,
+                           priority=priority, ip=ip, port=port, type=_type, sdpMid=sdp_mid, sdpMLineIndex=sdp_mline_index)
+
+
+def codec_parse(message):
+    return decode_message(message).candidates
+
+
+def codec_to_rtc(message):
+    return [c.to_rtc() for c in decode_message(message).candidates]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Signaling codec micro-benchmark")
+    parser.add_argument("--number", type=int, default=100000)
+    parser.add_argument("--batch", type=int, default=10)
+    args = parser.parse_args()
+
+    candidate = decode_message(MESSAGE).candidates[0]
+    batched = encode_candidates([candidate] * args.batch, version=2)
+    cases = {
+        "split_based": lambda: split_based(MESSAGE),
+        "codec_parse": lambda: codec_parse(MESSAGE),
+        "codec_to_rtc": lambda: codec_to_rtc(MESSAGE),
+        f"codec_batch_{args.batch}_per_candidate": lambda: codec_parse(batched),
+    }
+    results = {}
+    for name, case in cases.items():
+        seconds = min(timeit.repeat(case, number=args.number, repeat=3))
+        if name.startswith("codec_batch"):
+            seconds /= args.batch
+        results[name] = {"us_per_candidate": round(seconds * 1e6 / args.number, 3)}
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""
+Load generator for the websocket.py signaling relay.
+
+Opens one Unity and one web client per room, has every Unity client send
+messages to its web peer at a fixed rate and reports delivered messages/s and
+latency. A relay is started in-process unless --uri is given.
+
+    python benchmarks/signaling_load.py --rooms 200 --rate 20 --duration 10
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+
+import websockets
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import websocket as relay  # noqa: E402
+
+PAYLOAD = "candidate~candidate:842163049 1 udp 1677729535 203.0.113.7 61234 typ srflx raddr 192.168.1.20 rport 61234~0~0"
+
+
+async def receiver(uri, room, latencies, received, ready, stop, slow):
+    async with websockets.connect(f"{uri}?type=w&uid={room}&token=load") as ws:
+        ready.release()
+        while not stop.is_set():
+            try:
+                message = await asyncio.wait_for(ws.recv(), 0.5)
+            except asyncio.TimeoutError:
+                continue
+            sent_at, _, _ = message.partition("|")
+            latencies.append(time.perf_counter() - float(sent_at))
+            received[0] += 1
+            if slow:
+                await asyncio.sleep(slow)
+
+
+async def sender(uri, room, rate, duration, sent):
+    async with websockets.connect(f"{uri}?type=u&uid={room}&token=load") as ws:
+        interval = 1 / rate
+        end = time.perf_counter() + duration
+        next_send = time.perf_counter()
+        while next_send < end:
+            await ws.send(f"{time.perf_counter()}|{PAYLOAD}")
+            sent[0] += 1
+            next_send += interval
+            await asyncio.sleep(max(0, next_send - time.perf_counter()))
+
+
+async def run(args):
+    server = None
+    uri = args.uri
+    if uri is None:
+        server = await websockets.serve(relay.handle_connection, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        uri = f"ws://127.0.0.1:{port}/ws"
+
+    latencies, received, sent = [], [0], [0]
+    ready = asyncio.Semaphore(0)
+    stop = asyncio.Event()
+    receivers = [
+        asyncio.create_task(receiver(uri, room, latencies, received, ready, stop,
+                                     args.slow_delay if room < args.slow_clients else 0))
+        for room in range(args.rooms)
+    ]
+    for _ in range(args.rooms):
+        await ready.acquire()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[sender(uri, room, args.rate, args.duration, sent) for room in range(args.rooms)])
+    elapsed = time.perf_counter() - start
+    # let in-flight messages arrive
+    await asyncio.sleep(1)
+    stop.set()
+    await asyncio.gather(*receivers)
+    if server:
+        server.close()
+        await server.wait_closed()
+
+    latencies.sort()
+    fast = latencies or [0]
+    return {
+        "rooms": args.rooms,
+        "connections": args.rooms * 2,
+        "slow_clients": args.slow_clients,
+        "sent": sent[0],
+        "received": received[0],
+        "sent_per_s": round(sent[0] / elapsed, 1),
+        "received_per_s": round(received[0] / elapsed, 1),
+        "latency_ms_p50": round(statistics.median(fast) * 1000, 2),
+        "latency_ms_p99": round(fast[int(len(fast) * 0.99) - 1] * 1000, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Signaling relay load generator")
+    parser.add_argument("--uri", help="Relay to test, e.g. ws://127.0.0.1:5011/ws (default: in-process)")
+    parser.add_argument("--rooms", type=int, default=200)
+    parser.add_argument("--rate", type=float, default=20, help="Messages/s per sender")
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--slow-clients", type=int, default=0, help="Receivers that read slowly")
+    parser.add_argument("--slow-delay", type=float, default=0.5, help="Seconds a slow receiver waits per message")
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(run(args)), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+"""
+Compare the CPU cost of scaling and encoding video per peer, as adaptive
+mode does, against simulcast, which scales each frame once per layer and
+shares each layer's encoder, with viewers spread over the layers. Then
+switch a SimulcastTrack between layers over a loopback connection and
+measure how long the receiver takes to see the new resolution.
+
+    python benchmarks/simulcast.py --viewers 3 6 12
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+import av
+from aiortc import RTCPeerConnection
+from aiortc.contrib.media import MediaPlayer
+from aiortc.mediastreams import MediaStreamError
+from aiortc.rtcrtpsender import RTCRtpSender
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from bitrate_controller import AdaptiveVideoTrack, Settings  # noqa: E402
+from broadcast import EncodedBroadcast, route_keyframe_requests  # noqa: E402
+from simulcast import LAYERS, UPGRADE_AFTER, SimulcastSource  # noqa: E402
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+
+
+def load_frames(path, count, width, height):
+    frames = []
+    with av.open(path) as container:
+        for frame in container.decode(video=0):
+            frames.append(frame.reformat(width=width, height=height, format="yuv420p"))
+            if len(frames) == count:
+                break
+    return frames
+
+
+def per_peer(frames, codec, layers):
+    # every peer scales the captured frame and encodes it itself
+    encoders = [(LAYERS[layer][0], EncodedBroadcast(None, codec=codec, bitrate=LAYERS[layer][1])) for layer in layers]
+    start = time.process_time()
+    for frame in frames:
+        for scale, encoder in encoders:
+            if scale < 1.0:
+                width = int(frame.width * scale) & ~1
+                height = int(frame.height * scale) & ~1
+                encoder._encode(frame.reformat(width=width, height=height), False)
+            else:
+                encoder._encode(frame, False)
+    return time.process_time() - start
+
+
+def shared(frames, codec, layers):
+    source = SimulcastSource(None, codec=codec)
+    indexes = sorted(set(layers))
+    encoders = {index: EncodedBroadcast(None, codec=codec, bitrate=LAYERS[index][1]) for index in indexes}
+    start = time.process_time()
+    for frame in frames:
+        for index, layer_frame in source._scale(frame, indexes).items():
+            encoders[index]._encode(layer_frame, False)
+    return time.process_time() - start
+
+
+async def wait_for_width(widths, changed_from, timeout=10):
+    start = time.perf_counter()
+    while time.perf_counter() - start < timeout:
+        if widths and widths[-1] != changed_from:
+            return round((time.perf_counter() - start) * 1000, 1)
+        await asyncio.sleep(0.005)
+    return None
+
+
+async def switching(args):
+    player = MediaPlayer(args.file, loop=True)
+    # the 720p file scaled to about the size of a capture, so that a single
+    # core keeps up with decoding it again on the receiving side
+    source = SimulcastSource(AdaptiveVideoTrack(player.video, scale=0.5), codec=args.codec)
+    track = source.subscribe(LAYERS[0][1])
+    pc1, pc2 = RTCPeerConnection(), RTCPeerConnection()
+    sender = pc1.addTrack(track)
+    transceiver = next(t for t in pc1.getTransceivers() if t.sender == sender)
+    transceiver.setCodecPreferences(
+        [codec for codec in RTCRtpSender.getCapabilities("video").codecs if codec.mimeType == args.codec])
+    route_keyframe_requests(sender, track)
+    widths = []
+    tasks = []
+
+    @pc2.on("track")
+    def on_track(remote):
+        async def consume():
+            try:
+                while True:
+                    widths.append((await remote.recv()).width)
+            except MediaStreamError:
+                pass
+        tasks.append(asyncio.ensure_future(consume()))
+
+    await pc1.setLocalDescription(await pc1.createOffer())
+    await pc2.setRemoteDescription(pc1.localDescription)
+    await pc2.setLocalDescription(await pc2.createAnswer())
+    await pc1.setRemoteDescription(pc2.localDescription)
+
+    await asyncio.sleep(args.warmup)
+    top = widths[-1] if widths else None
+    track.apply(Settings(bitrate=LAYERS[-1][1]))
+    down_ms = await wait_for_width(widths, top)
+    bottom = widths[-1] if widths else None
+    await asyncio.sleep(1)
+    for _ in range(UPGRADE_AFTER):
+        track.apply(Settings(bitrate=LAYERS[0][1]))
+    up_ms = await wait_for_width(widths, bottom)
+    result = {
+        "widths": [top, bottom, widths[-1] if widths else None],
+        "switch_down_ms": down_ms,
+        "switch_up_ms": up_ms,
+        "frames_received": len(widths),
+    }
+    for task in tasks:
+        task.cancel()
+    track.stop()
+    await pc1.close()
+    await pc2.close()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulcast benchmark")
+    parser.add_argument("--file", default=os.path.join(ROOT, "big_buck_bunny_720p_1mb.mp4"))
+    parser.add_argument("--frames", type=int, default=120)
+    parser.add_argument("--size", default="640x480")
+    parser.add_argument("--codec", default="video/H264", choices=["video/H264", "video/VP8"])
+    parser.add_argument("--viewers", type=int, nargs="+", default=[3, 6, 12])
+    parser.add_argument("--warmup", type=float, default=3)
+    args = parser.parse_args()
+
+    width, height = map(int, args.size.split("x"))
+    frames = load_frames(args.file, args.frames, width, height)
+    results = []
+    for viewers in args.viewers:
+        # viewers spread evenly over the layers
+        layers = [viewer % len(LAYERS) for viewer in range(viewers)]
+        for mode, run in (("per_peer", per_peer), ("simulcast", shared)):
+            cpu = run(frames, args.codec, layers)
+            results.append({
+                "mode": mode,
+                "viewers": viewers,
+                "cpu_ms_per_frame": round(cpu * 1000 / len(frames), 3),
+            })
+    print(json.dumps({
+        "codec": args.codec,
+        "size": args.size,
+        "layers": LAYERS,
+        "encoding": results,
+        "switching": asyncio.run(switching(args)),
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
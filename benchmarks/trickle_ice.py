@@ -0,0 +1,130 @@
+"""
+Measure time-to-offer and time-to-connected of AiortcConnection with and
+without trickle ICE, with TURN_SERVER pointing at a local stand-in that
+never answers, like a TURN server that is unreachable or overloaded.
+
+The remote peer stands in for the Unity client: it takes --remote-delay
+seconds to answer, for its own setup and gathering, and adds candidates
+as they arrive. It runs on its own thread and loop.
+
+    python benchmarks/trickle_ice.py --calls 3 --remote-delay 1
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import Future
+
+import websockets
+from aiortc import RTCPeerConnection, RTCSessionDescription
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import websocket as relay  # noqa: E402
+from aiortc_connection import AiortcConnection  # noqa: E402
+from signaling_codec import decode_message, encode_description  # noqa: E402
+
+
+class SilentTurnServer(asyncio.DatagramProtocol):
+    """
+    Accepts TURN allocations and never answers them.
+    """
+
+    def __init__(self):
+        self.requests = 0
+
+    def datagram_received(self, data, addr):
+        self.requests += 1
+
+
+async def remote_peer(uri, uid, delay, connected):
+    pc = RTCPeerConnection()
+    done = asyncio.Event()
+
+    @pc.on("connectionstatechange")
+    def on_connectionstatechange():
+        if pc.connectionState == "connected":
+            connected.set_result(time.perf_counter())
+            done.set()
+
+    async def answer(ws):
+        async for message in ws:
+            message = decode_message(message)
+            if message.type == "offer":
+                await pc.setRemoteDescription(RTCSessionDescription(sdp=message.sdp, type=message.type))
+                await asyncio.sleep(delay)
+                await pc.setLocalDescription(await pc.createAnswer())
+                await ws.send(encode_description(pc.localDescription.type, pc.localDescription.sdp))
+            elif message.type == "candidate":
+                for candidate in message.candidates:
+                    await pc.addIceCandidate(candidate.to_rtc())
+
+    async with websockets.connect(f"{uri}?type=u&uid={uid}&token=bench") as ws:
+        signaling = asyncio.ensure_future(answer(ws))
+        await done.wait()
+        signaling.cancel()
+    await pc.close()
+
+
+async def one_call(uri, uid, trickle, delay):
+    remote_connected = Future()
+    remote = threading.Thread(target=asyncio.run, args=(remote_peer(uri, uid, delay, remote_connected),))
+    remote.start()
+    await asyncio.sleep(0.2)
+
+    start = time.perf_counter()
+    connection = AiortcConnection(uid=uid, websocket_uri=uri + "?type=w&uid={uid}&token=bench", trickle=trickle)
+    await connection.connect_to_websocket()
+    connection.start_signaling()
+    connection.create_peer_connection()
+    connection.create_data_channel()
+    await connection.send_offer()
+    offer_sent = time.perf_counter()
+    await asyncio.wait_for(asyncio.wrap_future(remote_connected), 60)
+    result = {"time_to_offer_ms": (offer_sent - start) * 1000,
+              "time_to_connected_ms": (remote_connected.result() - start) * 1000}
+    await asyncio.to_thread(remote.join)
+    connection.stop_signaling()
+    await connection.disconnect_from_websocket()
+    await connection.clear()
+    return result
+
+
+async def run(args):
+    loop = asyncio.get_running_loop()
+    transport, turn = await loop.create_datagram_endpoint(SilentTurnServer, local_addr=("127.0.0.1", 0))
+    os.environ["TURN_SERVER"] = f"turn:127.0.0.1:{transport.get_extra_info('sockname')[1]}"
+    os.environ["TURN_SERVER_USERNAME"] = "bench"
+    os.environ["TURN_SERVER_CREDENTIAL"] = "bench"
+    server = await websockets.serve(relay.handle_connection, "127.0.0.1", 0)
+    uri = f"ws://127.0.0.1:{server.sockets[0].getsockname()[1]}/ws"
+
+    report = {"remote_delay_s": args.remote_delay}
+    for mode in ("gather_first", "trickle"):
+        results = [await one_call(uri, f"{mode}{i}", mode == "trickle", args.remote_delay) for i in range(args.calls)]
+        report[mode] = {key: round(statistics.median(r[key] for r in results), 1) for key in results[0]}
+    report["turn_requests"] = turn.requests
+
+    server.close()
+    await server.wait_closed()
+    transport.close()
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Trickle ICE call setup benchmark")
+    parser.add_argument("--calls", type=int, default=3)
+    parser.add_argument("--remote-delay", type=float, default=1,
+                        help="Seconds the remote peer takes to answer, for its own gathering")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    print(json.dumps(asyncio.run(run(args)), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""
+Measure time-to-offer and time-to-first-frame of a call with and without the
+WarmPool, against a Python stand-in for the Unity client over an in-process
+websocket.py relay.
+
+    python benchmarks/warm_pool.py --calls 5
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import Future
+
+import websockets
+from aiortc import RTCPeerConnection, RTCSessionDescription
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import websocket as relay  # noqa: E402
+from aiortc_connection import AiortcConnection  # noqa: E402
+from signaling_codec import decode_message, encode_description  # noqa: E402
+from warm_pool import WarmPool  # noqa: E402
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+
+
+async def remote_peer(uri, uid, first_frame):
+    """
+    Answer the offer like the Unity client and report when the first video
+    frame is decoded. Runs on its own thread and loop so its work does not
+    delay the call being measured.
+    """
+    pc = RTCPeerConnection()
+
+    @pc.on("track")
+    def on_track(track):
+        async def read():
+            await track.recv()
+            if not first_frame.done():
+                first_frame.set_result(time.perf_counter())
+        if track.kind == "video":
+            asyncio.ensure_future(read())
+
+    async with websockets.connect(f"{uri}?type=u&uid={uid}&token=bench") as ws:
+        message = decode_message(await ws.recv())
+        await pc.setRemoteDescription(RTCSessionDescription(sdp=message.sdp, type=message.type))
+        await pc.setLocalDescription(await pc.createAnswer())
+        await ws.send(encode_description(pc.localDescription.type, pc.localDescription.sdp))
+        await asyncio.wrap_future(first_frame)
+    await pc.close()
+
+
+async def one_call(uri, uid, media_options, pool):
+    first_frame = Future()
+    remote = threading.Thread(target=asyncio.run, args=(remote_peer(uri, uid, first_frame),))
+    remote.start()
+    await asyncio.sleep(0.2)
+
+    start = time.perf_counter()
+    if pool is not None:
+        connection = await pool.acquire(uid)
+    else:
+        connection = AiortcConnection(uid=uid, websocket_uri=uri + "?type=w&uid={uid}&token=bench")
+    await connection.connect_to_websocket()
+    connection.start_signaling()
+    if not connection.is_active:
+        connection.create_peer_connection()
+        connection.create_data_channel()
+        await connection.get_media(**media_options)
+    await connection.send_offer()
+    offer_sent = time.perf_counter()
+    await asyncio.wait_for(asyncio.wrap_future(first_frame), 30)
+    result = {"time_to_offer_ms": (offer_sent - start) * 1000,
+              "time_to_first_frame_ms": (first_frame.result() - start) * 1000}
+
+    await asyncio.to_thread(remote.join)
+    connection.stop_signaling()
+    await connection.disconnect_from_websocket()
+    await connection.clear()
+    return result
+
+
+async def run(args):
+    server = await websockets.serve(relay.handle_connection, "127.0.0.1", 0)
+    uri = f"ws://127.0.0.1:{server.sockets[0].getsockname()[1]}/ws"
+    media_options = {"play_from": args.file}
+
+    report = {}
+    for mode in ("cold", "warm"):
+        pool = None
+        if mode == "warm":
+            pool = WarmPool(size=1, media_options=media_options, connection_factory=lambda peer_id: AiortcConnection(
+                websocket_uri=uri + "?type=w&uid={uid}&token=bench"))
+            await pool.start()
+        results = []
+        for i in range(args.calls):
+            results.append(await one_call(uri, f"{mode}{i}", media_options, pool))
+            if pool is not None:
+                # give the pool time to refill, as between real calls
+                while len(pool) < 1:
+                    await asyncio.sleep(0.05)
+        if pool is not None:
+            await pool.close()
+        report[mode] = {key: round(statistics.median(r[key] for r in results), 1) for key in results[0]}
+
+    server.close()
+    await server.wait_closed()
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Warm pool call latency benchmark")
+    parser.add_argument("--file", default=os.path.join(ROOT, "big_buck_bunny_720p_1mb.mp4"))
+    parser.add_argument("--calls", type=int, default=5)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    print(json.dumps(asyncio.run(run(args)), indent=2))
+
+
+if __name__ == "__main__":
+    main()
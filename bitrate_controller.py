@@ -0,0 +1,292 @@
+"""
+Adapts the bitrate, frame rate and resolution of a video sender to the link,
+using the RTCP feedback aiortc exposes through getStats.
+
+The controller polls the sender for round trip time and loss from receiver
+reports, and for the receiver's REMB estimate, which aiortc applies to the
+encoder directly. A policy turns these into new Settings, which are applied
+to the encoder and to an AdaptiveVideoTrack dropping and scaling frames
+before they reach it.
+"""
+import asyncio
+import logging
+import time
+from aiortc import MediaStreamTrack
+
+POLL_INTERVAL = 1.0
+MIN_BITRATE = 150000
+MAX_BITRATE = 2000000
+START_BITRATE = 500000
+# round trip time above which the link is treated as congested, in seconds
+HIGH_RTT = 0.3
+# (minimum bitrate, resolution scale, frame rate), best first
+LADDER = [
+    (900000, 1.0, 30),
+    (500000, 0.75, 30),
+    (300000, 0.5, 25),
+    (0, 0.5, 15),
+]
+
+
+class LinkStats:
+    """
+    One sample of the link as seen by the sender.
+
+    rtt: round trip time in seconds, None before the first receiver report
+    fraction_lost: fraction of packets lost since the previous receiver
+        report, from 0 to 1
+    estimate: bitrate estimate sent by the receiver, None if none was sent
+    send_rate: bitrate actually sent since the previous sample
+    """
+
+    __slots__ = ("rtt", "fraction_lost", "estimate", "send_rate")
+
+    def __init__(self, rtt=None, fraction_lost=0.0, estimate=None, send_rate=None):
+        self.rtt = rtt
+        self.fraction_lost = fraction_lost
+        self.estimate = estimate
+        self.send_rate = send_rate
+
+    def __repr__(self):
+        return (f"LinkStats(rtt={self.rtt}, fraction_lost={self.fraction_lost}, "
+                f"estimate={self.estimate}, send_rate={self.send_rate})")
+
+
+class Settings:
+    """
+    What the sender should produce.
+
+    bitrate: encoder target bitrate in bits per second
+    framerate: maximum frames per second passed to the encoder
+    scale: factor applied to the source resolution
+    """
+
+    __slots__ = ("bitrate", "framerate", "scale")
+
+    def __init__(self, bitrate=START_BITRATE, framerate=30, scale=1.0):
+        self.bitrate = bitrate
+        self.framerate = framerate
+        self.scale = scale
+
+    def __repr__(self):
+        return f"Settings(bitrate={self.bitrate}, framerate={self.framerate}, scale={self.scale})"
+
+    def __eq__(self, other):
+        return isinstance(other, Settings) and all(
+            getattr(self, name) == getattr(other, name) for name in self.__slots__)
+
+
+class Policy:
+    """
+    Decides the next Settings from the latest LinkStats. Policies may keep
+    state between calls, so each controller needs its own instance.
+    """
+
+    def initial(self):
+        return Settings()
+
+    def update(self, stats, settings):
+        raise NotImplementedError
+
+
+class StaticPolicy(Policy):
+    """
+    Never changes the settings, as before adaptation was added.
+    """
+
+    def __init__(self, settings=None):
+        self._settings = settings or Settings(bitrate=START_BITRATE)
+
+    def initial(self):
+        return self._settings
+
+    def update(self, stats, settings):
+        return settings
+
+
+class LossBasedPolicy(Policy):
+    """
+    Backs off in proportion to loss and on high round trip time, probes
+    upwards slowly while the link is clean, and never exceeds the receiver's
+    estimate. Resolution and frame rate follow the bitrate through a ladder,
+    stepping down at once but only stepping up after the bitrate has allowed
+    it for upgrade_after samples, so they do not flap.
+
+    min_bitrate, max_bitrate: bounds of the target bitrate
+    ladder: (minimum bitrate, scale, frame rate) rungs, best first
+    upgrade_after: samples a better rung has to be allowed before it is used
+    """
+
+    def __init__(self, min_bitrate=MIN_BITRATE, max_bitrate=MAX_BITRATE, ladder=LADDER, upgrade_after=3):
+        self._min_bitrate = min_bitrate
+        self._max_bitrate = max_bitrate
+        self._ladder = ladder
+        self._upgrade_after = upgrade_after
+        self._upgrade_count = 0
+        self._last_rtt = None
+
+    def initial(self):
+        return self._rung(START_BITRATE, Settings(), force=True)
+
+    def _rung(self, bitrate, settings, force=False):
+        index = next(i for i, (minimum, _, _) in enumerate(self._ladder) if bitrate >= minimum)
+        _, scale, framerate = self._ladder[index]
+        current = next((i for i, (_, s, f) in enumerate(self._ladder)
+                        if s == settings.scale and f == settings.framerate), None)
+        if not force and current is not None and index < current:
+            self._upgrade_count += 1
+            if self._upgrade_count < self._upgrade_after:
+                _, scale, framerate = self._ladder[current]
+            else:
+                self._upgrade_count = 0
+        else:
+            self._upgrade_count = 0
+        return Settings(bitrate=bitrate, framerate=framerate, scale=scale)
+
+    def update(self, stats, settings):
+        bitrate = settings.bitrate
+        # a queue that is not draining keeps the round trip time up
+        draining = stats.rtt is not None and self._last_rtt is not None and stats.rtt < self._last_rtt
+        if stats.fraction_lost > 0.1:
+            bitrate *= 1 - 0.5 * stats.fraction_lost
+        elif stats.rtt is not None and stats.rtt > HIGH_RTT and not draining:
+            bitrate *= 0.85
+        elif stats.fraction_lost < 0.02:
+            bitrate *= 1.08
+        self._last_rtt = stats.rtt
+        if stats.estimate:
+            bitrate = min(bitrate, stats.estimate)
+        bitrate = int(max(self._min_bitrate, min(bitrate, self._max_bitrate)))
+        return self._rung(bitrate, settings)
+
+
+class AdaptiveVideoTrack(MediaStreamTrack):
+    """
+    Passes frames of a decoded video track on at most the given frame rate
+    and scaled by the given factor, so the encoder after it has less to do.
+
+    track: decoded video track to read from
+    """
+
+    kind = "video"
+
+    def __init__(self, track, framerate=30, scale=1.0):
+        super().__init__()
+        self._track = track
+        self.framerate = framerate
+        self.scale = scale
+        self._next_time = None
+
+    async def recv(self):
+        while True:
+            frame = await self._track.recv()
+            # frames keep their timestamps, so dropped ones just leave a gap
+            timestamp = frame.time if frame.time is not None else frame.pts
+            if self._next_time is not None and timestamp < self._next_time - 0.001:
+                continue
+            # keep the average rate even when the source rate is not a multiple
+            if self._next_time is None or timestamp - self._next_time > 1 / self.framerate:
+                self._next_time = timestamp
+            self._next_time += 1 / self.framerate
+            if self.scale < 1.0:
+                # even sizes, as yuv420p needs
+                width = int(frame.width * self.scale) & ~1
+                height = int(frame.height * self.scale) & ~1
+                frame = frame.reformat(width=width, height=height)
+            return frame
+
+    def apply(self, settings):
+        self.framerate = settings.framerate
+        self.scale = settings.scale
+
+    def stop(self):
+        super().stop()
+        self._track.stop()
+
+
+class BitrateController:
+    """
+    Polls a video sender's stats and applies the policy's settings to its
+    encoder and, if given, to the AdaptiveVideoTrack feeding it.
+
+    sender: RTCRtpSender of the video track
+    track: track added to the sender with an apply(settings) method, like
+        AdaptiveVideoTrack or simulcast.SimulcastTrack, or None to adapt the
+        bitrate only
+    policy: Policy deciding the settings, LossBasedPolicy by default
+    interval: seconds between polls
+    """
+
+    def __init__(self, sender, track=None, policy=None, interval=POLL_INTERVAL):
+        self._sender = sender
+        self._track = track
+        self._policy = policy or LossBasedPolicy()
+        self._interval = interval
+        self._task = None
+        self._applied_bitrate = None
+        self._last_bytes = None
+        self._last_time = None
+        self.settings = self._policy.initial()
+        self._apply(self.settings)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+        self._task = None
+
+    @property
+    def _encoder(self):
+        # aiortc creates the encoder on the first frame and keeps it private
+        return getattr(self._sender, "_RTCRtpSender__encoder", None)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self._interval)
+            try:
+                stats = await self.sample()
+            except Exception as e:
+                logging.error(f"Reading sender stats failed: {e}")
+                continue
+            if stats.rtt is None:
+                # nothing to go on until the first receiver report
+                continue
+            settings = self._policy.update(stats, self.settings)
+            if settings != self.settings:
+                logging.info(f"Adapting video to {settings} for {stats}")
+            self.settings = settings
+            self._apply(settings)
+
+    async def sample(self):
+        report = await self._sender.getStats()
+        stats = LinkStats()
+        now = time.monotonic()
+        for entry in report.values():
+            if entry.type == "remote-inbound-rtp":
+                stats.rtt = entry.roundTripTime
+                # receiver reports carry the fraction as 8 bit fixed point
+                stats.fraction_lost = entry.fractionLost / 256
+            elif entry.type == "outbound-rtp":
+                if self._last_bytes is not None and now > self._last_time:
+                    stats.send_rate = (entry.bytesSent - self._last_bytes) * 8 / (now - self._last_time)
+                self._last_bytes = entry.bytesSent
+                self._last_time = now
+        encoder = self._encoder
+        if encoder is not None and self._applied_bitrate is not None and hasattr(encoder, "target_bitrate"):
+            # aiortc sets the encoder straight from REMB, so a changed target
+            # is the receiver's estimate
+            if encoder.target_bitrate != self._applied_bitrate:
+                stats.estimate = encoder.target_bitrate
+        return stats
+
+    def _apply(self, settings):
+        encoder = self._encoder
+        if encoder is not None and hasattr(encoder, "target_bitrate"):
+            encoder.target_bitrate = settings.bitrate
+            # the encoder clamps to the range its codec supports
+            self._applied_bitrate = encoder.target_bitrate
+        if self._track is not None:
+            self._track.apply(settings)
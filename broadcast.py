@@ -0,0 +1,257 @@
+import asyncio
+import logging
+import time
+import av
+from aiortc import MediaStreamTrack
+from aiortc.mediastreams import MediaStreamError
+from capture_hub import hub as capture_hub
+from metrics import BROADCAST_QUEUE_DEPTH, ENCODE_SECONDS, registry
+
+DEFAULT_CODEC = "video/H264"
+DEFAULT_BITRATE = 1000000
+# frames between forced keyframes so late joiners never wait long for a picture
+KEYFRAME_INTERVAL = 60
+# encoded packets held per subscriber before it is considered too slow
+SUBSCRIBER_QUEUE_SIZE = 30
+
+ENCODERS = {
+    "video/H264": "libx264",
+    "video/VP8": "libvpx",
+}
+
+
+class EncodedTrack(MediaStreamTrack):
+    """
+    A video track that yields packets from a shared encoder instead of frames.
+
+    RTCRtpSender only packetizes av.Packet objects, so every peer connection
+    subscribed to the same EncodedBroadcast skips encoding entirely.
+    """
+
+    kind = "video"
+
+    def __init__(self, broadcast):
+        super().__init__()
+        self._broadcast = broadcast
+        self._queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        self._waiting_for_keyframe = True
+
+    @property
+    def pending(self):
+        """
+        Packets queued and not yet received.
+        """
+        return self._queue.qsize()
+
+    def request_keyframe(self):
+        if self._broadcast:
+            self._broadcast.request_keyframe()
+
+    def _put(self, packet):
+        if self._waiting_for_keyframe:
+            if not packet.is_keyframe:
+                return
+            self._waiting_for_keyframe = False
+        try:
+            self._queue.put_nowait(packet)
+        except asyncio.QueueFull:
+            # resume from the next keyframe so the remote decoder never sees a gap
+            self._drain()
+            self._waiting_for_keyframe = True
+            self.request_keyframe()
+
+    def _end(self):
+        self._drain()
+        self._queue.put_nowait(None)
+
+    def _drain(self):
+        while not self._queue.empty():
+            self._queue.get_nowait()
+
+    async def recv(self):
+        if self.readyState != "live":
+            raise MediaStreamError
+        packet = await self._queue.get()
+        if packet is None:
+            self.stop()
+            raise MediaStreamError
+        return packet
+
+    def stop(self):
+        super().stop()
+        if self._broadcast:
+            self._broadcast._unsubscribe(self)
+            self._broadcast = None
+
+
+class EncodedBroadcast:
+    """
+    Encodes a source track once and fans the packets out to any number of
+    EncodedTrack subscribers.
+
+    source: decoded video track to encode
+    codec: mime type of the codec, one of ENCODERS
+    width, height: output resolution, defaults to the source resolution
+    bitrate: target bitrate in bits per second
+    """
+
+    def __init__(self, source, codec=DEFAULT_CODEC, width=None, height=None, bitrate=DEFAULT_BITRATE, on_close=None):
+        if codec not in ENCODERS:
+            raise Exception(f"Codec {codec} cannot be used for broadcast")
+        self.codec = codec
+        self.width = width
+        self.height = height
+        self.bitrate = bitrate
+        self._source = source
+        self._on_close = on_close
+        self._context = None
+        self._force_keyframe = False
+        self._subscribers = set()
+        self._task = None
+        self._closed = False
+
+    def subscribe(self):
+        track = EncodedTrack(self)
+        self._subscribers.add(track)
+        self.request_keyframe()
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+        return track
+
+    def request_keyframe(self):
+        self._force_keyframe = True
+
+    @property
+    def queue_depth(self):
+        """
+        Packets waiting for the slowest subscriber.
+        """
+        return max((track.pending for track in self._subscribers), default=0)
+
+    def _unsubscribe(self, track):
+        self._subscribers.discard(track)
+        if not self._subscribers:
+            self.close()
+
+    def close(self):
+        # ended subscribers unsubscribe, which closes again
+        if self._closed:
+            return
+        self._closed = True
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        if self._source:
+            self._source.stop()
+            self._source = None
+        for track in list(self._subscribers):
+            track._end()
+        if self._on_close:
+            self._on_close(self)
+
+    def _create_context(self, frame):
+        context = av.CodecContext.create(ENCODERS[self.codec], "w")
+        context.width = frame.width
+        context.height = frame.height
+        context.bit_rate = self.bitrate
+        context.pix_fmt = "yuv420p"
+        context.time_base = frame.time_base
+        context.gop_size = KEYFRAME_INTERVAL
+        if self.codec == "video/H264":
+            context.options = {"level": "31", "tune": "zerolatency"}
+            context.profile = "Baseline"
+        else:
+            context.options = {"deadline": "realtime", "cpu-used": "-6", "lag-in-frames": "0"}
+        return context
+
+    def _encode(self, frame, force_keyframe):
+        start = time.perf_counter()
+        if self.width and self.height:
+            frame = frame.reformat(width=self.width, height=self.height, format="yuv420p")
+        elif frame.format.name != "yuv420p":
+            frame = frame.reformat(format="yuv420p")
+        if self._context is None:
+            self._context = self._create_context(frame)
+        frame.pict_type = av.video.frame.PictureType.I if force_keyframe else av.video.frame.PictureType.NONE
+        packets = self._context.encode(frame)
+        for packet in packets:
+            packet.pts = frame.pts
+            packet.time_base = frame.time_base
+        ENCODE_SECONDS.observe(time.perf_counter() - start, (self.codec,))
+        return packets
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        logging.info(f"Broadcast encoder started: {self.codec} {self.width}x{self.height}@{self.bitrate}")
+        try:
+            while True:
+                frame = await self._source.recv()
+                force_keyframe = self._force_keyframe
+                self._force_keyframe = False
+                packets = await loop.run_in_executor(None, self._encode, frame, force_keyframe)
+                for packet in packets:
+                    for track in list(self._subscribers):
+                        track._put(packet)
+        except MediaStreamError:
+            pass
+        except Exception as e:
+            logging.error(f"Broadcast encoder failed: {e}")
+            # later subscribers get a new broadcast instead of this dead one
+            self._task = None
+            self.close()
+        finally:
+            # subscribers waiting for packets would otherwise wait forever
+            for track in list(self._subscribers):
+                track._end()
+        logging.info("Broadcast encoder stopped")
+
+
+class BroadcastHub:
+    """
+    Keeps one EncodedBroadcast per (device, codec, resolution, bitrate) so that
+    peers asking for the same stream share a single encoder.
+    """
+
+    def __init__(self):
+        self._broadcasts = {}
+
+    def __len__(self):
+        return len(self._broadcasts)
+
+    async def subscribe(self, file, format=None, options=None, codec=DEFAULT_CODEC, width=None, height=None, bitrate=DEFAULT_BITRATE):
+        key = (file, format, tuple(sorted((options or {}).items())), codec, width, height, bitrate)
+        broadcast = self._broadcasts.get(key)
+        if broadcast is None:
+            source = await capture_hub.subscribe(file, "video", format=format, options=options)
+            if source is None:
+                return None
+            # another call may have started the broadcast while the device opened
+            broadcast = self._broadcasts.get(key)
+            if broadcast is not None:
+                capture_hub.release(source)
+                return broadcast.subscribe()
+            broadcast = EncodedBroadcast(
+                source, codec=codec, width=width, height=height, bitrate=bitrate,
+                on_close=lambda b: self._broadcasts.pop(key, None))
+            self._broadcasts[key] = broadcast
+        return broadcast.subscribe()
+
+    def collect_metrics(self):
+        depths = {}
+        for (file, _, _, codec, *_), broadcast in self._broadcasts.items():
+            depths[file, codec] = max(depths.get((file, codec), 0), broadcast.queue_depth)
+        BROADCAST_QUEUE_DEPTH.clear()
+        for labels, depth in depths.items():
+            BROADCAST_QUEUE_DEPTH.set(depth, labels)
+
+
+def route_keyframe_requests(sender, track):
+    """
+    Forward PLI/FIR received by the sender to the shared encoder, since the
+    sender's own encoder is bypassed for pre-encoded packets.
+    """
+    sender._send_keyframe = track.request_keyframe
+
+
+hub = BroadcastHub()
+registry.add_collector(hub.collect_metrics)
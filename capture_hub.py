@@ -0,0 +1,122 @@
+import asyncio
+import functools
+import logging
+import tracing
+from aiortc.contrib.media import MediaPlayer, MediaRelay
+
+
+class _Capture:
+    def __init__(self, key, player):
+        self.key = key
+        self.player = player
+        self.audio = player.audio
+        self.video = player.video
+        if self.video and tracing.enabled:
+            self.video = tracing.TracedTrack(self.video, "capture")
+        self.relay = MediaRelay()
+        self.subscribers = set()
+
+
+class CaptureHub:
+    """
+    Opens each capture device once per process and relays its decoded frames
+    to any number of subscribers.
+
+    The device is closed as soon as its last subscriber is released: the
+    MediaRelay reader task is ended and the MediaPlayer worker thread stopped.
+    """
+
+    def __init__(self):
+        self._captures = {}
+        self._track_captures = {}
+        # key -> future of a MediaPlayer being opened in the executor
+        self._opening = {}
+
+    def __len__(self):
+        return len(self._captures)
+
+    @staticmethod
+    def _key(file, format, options):
+        return (file, format, tuple(sorted((options or {}).items())))
+
+    async def open(self, file, format=None, options=None):
+        """
+        Open a capture device in the executor, if it is not open yet, without
+        blocking the event loop on the device. Concurrent calls for the same
+        device share one open. The device is closed again once its last
+        subscriber is released, so subscribe to it next.
+        """
+        key = self._key(file, format, options)
+        # a device closed again before this call resumed is opened anew
+        while key not in self._captures:
+            opening = self._opening.get(key)
+            if opening is None:
+                opening = self._opening[key] = asyncio.get_running_loop().run_in_executor(
+                    None, functools.partial(MediaPlayer, file, format=format, options=options))
+                opening.add_done_callback(functools.partial(self._opened, key))
+            await asyncio.shield(opening)
+        return self._captures[key]
+
+    def _opened(self, key, opening):
+        # registered once, by whichever call started the open
+        del self._opening[key]
+        if not opening.cancelled() and opening.exception() is None:
+            self._captures[key] = _Capture(key, opening.result())
+            logging.info(f"Capture opened: {key[0]}")
+
+    async def subscribe(self, file, kind, format=None, options=None, buffered=None):
+        """
+        Subscribe to the audio or video of a capture device, opening it off
+        the event loop if needed.
+
+        file: device name or path passed to MediaPlayer
+        kind: "audio" or "video"
+        format: ffmpeg input format, e.g. "v4l2", "dshow" or "avfoundation"
+        options: ffmpeg input options
+        buffered: keep every frame for a slow subscriber instead of only the
+            latest, by default for audio, where a skipped frame is a gap in
+            the sound, and not for video
+        """
+        # nothing yields between the open and the subscription, so the
+        # capture cannot be closed in between
+        capture = await self.open(file, format, options)
+        source = capture.audio if kind == "audio" else capture.video
+        if source is None:
+            self._close_if_unused(capture)
+            return None
+
+        if buffered is None:
+            buffered = kind == "audio"
+        track = capture.relay.subscribe(source, buffered=buffered)
+        capture.subscribers.add(track)
+        self._track_captures[track] = capture
+        # senders stop their track when the peer connection closes
+        track.on("ended", lambda: self.release(track))
+        return track
+
+    def release(self, track):
+        capture = self._track_captures.pop(track, None)
+        if capture is None:
+            return
+        capture.subscribers.discard(track)
+        track.stop()
+        self._close_if_unused(capture)
+
+    def _close_if_unused(self, capture):
+        if capture.subscribers or self._captures.get(capture.key) is not capture:
+            return
+        del self._captures[capture.key]
+        for track in (capture.player.audio, capture.player.video):
+            if track:
+                # the player never ends its tracks when stopped, so the relay
+                # task would wait on them forever. Frames still queued are
+                # dropped and None, which ends the relay, is queued instead
+                while not track._queue.empty():
+                    track._queue.get_nowait()
+                track._queue.put_nowait(None)
+                # stopping the last track also stops the player thread
+                track.stop()
+        logging.info(f"Capture closed: {capture.key[0]}")
+
+
+hub = CaptureHub()
@@ -0,0 +1,255 @@
+"""
+The capture sources of this machine, listed once and opened off the event
+loop.
+
+Sources are listed per platform: V4L2 cameras from sysfs and ALSA cards
+from /proc/asound on Linux, DirectShow devices on Windows and AVFoundation
+devices on macOS from ffmpeg's device listing. Media files in media_dir
+and synthetic test patterns from ffmpeg's lavfi, which need no hardware,
+are listed everywhere.
+
+The listing is cached. It is listed again when the sysfs, /proc or
+media_dir entries change, which is when a device is plugged in or out on
+Linux, and costs a few directory reads to check. ffmpeg's listing spawns a
+process, so it is trusted for REFRESH_INTERVAL seconds or until a listed
+device fails to open, and refreshed in the background meanwhile. Listing
+and opening run in the executor.
+"""
+import asyncio
+import logging
+import os
+import platform
+import re
+import subprocess
+import time
+from capture_hub import hub as capture_hub
+
+# seconds an ffmpeg device listing is used for before it is refreshed
+REFRESH_INTERVAL = 30
+V4L2_DIR = "/sys/class/video4linux"
+ASOUND_CARDS = "/proc/asound/cards"
+MEDIA_EXTENSIONS = (".mp4", ".mkv", ".webm", ".mov", ".wav", ".mp3", ".ogg")
+# what cameras are asked for
+VIDEO_OPTIONS = {"framerate": "30", "video_size": "640x480"}
+
+
+class CaptureSource:
+    """
+    Something MediaPlayer can open.
+
+    name: name to pick the source by, e.g. the device name
+    kinds: "audio" and "video", or either, as the source has
+    file, format, options: passed to MediaPlayer
+    type: "device", "file" or "synthetic"
+    """
+
+    __slots__ = ("name", "kinds", "file", "format", "options", "type")
+
+    def __init__(self, name, kinds, file, format=None, options=None, type="device"):
+        self.name = name
+        self.kinds = kinds
+        self.file = file
+        self.format = format
+        self.options = options or {}
+        self.type = type
+
+    def __repr__(self):
+        return f"CaptureSource({self.name!r}, {self.kinds}, {self.file!r}, format={self.format!r}, type={self.type!r})"
+
+
+SYNTHETIC_SOURCES = [
+    CaptureSource("testsrc", ("video",), "testsrc=size=640x480:rate=30", "lavfi", type="synthetic"),
+    CaptureSource("sine", ("audio",), "sine=frequency=440:sample_rate=48000", "lavfi", type="synthetic"),
+]
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def _entries(path):
+    try:
+        return sorted(os.listdir(path), key=lambda entry: (len(entry), entry))
+    except OSError:
+        return []
+
+
+def list_v4l2(root=V4L2_DIR):
+    sources = []
+    for entry in _entries(root):
+        # cameras also have metadata nodes, whose index is 1 and above
+        if (_read(os.path.join(root, entry, "index")) or "0") != "0":
+            continue
+        name = _read(os.path.join(root, entry, "name")) or entry
+        sources.append(CaptureSource(name, ("video",), f"/dev/{entry}", "v4l2", VIDEO_OPTIONS))
+    return sources
+
+
+def list_alsa(path=ASOUND_CARDS):
+    # " 0 [PCH            ]: HDA-Intel - HDA Intel PCH"
+    cards = re.findall(r"^\s*(\d+) \[[^\]]*\]: .* - (.+)$", _read(path) or "", re.MULTILINE)
+    return [CaptureSource(name.strip(), ("audio",), f"hw:{number}", "alsa") for number, name in cards]
+
+
+def _ffmpeg_devices(args):
+    try:
+        result = subprocess.run(["ffmpeg", "-hide_banner"] + args, capture_output=True, text=True, timeout=10)
+    except FileNotFoundError:
+        logging.info("ffmpeg not found. Please install ffmpeg.")
+        return ""
+    except subprocess.TimeoutExpired:
+        logging.error(f"Listing devices with ffmpeg {' '.join(args)} timed out")
+        return ""
+    return result.stderr
+
+
+def list_dshow():
+    sources = []
+    devices = _ffmpeg_devices(["-list_devices", "true", "-f", "dshow", "-i", "dummy"])
+    for name, kind in re.findall(r'"([^"]+)"\s+\((video|audio)\)', devices):
+        options = dict(VIDEO_OPTIONS, pixel_format="yuyv422") if kind == "video" else {}
+        sources.append(CaptureSource(name, (kind,), f"{kind}={name}", "dshow", options))
+    return sources
+
+
+def list_avfoundation():
+    sources = []
+    kind = None
+    for line in _ffmpeg_devices(["-f", "avfoundation", "-list_devices", "true", "-i", ""]).splitlines():
+        if "AVFoundation video devices" in line:
+            kind = "video"
+        elif "AVFoundation audio devices" in line:
+            kind = "audio"
+        else:
+            # "[AVFoundation indev @ 0x7f8] [0] FaceTime HD Camera"
+            match = re.search(r"\] \[(\d+)\] (.+)$", line)
+            if match and kind:
+                index, name = match.groups()
+                if kind == "video":
+                    sources.append(CaptureSource(name, ("video",), f"{index}:none", "avfoundation", VIDEO_OPTIONS))
+                else:
+                    sources.append(CaptureSource(name, ("audio",), f"none:{index}", "avfoundation"))
+    return sources
+
+
+def list_files(media_dir):
+    if not media_dir:
+        return []
+    return [CaptureSource(entry, ("audio", "video"), os.path.join(media_dir, entry), type="file")
+            for entry in _entries(media_dir) if entry.lower().endswith(MEDIA_EXTENSIONS)]
+
+
+class CaptureRegistry:
+    """
+    The capture sources of this machine, cached.
+
+    media_dir: directory whose media files are listed as sources, the
+        CAPTURE_MEDIA_DIR environment variable by default
+    refresh_interval: seconds an ffmpeg device listing is used for
+    system: platform.system() of the machine
+    """
+
+    def __init__(self, media_dir=None, refresh_interval=REFRESH_INTERVAL, system=None):
+        self._media_dir = media_dir
+        self.refresh_interval = refresh_interval
+        self.system = system or platform.system()
+        self._sources = None
+        self._signature = None
+        self._listed_at = None
+        self._listing = None
+        self._background_refresh = None
+
+    @property
+    def media_dir(self):
+        return self._media_dir or os.getenv("CAPTURE_MEDIA_DIR")
+
+    def _hotplug_signature(self):
+        # what changes when a device is plugged in or out, cheap to read
+        media_dir = self.media_dir
+        if self.system == "Linux":
+            return _entries(V4L2_DIR), _read(ASOUND_CARDS), media_dir, _entries(media_dir) if media_dir else None
+        return media_dir, _entries(media_dir) if media_dir else None
+
+    def _list_devices(self):
+        if self.system == "Linux":
+            return list_v4l2(V4L2_DIR) + list_alsa(ASOUND_CARDS)
+        elif self.system == "Windows":
+            return list_dshow()
+        elif self.system == "Darwin":
+            return list_avfoundation()
+        return []
+
+    def _list(self):
+        # the signature is taken first, so a device plugged in meanwhile is listed next time
+        signature = self._hotplug_signature()
+        start = time.perf_counter()
+        sources = self._list_devices() + list_files(self.media_dir) + SYNTHETIC_SOURCES
+        logging.info(f"Listed {len(sources)} capture sources in {(time.perf_counter() - start) * 1000:.0f} ms")
+        return sources, signature
+
+    async def refresh(self):
+        """
+        List the sources again, sharing a listing already under way.
+        """
+        if self._listing is None:
+            self._listing = asyncio.get_running_loop().run_in_executor(None, self._list)
+        listing = self._listing
+        try:
+            self._sources, self._signature = await listing
+            self._listed_at = time.monotonic()
+        finally:
+            if self._listing is listing:
+                self._listing = None
+
+    def invalidate(self):
+        self._sources = None
+
+    async def sources(self):
+        """
+        All sources, devices first, listed again if anything was plugged in
+        or out since.
+        """
+        if self._sources is None or self._hotplug_signature() != self._signature:
+            await self.refresh()
+        elif (self.system in ("Windows", "Darwin") and self._listing is None
+              and time.monotonic() - self._listed_at > self.refresh_interval):
+            # the old listing is used rather than waiting for ffmpeg
+            self._background_refresh = asyncio.ensure_future(self.refresh())
+            self._background_refresh.add_done_callback(self._refreshed)
+        return self._sources
+
+    def _refreshed(self, task):
+        if self._background_refresh is task:
+            self._background_refresh = None
+        if not task.cancelled() and task.exception():
+            logging.error(f"Listing capture sources failed: {task.exception()}")
+
+    async def find(self, kind, name=None):
+        """
+        The source of kind whose name or file is name, or the first device
+        of kind if name is None. None if there is no such source.
+        """
+        sources = await self.sources()
+        if name is None:
+            return next((source for source in sources if source.type == "device" and kind in source.kinds), None)
+        return next((source for source in sources if kind in source.kinds and name in (source.name, source.file)), None)
+
+    async def open(self, source):
+        """
+        Open source in the capture hub off the event loop, to be subscribed
+        to next. A device that fails to open is taken as unplugged and the
+        sources are listed again.
+        """
+        try:
+            await capture_hub.open(source.file, format=source.format, options=source.options)
+        except Exception:
+            if source.type == "device":
+                self.invalidate()
+            raise
+
+
+registry = CaptureRegistry()
@@ -0,0 +1,183 @@
+"""
+Messaging over RTCDataChannel with flow control and, for peers that support
+it, binary framing with coalescing.
+
+Messages are queued and written to the channel only while its
+bufferedAmount is below a high watermark. The rest wait for the channel's
+"bufferedamountlow" event, so a fast producer cannot grow the SCTP buffers
+without limit, and send raises once the queue itself is full.
+
+In framed mode, the small messages queued during one loop iteration are
+packed into a single data channel message of records:
+
+    <kind: 1 byte><length: 4 bytes, big endian><payload>
+
+kind is 0 for UTF-8 text and 1 for binary. Unframed mode sends each message
+as it is, which is what the Unity client expects on the "chat" channel.
+"""
+import asyncio
+import logging
+import struct
+from collections import deque
+
+RECORD_HEADER = struct.Struct("!BI")
+TEXT = 0
+BINARY = 1
+# largest coalesced message, well below the 64 KiB SCTP message size aiortc supports
+MAX_FRAME_SIZE = 16384
+# stop writing to the channel above this many buffered bytes, everything
+# buffered adds to the latency of the next message
+HIGH_WATERMARK = 256 * 1024
+# resume writing once the buffered bytes fall to this
+LOW_WATERMARK = 64 * 1024
+# drain returns once no more than this many bytes are queued
+DRAIN_THRESHOLD = 64 * 1024
+# most bytes queued before send raises MessageChannelFull
+MAX_PENDING = 4 * 1024 * 1024
+
+
+class MessageChannelFull(Exception):
+    pass
+
+
+def encode_records(messages):
+    frame = bytearray()
+    for message in messages:
+        if isinstance(message, str):
+            kind, message = TEXT, message.encode("utf-8")
+        else:
+            kind = BINARY
+        frame += RECORD_HEADER.pack(kind, len(message))
+        frame += message
+    return bytes(frame)
+
+
+def decode_records(frame):
+    messages = []
+    offset = 0
+    view = memoryview(frame)
+    while offset < len(frame):
+        kind, size = RECORD_HEADER.unpack_from(frame, offset)
+        offset += RECORD_HEADER.size
+        if offset + size > len(frame):
+            raise ValueError("Truncated data channel record")
+        payload = view[offset:offset + size]
+        messages.append(str(payload, "utf-8") if kind == TEXT else bytes(payload))
+        offset += size
+    return messages
+
+
+class MessageChannel:
+    """
+    Queues messages for an RTCDataChannel and writes them as fast as the
+    channel drains.
+
+    channel: RTCDataChannel to send on and receive from
+    framed: pack messages into binary frames, both peers must use framing
+    on_message: callable given each received message, as str or bytes
+    drop_when_full: drop the oldest queued messages instead of raising when
+        the queue is full, for telemetry where only recent values matter
+    max_pending: most bytes queued before the channel counts as full
+    """
+
+    def __init__(self, channel, framed=False, on_message=None, drop_when_full=False, max_pending=MAX_PENDING):
+        self.channel = channel
+        self.framed = framed
+        self.on_message = on_message
+        self.drop_when_full = drop_when_full
+        self.dropped = 0
+        self._max_pending = max_pending
+        # (message, its UTF-8 encoding or the bytes themselves)
+        self._pending = deque()
+        self._pending_bytes = 0
+        self._flush_scheduled = False
+        self._writable = asyncio.Event()
+        self._writable.set()
+        channel.bufferedAmountLowThreshold = LOW_WATERMARK
+        channel.on("open", self._flush)
+        channel.on("bufferedamountlow", self._flush)
+        channel.on("message", self._receive)
+        channel.on("close", self._closed)
+
+    @property
+    def pending_bytes(self):
+        return self._pending_bytes
+
+    def send(self, message):
+        """
+        Queue a message, str or bytes, to be written on the next flush.
+        """
+        if self.channel.readyState == "closed":
+            self.dropped += 1
+            return
+        # counted in bytes as sent, and framing reuses the encoding
+        data = message.encode("utf-8") if isinstance(message, str) else message
+        size = len(data)
+        if self._pending_bytes + size > self._max_pending:
+            if not self.drop_when_full:
+                raise MessageChannelFull(f"{self._pending_bytes} bytes already queued on {self.channel.label}")
+            while self._pending and self._pending_bytes + size > self._max_pending:
+                self._pending_bytes -= len(self._pending.popleft()[1])
+                self.dropped += 1
+        self._pending.append((message, data))
+        self._pending_bytes += size
+        if self._pending_bytes > DRAIN_THRESHOLD:
+            self._writable.clear()
+        if not self._flush_scheduled:
+            # messages sent in the same loop iteration go out together
+            self._flush_scheduled = True
+            asyncio.get_running_loop().call_soon(self._flush)
+
+    async def drain(self):
+        """
+        Wait until the queue is short again, for producers that would rather
+        slow down than have send raise. Also returns once the channel closes.
+        """
+        await self._writable.wait()
+
+    def _next_frame(self):
+        message, data = self._pending.popleft()
+        self._pending_bytes -= len(data)
+        if not self.framed:
+            return message
+        frame = bytearray()
+        while True:
+            frame += RECORD_HEADER.pack(TEXT if isinstance(message, str) else BINARY, len(data))
+            frame += data
+            if not self._pending or len(frame) + RECORD_HEADER.size + len(self._pending[0][1]) > MAX_FRAME_SIZE:
+                return bytes(frame)
+            message, data = self._pending.popleft()
+            self._pending_bytes -= len(data)
+
+    def _flush(self):
+        self._flush_scheduled = False
+        if self.channel.readyState != "open":
+            # flushed again by the "open" event
+            return
+        while self._pending and self.channel.bufferedAmount < HIGH_WATERMARK:
+            self.channel.send(self._next_frame())
+        if self._pending_bytes <= DRAIN_THRESHOLD:
+            self._writable.set()
+
+    def _closed(self):
+        # nothing queued will be sent any more, and drain must not wait for it
+        if self._pending:
+            logging.warning(f"Data channel {self.channel.label} closed with {len(self._pending)} messages queued")
+        self._pending.clear()
+        self._pending_bytes = 0
+        self._writable.set()
+
+    def _receive(self, message):
+        if self.framed and isinstance(message, bytes):
+            try:
+                messages = decode_records(message)
+            except (ValueError, struct.error) as e:
+                logging.error(f"Malformed frame on data channel {self.channel.label}: {e}")
+                return
+        else:
+            messages = [message]
+        for message in messages:
+            # not formatted unless debug logging is on
+            logging.debug("<<< %r", message)
+            if self.on_message:
+                self.on_message(message)
@@ -4,22 +4,34 @@ import json
 import logging
 import os
 import ssl
+import sys
 import uuid
 import websockets
 import platform
 
-import cv2
 from aiohttp import web
-from aiortc import MediaStreamTrack, RTCPeerConnection, RTCSessionDescription, RTCIceCandidate, RTCRtpSender
+from aiortc import MediaStreamTrack, RTCPeerConnection, RTCSessionDescription, RTCRtpSender
 from aiortc.contrib.media import MediaBlackhole, MediaPlayer, MediaRecorder, MediaRelay
-from av import VideoFrame
 
 ROOT = os.path.dirname(__file__)
+sys.path.append(os.path.join(ROOT, "..", ".."))
+
+from batch_inference import BatchedTrack, BatchStage, SobelEdgesModel  # noqa: E402
+from frame_transforms import TransformEngine, parse_chain  # noqa: E402
+from frame_workers import OffloadedTransformTrack, WorkerPool  # noqa: E402
+from packet_cache import cache_sent_packets  # noqa: E402
+from recording import CONTAINERS as RECORDING_CONTAINERS, Recorder  # noqa: E402
+from sfu import hub as forwarding_hub  # noqa: E402
+from signaling_codec import Candidate, decode_message, encode_candidates  # noqa: E402
+import tracing  # noqa: E402
 
 logger = logging.getLogger("pc")
 pcs = set()
 websocket = None
 relay = None
+transform_pool = None
+batch_stage = None
+transform_tracks = set()
 webcam = None
 
 
@@ -74,6 +86,7 @@ def add_media_tracks(pc):
 
     if video:
         video_sender = pc.addTrack(video)
+        cache_sent_packets(video_sender)
         if args.video_codec:
             force_codec(pc, video_sender, args.video_codec)
         elif args.play_without_decoding:
@@ -85,72 +98,23 @@ def add_media_tracks(pc):
 class VideoTransformTrack(MediaStreamTrack):
     """
     A video stream track that transforms frames from an another track.
+
+    transform: transform names joined by "+", e.g. "edges+rotate", see
+        frame_transforms.TRANSFORMS
     """
 
     kind = "video"
 
-    def __init__(self, track, transform):
+    def __init__(self, track, transform=None):
         super().__init__()  # don't forget this!
         self.track = track
         self.transform = transform
+        # works on the decoded yuv420p planes, reusing its output frames
+        self.engine = TransformEngine(parse_chain(transform))
 
     async def recv(self):
         frame = await self.track.recv()
-
-        if self.transform == "cartoon":
-            img = frame.to_ndarray(format="bgr24")
-
-            # prepare color
-            img_color = cv2.pyrDown(cv2.pyrDown(img))
-            for _ in range(6):
-                img_color = cv2.bilateralFilter(img_color, 9, 9, 7)
-            img_color = cv2.pyrUp(cv2.pyrUp(img_color))
-
-            # prepare edges
-            img_edges = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
-            img_edges = cv2.adaptiveThreshold(
-                cv2.medianBlur(img_edges, 7),
-                255,
-                cv2.ADAPTIVE_THRESH_MEAN_C,
-                cv2.THRESH_BINARY,
-                9,
-                2,
-            )
-            img_edges = cv2.cvtColor(img_edges, cv2.COLOR_GRAY2RGB)
-
-            # combine color and edges
-            img = cv2.bitwise_and(img_color, img_edges)
-
-            # rebuild a VideoFrame, preserving timing information
-            new_frame = VideoFrame.from_ndarray(img, format="bgr24")
-            new_frame.pts = frame.pts
-            new_frame.time_base = frame.time_base
-            return new_frame
-        elif self.transform == "edges":
-            # perform edge detection
-            img = frame.to_ndarray(format="bgr24")
-            img = cv2.cvtColor(cv2.Canny(img, 100, 200), cv2.COLOR_GRAY2BGR)
-
-            # rebuild a VideoFrame, preserving timing information
-            new_frame = VideoFrame.from_ndarray(img, format="bgr24")
-            new_frame.pts = frame.pts
-            new_frame.time_base = frame.time_base
-            return new_frame
-        elif self.transform == "rotate":
-            # rotate image
-            img = frame.to_ndarray(format="bgr24")
-            rows, cols, _ = img.shape
-            M = cv2.getRotationMatrix2D(
-                (cols / 2, rows / 2), frame.time * 45, 1)
-            img = cv2.warpAffine(img, M, (cols, rows))
-
-            # rebuild a VideoFrame, preserving timing information
-            new_frame = VideoFrame.from_ndarray(img, format="bgr24")
-            new_frame.pts = frame.pts
-            new_frame.time_base = frame.time_base
-            return new_frame
-        else:
-            return frame
+        return self.engine.process(frame)
 
 
 async def index(request):
@@ -175,7 +139,12 @@ async def offer(request):
 
     pc = RTCPeerConnection()
     print("Created peer connection")
-    pc = add_media_tracks(pc)
+    if args.sfu:
+        # whatever the publishing peer sends is forwarded to this one
+        forwarding_hub.subscribe(pc, "unity", "audio")
+        forwarding_hub.subscribe(pc, "unity", "video")
+    else:
+        pc = add_media_tracks(pc)
     print("Added media tracks")
     offer = await pc.createOffer()
     await pc.setLocalDescription(offer)
@@ -190,7 +159,10 @@ async def offer(request):
 
     # prepare local media
     player = MediaPlayer(os.path.join(ROOT, "demo-instruct.wav"))
-    if args.record_to:
+    # .mkv and .mp4 recordings copy the received frames without decoding,
+    # anything else goes through MediaRecorder and is re-encoded
+    copy_recording = args.record_to and os.path.splitext(args.record_to)[1] in RECORDING_CONTAINERS
+    if args.record_to and not copy_recording:
         recorder = MediaRecorder(args.record_to)
     else:
         recorder = MediaBlackhole()
@@ -213,31 +185,68 @@ async def offer(request):
     def on_track(track):
         log_info("Track %s received", track.kind)
 
-        if track.kind == "audio":
+        publisher = None
+        if args.sfu:
+            # before the recorder taps the receiver, so it still sees every frame
+            receiver = next(t.receiver for t in pc.getTransceivers() if t.receiver.track is track)
+            publisher = forwarding_hub.publish("unity", receiver, track.kind)
+
+        track_recorder = None
+        if copy_recording:
+            receiver = next(t.receiver for t in pc.getTransceivers() if t.receiver.track is track)
+            base, extension = os.path.splitext(args.record_to)
+            track_recorder = Recorder(f"{base}-{track.kind}-{{segment:03}}{extension}", args.record_segment)
+            track_recorder.tap(receiver)
+
+        # forwarded tracks are never decoded, so only copy recordings get them
+        if publisher:
+            pass
+        elif track.kind == "audio":
             pc.addTrack(player.audio)
             recorder.addTrack(track)
         elif track.kind == "video":
-            pc.addTrack(
-                VideoTransformTrack(
-                    relay.subscribe(track)
-                    # relay.subscribe(track), transform=params["video_transform"]
+            source = relay.subscribe(track)
+            if tracing.enabled:
+                source = tracing.TracedTrack(source, "relay", pc_id)
+            if batch_stage:
+                # frames from every headset share one model run
+                transformed = BatchedTrack(source, batch_stage)
+            elif transform_pool and args.video_transform:
+                # heavy transforms run off the event loop, dropping stale frames
+                transformed = OffloadedTransformTrack(
+                    source, args.video_transform, transform_pool
+                )
+                transform_tracks.add(transformed)
+                transformed.on("ended", lambda: transform_tracks.discard(transformed))
+            else:
+                transformed = VideoTransformTrack(
+                    source, transform=args.video_transform
                 )
-            )
-            if args.record_to:
+            if tracing.enabled:
+                # the sender takes each frame as soon as its transform is done
+                transformed = tracing.TracedTrack(transformed, "transform", pc_id)
+                tracing.trace_sender(pc.addTrack(transformed), transformed, pc_id)
+            else:
+                pc.addTrack(transformed)
+            if args.record_to and not copy_recording:
                 recorder.addTrack(relay.subscribe(track))
 
         @track.on("ended")
         async def on_ended():
             log_info("Track %s ended", track.kind)
+            if publisher:
+                forwarding_hub.unpublish("unity", publisher)
             await recorder.stop()
+            if track_recorder:
+                # writes out what is still queued
+                await asyncio.to_thread(track_recorder.stop)
 
     @pc.on("icecandidate")
     async def on_icecandidate(candidate):
         print("on_icecandidate")
         if candidate:
-            candidate = candidate.to_sdp()
-            candidate = "candidate~" + candidate
-            await websocket.send(candidate)
+            for message in encode_candidates([Candidate.from_rtc(candidate)]):
+                await websocket.send(message)
 
     # offer = RTCSessionDescription(sdp=params["sdp"], type=params["type"])
     # await pc.setRemoteDescription(offer)
@@ -247,8 +256,8 @@ async def offer(request):
     print(answer)
 
     # handle answer
-    sdp_type, sdp = answer.split("~")
-    answer = RTCSessionDescription(sdp=sdp, type=sdp_type)
+    answer = decode_message(answer)
+    answer = RTCSessionDescription(sdp=answer.sdp, type=answer.type)
     await pc.setRemoteDescription(answer)
     await recorder.start()
 
@@ -256,12 +265,8 @@ async def offer(request):
     candidate = await websocket.recv()
     print("received candidate")
     print(candidate)
-    sdp_type, candidate, sdp_mid, sdp_mline_index = candidate.split("~")
-    foundation, component, protocol, priority, ip, port, _, _type = candidate.split()[
-        :8]
-    candidate = RTCIceCandidate(foundation=foundation, component=component, protocol=protocol,
-                                priority=priority, ip=ip, port=port, type=_type, sdpMid=sdp_mid, sdpMLineIndex=sdp_mline_index)
-    await pc.addIceCandidate(candidate)
+    for candidate in decode_message(candidate).candidates:
+        await pc.addIceCandidate(candidate.to_rtc())
 
     return web.Response(
         content_type="application/json",
@@ -279,11 +284,25 @@ async def send(request):
     print("Sent message: " + message)
 
 
+async def transform_metrics(request):
+    return web.json_response([track.metrics_dict() for track in transform_tracks])
+
+
+async def batch_metrics(request):
+    return web.json_response(batch_stage.metrics.as_dict() if batch_stage else {})
+
+
 async def on_shutdown(app):
     # close peer connections
     coros = [pc.close() for pc in pcs]
     await asyncio.gather(*coros)
     pcs.clear()
+    if transform_pool:
+        transform_pool.close()
+    if batch_stage:
+        batch_stage.close()
+    if args.trace_to:
+        tracing.dump(args.trace_to)
 
 
 if __name__ == "__main__":
@@ -298,7 +317,39 @@ if __name__ == "__main__":
     parser.add_argument(
         "--port", type=int, default=8080, help="Port for HTTP server (default: 8080)"
     )
-    parser.add_argument("--record-to", help="Write received media to a file.")
+    parser.add_argument(
+        "--record-to", help="Write received media to a file, .mkv and .mp4 as received, in segments, one per track"
+    )
+    parser.add_argument(
+        "--record-segment", type=float, default=60,
+        help="Seconds per .mkv or .mp4 recording segment, 0 for a single file (default: 60)"
+    )
+    parser.add_argument(
+        "--video-transform", help="Transforms applied to received video, e.g. cartoon or edges+rotate"
+    )
+    parser.add_argument(
+        "--transform-workers", type=int, default=0,
+        help="Run video transforms on this many workers instead of the event loop"
+    )
+    parser.add_argument(
+        "--transform-pool", choices=["thread", "process"], default="thread",
+        help="Kind of workers running video transforms (default: thread)"
+    )
+    parser.add_argument(
+        "--batch-size", type=int, default=0,
+        help="Run received video from all peers through a batched model, this many frames at a time"
+    )
+    parser.add_argument(
+        "--batch-delay", type=float, default=0.02,
+        help="Longest a frame waits for its batch to fill, in seconds (default: 0.02)"
+    )
+    parser.add_argument(
+        "--trace-to", help="Trace every video frame through the pipeline and write a Chrome trace here on exit"
+    )
+    parser.add_argument(
+        "--sfu", action="store_true",
+        help="Forward the media received from the latest publishing peer to every other peer, without decoding it"
+    )
     parser.add_argument("--verbose", "-v", action="count")
     args = parser.parse_args()
     args.play_from = None
@@ -317,12 +368,23 @@ if __name__ == "__main__":
     else:
         ssl_context = None
 
+    if args.trace_to:
+        tracing.enable()
+
+    if args.transform_workers:
+        transform_pool = WorkerPool(args.transform_pool, args.transform_workers)
+
+    if args.batch_size:
+        batch_stage = BatchStage(SobelEdgesModel(), args.batch_size, args.batch_delay)
+
     app = web.Application()
     app.on_shutdown.append(on_shutdown)
     app.router.add_get("/", index)
     app.router.add_get("/client.js", javascript)
     app.router.add_get("/offer", offer)
     app.router.add_post("/send", send)
+    app.router.add_get("/transform_metrics", transform_metrics)
+    app.router.add_get("/batch_metrics", batch_metrics)
     web.run_app(
         app, access_log=None, host=args.host, port=args.port, ssl_context=ssl_context
     )
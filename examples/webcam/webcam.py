@@ -5,14 +5,18 @@ import logging
 import os
 import platform
 import ssl
+import sys
 import websockets
 
 from aiohttp import web
-from aiortc import RTCPeerConnection, RTCSessionDescription, RTCIceCandidate, RTCConfiguration, RTCIceServer
+from aiortc import RTCPeerConnection, RTCSessionDescription, RTCConfiguration, RTCIceServer
 from aiortc.contrib.media import MediaPlayer, MediaRelay
 from aiortc.rtcrtpsender import RTCRtpSender
 
 ROOT = os.path.dirname(__file__)
+sys.path.append(os.path.join(ROOT, "..", ".."))
+
+from signaling_codec import decode_message, encode_description  # noqa: E402
 
 
 relay = None
@@ -62,24 +66,20 @@ def force_codec(pc, sender, forced_codec):
 async def consume_signaling(pc, websocket):
     message = await websocket.recv()
     print("Received:", message)
-    sdp_type, sdp = message.split("~")[:2]
-    if sdp_type == "offer":
-        offer = RTCSessionDescription(sdp=sdp, type=sdp_type)
+    message = decode_message(message)
+    if message.type == "offer":
+        offer = RTCSessionDescription(sdp=message.sdp, type=message.type)
         await pc.setRemoteDescription(offer)
         answer = await pc.createAnswer()
         await pc.setLocalDescription(answer)
-        answer = answer.type + "~" + answer.sdp
+        answer = encode_description(answer.type, answer.sdp, version=message.version)
         await websocket.send(answer)
-    elif sdp_type == "answer":
-        sdp = RTCSessionDescription(sdp=sdp, type=sdp_type)
+    elif message.type == "answer":
+        sdp = RTCSessionDescription(sdp=message.sdp, type=message.type)
         await pc.setRemoteDescription(sdp)
-    elif sdp_type == "candidate":
-        sdp_type, candidate, sdp_mid, sdp_mline_index = message.split("~")
-        foundation, component, protocol, priority, ip, port, _, _type = candidate.split()[
-            :8]
-        candidate = RTCIceCandidate(foundation=foundation, component=component, protocol=protocol,
-                                    priority=priority, ip=ip, port=port, type=_type, sdpMid=sdp_mid, sdpMLineIndex=sdp_mline_index)
-        await pc.addIceCandidate(candidate)
+    elif message.type == "candidate":
+        for candidate in message.candidates:
+            await pc.addIceCandidate(candidate.to_rtc())
 
 async def index(request):
     global websocket
@@ -0,0 +1,242 @@
+"""
+Video transforms that work on the Y, U and V planes of yuv420p frames, the
+format aiortc decodes to and encodes from, instead of converting every frame
+to BGR and back.
+
+Planes are numpy views of the frame's own buffers, so reading and writing
+them copies nothing. A TransformEngine runs a chain of transforms, passing
+each one's output planes to the next, and writes the result into output
+frames it allocates once and then reuses.
+"""
+import collections
+import cv2
+import numpy as np
+from av import VideoFrame
+
+# values of a black pixel in yuv420p
+BLACK_LUMA = 0
+NEUTRAL_CHROMA = 128
+
+
+def planes(frame):
+    """
+    Writable (y, u, v) numpy views of a yuv420p frame, without copying.
+    Rows may be padded, so the views are strided rather than contiguous.
+    """
+    return tuple(
+        np.frombuffer(plane, np.uint8, count=plane.height * plane.line_size)
+        .reshape(plane.height, plane.line_size)[:, :plane.width]
+        for plane in frame.planes)
+
+
+class Transform:
+    """
+    A frame transform. apply reads the planes of src and writes the planes
+    of dst, each a (y, u, v) tuple of numpy views. Transforms that set
+    in_place are given the same planes as src and dst.
+    """
+
+    in_place = False
+
+    def apply(self, src, dst, time):
+        raise NotImplementedError
+
+
+class Copy(Transform):
+    def apply(self, src, dst, time):
+        for s, d in zip(src, dst):
+            np.copyto(d, s)
+
+
+class Grayscale(Transform):
+    in_place = True
+
+    def apply(self, src, dst, time):
+        dst[1].fill(NEUTRAL_CHROMA)
+        dst[2].fill(NEUTRAL_CHROMA)
+
+
+class Edges(Transform):
+    """
+    Canny edges of the luma plane, in white on black.
+    """
+
+    def __init__(self, low=100, high=200):
+        self._low = low
+        self._high = high
+
+    def apply(self, src, dst, time):
+        cv2.Canny(src[0], self._low, self._high, edges=dst[0])
+        dst[1].fill(NEUTRAL_CHROMA)
+        dst[2].fill(NEUTRAL_CHROMA)
+
+
+class Rotate(Transform):
+    """
+    Rotates the frame about its centre by degrees_per_second times the frame
+    time.
+    """
+
+    def __init__(self, degrees_per_second=45):
+        self._degrees_per_second = degrees_per_second
+
+    def apply(self, src, dst, time):
+        angle = (time or 0) * self._degrees_per_second
+        for s, d, border in zip(src, dst, (BLACK_LUMA, NEUTRAL_CHROMA, NEUTRAL_CHROMA)):
+            height, width = s.shape
+            matrix = cv2.getRotationMatrix2D((width / 2, height / 2), angle, 1)
+            cv2.warpAffine(s, matrix, (width, height), dst=d, borderValue=border)
+
+
+class Cartoon(Transform):
+    """
+    Flattens colours with repeated bilateral filtering at quarter size and
+    draws dark outlines from an adaptive threshold. Only the luma plane is
+    bilateral filtered; the half size chroma planes are smoothed by a cheap
+    down and up scale, which is enough for the flat colour look.
+
+    passes: bilateral filter passes
+    """
+
+    def __init__(self, passes=6):
+        self._passes = passes
+        self._mask = None
+
+    def apply(self, src, dst, time):
+        y, u, v = src
+        height, width = y.shape
+        if self._mask is None or self._mask.shape != y.shape:
+            self._mask = np.empty(y.shape, np.uint8)
+
+        # edges first, as dst may not be read from once written
+        cv2.adaptiveThreshold(cv2.medianBlur(y, 7), 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY,
+                              9, 2, dst=self._mask)
+
+        small = cv2.pyrDown(cv2.pyrDown(y))
+        for _ in range(self._passes):
+            small = cv2.bilateralFilter(small, 9, 9, 7)
+        cv2.resize(small, (width, height), dst=dst[0], interpolation=cv2.INTER_LINEAR)
+        cv2.bitwise_and(dst[0], self._mask, dst=dst[0])
+
+        outline = self._mask[::2, ::2][:u.shape[0], :u.shape[1]] == 0
+        for s, d in ((u, dst[1]), (v, dst[2])):
+            cv2.resize(cv2.pyrDown(s), (s.shape[1], s.shape[0]), dst=d, interpolation=cv2.INTER_LINEAR)
+            d[outline] = NEUTRAL_CHROMA
+
+
+TRANSFORMS = {
+    "cartoon": Cartoon,
+    "edges": Edges,
+    "grayscale": Grayscale,
+    "rotate": Rotate,
+}
+
+
+def parse_chain(names):
+    """
+    Build transforms from names joined by "+", e.g. "edges+rotate".
+    """
+    if not names or names == "none":
+        return []
+    try:
+        return [TRANSFORMS[name]() for name in names.split("+")]
+    except KeyError as e:
+        raise Exception(f"Unknown video transform: {e.args[0]}")
+
+
+class TransformEngine:
+    """
+    Runs a chain of transforms on yuv420p frames.
+
+    Steps alternate between a scratch frame and the output frame, arranged so
+    the last one writes the output, and in place steps reuse whichever planes
+    hold the current result. Output frames come from a ring of pool_size
+    frames, so a frame handed out stays valid while up to pool_size - 1 later
+    ones are produced.
+
+    With recycle, output frames are instead taken from a free list and only
+    reused once given back with release, and more are allocated if none is
+    free.
+
+    transforms: list of Transform objects, applied in order
+    pool_size: output frames to rotate through, or to start the free list with
+    recycle: reuse output frames only once they are released
+    """
+
+    def __init__(self, transforms, pool_size=2, recycle=False):
+        self._steps = list(transforms)
+        if self._steps and self._steps[0].in_place:
+            # never write into the input, other tracks may share it
+            self._steps.insert(0, Copy())
+        self._pool_size = pool_size
+        self._recycle = recycle
+        self._outputs = []
+        self._output_planes = []
+        self._next_output = 0
+        self._scratch = None
+        # in recycle mode, planes of every output frame of the current size,
+        # and the frames free to be written, with their planes
+        self._recycled = {}
+        self._free = collections.deque()
+
+    def _allocate(self, width, height):
+        self._outputs = [VideoFrame(width, height, "yuv420p") for _ in range(self._pool_size)]
+        # kept so the buffers behind the scratch planes stay alive
+        self._scratch_frame = VideoFrame(width, height, "yuv420p")
+        self._scratch = planes(self._scratch_frame)
+        self._output_planes = [planes(frame) for frame in self._outputs]
+        if self._recycle:
+            # frames of the old size still out are dropped when released
+            self._recycled = dict(zip(self._outputs, self._output_planes))
+            self._free = collections.deque(zip(self._outputs, self._output_planes))
+
+    def _take_output(self, width, height):
+        try:
+            return self._free.popleft()
+        except IndexError:
+            output = VideoFrame(width, height, "yuv420p")
+            output_planes = self._recycled[output] = planes(output)
+            return output, output_planes
+
+    def release(self, output):
+        """
+        Give an output frame back for reuse, in recycle mode. Other frames,
+        such as inputs passed through an empty chain, are ignored.
+        """
+        output_planes = self._recycled.get(output)
+        if output_planes is not None:
+            self._free.append((output, output_planes))
+
+    def process(self, frame):
+        if not self._steps:
+            return frame
+        if frame.format.name != "yuv420p":
+            frame = frame.reformat(format="yuv420p")
+        if not self._outputs or (self._outputs[0].width, self._outputs[0].height) != (frame.width, frame.height):
+            self._allocate(frame.width, frame.height)
+
+        if self._recycle:
+            output, output_planes = self._take_output(frame.width, frame.height)
+        else:
+            index = self._next_output
+            self._next_output = (index + 1) % self._pool_size
+            output, output_planes = self._outputs[index], self._output_planes[index]
+
+        current = planes(frame)
+        remaining = sum(1 for step in self._steps if not step.in_place)
+        try:
+            for step in self._steps:
+                if step.in_place:
+                    step.apply(current, current, frame.time)
+                    continue
+                remaining -= 1
+                target = output_planes if remaining % 2 == 0 else self._scratch
+                step.apply(current, target, frame.time)
+                current = target
+        except Exception:
+            self.release(output)
+            raise
+
+        output.pts = frame.pts
+        output.time_base = frame.time_base
+        return output
@@ -0,0 +1,240 @@
+"""
+Runs frame transforms off the event loop, on a thread or process pool, so
+heavy transforms do not hold up signaling, RTCP or other peers.
+
+Each OffloadedTransformTrack keeps at most one frame waiting to be
+processed. A newer frame replaces a waiting one, so when transforms fall
+behind, frames are dropped rather than queued and latency stays bounded.
+"""
+import asyncio
+import concurrent.futures
+import logging
+import os
+import time
+from aiortc import MediaStreamTrack
+from aiortc.mediastreams import MediaStreamError
+from av import VideoFrame
+from frame_transforms import TransformEngine, parse_chain
+
+# weight of the newest sample in the moving averages
+AVERAGE_WEIGHT = 0.1
+
+# transform chains of the current worker process, by name
+_engines = {}
+
+
+def _process_in_worker(names, array, pts, time_base):
+    # runs in a pool process, where frames arrive as yuv420p arrays
+    engine = _engines.get(names)
+    if engine is None:
+        engine = _engines[names] = TransformEngine(parse_chain(names), pool_size=1)
+    frame = VideoFrame.from_ndarray(array, format="yuv420p")
+    # transforms such as rotate depend on the frame time
+    frame.pts = pts
+    frame.time_base = time_base
+    return engine.process(frame).to_ndarray(format="yuv420p")
+
+
+class WorkerPool:
+    """
+    A thread or process pool running transforms for any number of tracks.
+
+    Threads suit the OpenCV transforms, which release the GIL. Processes
+    also run Python-heavy transforms in parallel, at the cost of copying
+    each frame to and from the worker.
+
+    mode: "thread" or "process"
+    workers: pool size, the number of CPUs by default
+    """
+
+    def __init__(self, mode="thread", workers=None):
+        if mode not in ("thread", "process"):
+            raise Exception(f"Unknown worker pool mode: {mode}")
+        self.mode = mode
+        workers = workers or os.cpu_count()
+        if mode == "thread":
+            self._executor = concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix="transform")
+        else:
+            self._executor = concurrent.futures.ProcessPoolExecutor(workers)
+
+    async def run(self, engine, names, frame):
+        loop = asyncio.get_running_loop()
+        if self.mode == "thread":
+            # each track has its own engine and processes one frame at a time
+            return await loop.run_in_executor(self._executor, engine.process, frame)
+        if frame.format.name != "yuv420p":
+            frame = frame.reformat(format="yuv420p")
+        array = await loop.run_in_executor(
+            self._executor, _process_in_worker, names, frame.to_ndarray(format="yuv420p"), frame.pts, frame.time_base)
+        new_frame = VideoFrame.from_ndarray(array, format="yuv420p")
+        new_frame.pts = frame.pts
+        new_frame.time_base = frame.time_base
+        return new_frame
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+class LatestFrameSlot:
+    """
+    Holds the most recent frame only. put replaces a frame nobody has taken
+    yet and returns it, or None.
+    """
+
+    def __init__(self):
+        self._item = None
+        self._event = asyncio.Event()
+
+    def __len__(self):
+        return 0 if self._item is None else 1
+
+    def put(self, item):
+        replaced = self._item
+        self._item = item
+        self._event.set()
+        return replaced
+
+    async def get(self):
+        await self._event.wait()
+        item, self._item = self._item, None
+        self._event.clear()
+        return item
+
+
+class TrackMetrics:
+    """
+    Counters and moving averages of one offloaded track.
+
+    received: frames read from the source
+    processed: frames transformed
+    dropped: frames replaced before being transformed or sent
+    processing_ms: average time spent in the transform
+    latency_ms: average time from a frame arriving to it being sent
+    """
+
+    def __init__(self):
+        self.received = 0
+        self.processed = 0
+        self.dropped = 0
+        self.processing_ms = 0.0
+        self.latency_ms = 0.0
+
+    @staticmethod
+    def _average(current, sample):
+        return sample if current == 0 else current + AVERAGE_WEIGHT * (sample - current)
+
+    def add_processing(self, ms):
+        self.processed += 1
+        self.processing_ms = self._average(self.processing_ms, ms)
+
+    def add_latency(self, ms):
+        self.latency_ms = self._average(self.latency_ms, ms)
+
+
+class OffloadedTransformTrack(MediaStreamTrack):
+    """
+    A video track transforming the frames of another track on a WorkerPool.
+    Frames are read, transformed and sent in a pipeline, each stage keeping
+    only the latest frame, so the next frame is transformed while the
+    previous one is being encoded.
+
+    On a thread pool, output frames are reused: a frame returned by recv is
+    written again once recv is called for the next one, as the sender does
+    after encoding it. Frames dropped before being sent are reused at once.
+
+    track: video track to read from
+    transform: transform names joined by "+", see frame_transforms
+    pool: WorkerPool to run the transform on
+    """
+
+    kind = "video"
+
+    def __init__(self, track, transform, pool):
+        super().__init__()
+        self.track = track
+        self.transform = transform
+        self.metrics = TrackMetrics()
+        self._pool = pool
+        # one output frame being encoded, one waiting to be sent, one being written
+        self._engine = TransformEngine(
+            parse_chain(transform), pool_size=3, recycle=True) if pool.mode == "thread" else None
+        self._input = LatestFrameSlot()
+        self._output = LatestFrameSlot()
+        self._tasks = []
+        # the frame last returned by recv, not to be written until the next recv
+        self._sent = None
+
+    @property
+    def queue_depth(self):
+        return len(self._input) + len(self._output)
+
+    def metrics_dict(self):
+        return {
+            "transform": self.transform,
+            "queue_depth": self.queue_depth,
+            "received": self.metrics.received,
+            "processed": self.metrics.processed,
+            "dropped": self.metrics.dropped,
+            "processing_ms": round(self.metrics.processing_ms, 2),
+            "latency_ms": round(self.metrics.latency_ms, 2),
+        }
+
+    def _start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._read()), asyncio.create_task(self._process())]
+
+    async def _read(self):
+        try:
+            while True:
+                frame = await self.track.recv()
+                self.metrics.received += 1
+                if self._input.put((time.perf_counter(), frame)):
+                    self.metrics.dropped += 1
+        except MediaStreamError:
+            self._input.put(None)
+
+    async def _process(self):
+        while True:
+            item = await self._input.get()
+            if item is None:
+                self._output.put(None)
+                return
+            arrived, frame = item
+            start = time.perf_counter()
+            try:
+                frame = await self._pool.run(self._engine, self.transform, frame)
+            except Exception as e:
+                logging.error(f"Transform {self.transform} failed: {e}")
+                self.metrics.dropped += 1
+                continue
+            self.metrics.add_processing((time.perf_counter() - start) * 1000)
+            replaced = self._output.put((arrived, frame))
+            if replaced:
+                self.metrics.dropped += 1
+                self._release(replaced[1])
+
+    def _release(self, frame):
+        if self._engine is not None:
+            self._engine.release(frame)
+
+    async def recv(self):
+        if self.readyState != "live":
+            raise MediaStreamError
+        self._start()
+        if self._sent is not None:
+            self._release(self._sent)
+            self._sent = None
+        item = await self._output.get()
+        if item is None:
+            self.stop()
+            raise MediaStreamError
+        arrived, frame = item
+        self.metrics.add_latency((time.perf_counter() - arrived) * 1000)
+        self._sent = frame
+        return frame
+
+    def stop(self):
+        super().stop()
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
@@ -0,0 +1,249 @@
+"""
+Ultra-low-latency sending of decoded video, for headsets that show frames
+as soon as they arrive.
+
+A LowLatencyTrack reads its source as fast as frames come, stamps each with
+the time it was captured and keeps only the latest, so the encoder always
+gets the newest frame and its RTP timestamps follow the capture instead of
+the encoder. Frames that would reach the receiver later than max_delay
+after capture are skipped before being encoded, as long as a fresh frame
+could still make it.
+
+A Pacer spreads the packets of each encoded frame over up to MAX_SPREAD
+seconds, at PACING_FACTOR times the encoder's bitrate, instead of sending
+them in one burst that switches and Wi-Fi links queue or drop, and tells
+the track how long encoding and sending take.
+
+On the receiving side, tune_receiver makes an aiortc receiver decode a
+frame as soon as its last packet is in. Its jitter buffer otherwise waits
+for the first packet of the next frame, a frame interval later.
+"""
+import asyncio
+import fractions
+import time
+import numpy as np
+from av import VideoFrame
+from aiortc import MediaStreamTrack
+from aiortc.jitterbuffer import JitterBuffer, JitterFrame
+from aiortc.mediastreams import MediaStreamError
+from aiortc.rtp import is_rtcp
+from metrics import CAPTURE_TO_SEND_SECONDS, LOW_LATENCY_FRAMES_SKIPPED
+
+# seconds from capture until the last packet of a frame reaches the
+# receiver, taken as sent plus half the round trip
+MAX_DELAY = 0.1
+# packets are sent at this multiple of the encoder's bitrate, as in libwebrtc
+PACING_FACTOR = 2.5
+# seconds the packets of a frame are spread over at most
+MAX_SPREAD = 0.015
+# bitrate assumed before the encoder exists, aiortc's default for video
+DEFAULT_BITRATE = 1000000
+# weight of the newest sample in the encode and send time estimates
+SMOOTHING = 0.2
+VIDEO_CLOCK_RATE = 90000
+VIDEO_TIME_BASE = fractions.Fraction(1, VIDEO_CLOCK_RATE)
+
+
+def _copy(frame):
+    """
+    A copy of a video frame, for frames other tracks may share, e.g. through
+    a MediaRelay.
+    """
+    copy = VideoFrame(frame.width, frame.height, frame.format.name)
+    copy.colorspace = frame.colorspace
+    copy.color_range = frame.color_range
+    for source, target in zip(frame.planes, copy.planes):
+        if source.line_size == target.line_size:
+            target.update(source)
+            continue
+        # rows are padded differently, so copy the part both have
+        width = min(source.line_size, target.line_size)
+        rows = [
+            np.frombuffer(plane, np.uint8, count=plane.height * plane.line_size).reshape(plane.height, plane.line_size)
+            for plane in (source, target)]
+        rows[1][:, :width] = rows[0][:, :width]
+    return copy
+
+
+class LowLatencyTrack(MediaStreamTrack):
+    """
+    Passes on the latest frame of a decoded video track, timestamped at
+    capture, skipping frames that could not be sent within max_delay.
+
+    track: decoded video track to read from
+    max_delay: seconds from capture until the last packet of a frame
+        reaches the receiver
+    """
+
+    kind = "video"
+
+    def __init__(self, track, max_delay=MAX_DELAY):
+        super().__init__()
+        self.max_delay = max_delay
+        # estimates kept up to date by the Pacer of the sender
+        self.encode_time = 0.0
+        self.send_time = 0.0
+        # capture time of the frame last returned, and when it was returned
+        self.captured = None
+        self.returned = None
+        self._track = track
+        self._latest = None
+        self._new_frame = asyncio.Event()
+        self._ended = False
+        self._reader = None
+        self._start = None
+
+    async def _read(self):
+        try:
+            while True:
+                frame = await self._track.recv()
+                now = time.monotonic()
+                if self._start is None:
+                    self._start = now
+                if self._latest is not None:
+                    LOW_LATENCY_FRAMES_SKIPPED.inc(("replaced",))
+                self._latest = (frame, now)
+                self._new_frame.set()
+        except MediaStreamError:
+            self._ended = True
+            self._new_frame.set()
+
+    async def recv(self):
+        if self.readyState != "live":
+            raise MediaStreamError
+        if self._reader is None:
+            self._reader = asyncio.ensure_future(self._read())
+        while True:
+            await self._new_frame.wait()
+            self._new_frame.clear()
+            if self._latest is None and self._ended:
+                self.stop()
+                raise MediaStreamError
+            if self._latest is None:
+                continue
+            frame, captured = self._latest
+            self._latest = None
+            now = time.monotonic()
+            # the part of the delay a fresh frame would have too
+            ahead = self.encode_time + self.send_time
+            if now - captured + ahead > self.max_delay and ahead < self.max_delay:
+                LOW_LATENCY_FRAMES_SKIPPED.inc(("late",))
+                continue
+            self.captured = captured
+            self.returned = now
+            # the source's frame may be shared, so only a copy is restamped
+            frame = _copy(frame)
+            frame.pts = int((captured - self._start) * VIDEO_CLOCK_RATE)
+            frame.time_base = VIDEO_TIME_BASE
+            return frame
+
+    def stop(self):
+        super().stop()
+        if self._reader:
+            self._reader.cancel()
+        self._track.stop()
+
+
+class Pacer:
+    """
+    Paces the RTP packets a sender sends for a LowLatencyTrack and measures
+    how long frames take from capture to the network.
+
+    sender: RTCRtpSender of the track, not negotiated yet
+    track: LowLatencyTrack feeding the sender, possibly through other
+        tracks that pass its frames on
+    """
+
+    def __init__(self, sender, track):
+        self.sender = sender
+        self.track = track
+        # when the next packet of the current frame may be sent, and the gap after it
+        self._next_send = 0.0
+        self._gap = 0.0
+        self._remaining = 0
+        self._captured = None
+
+        next_encoded_frame = sender._next_encoded_frame
+        send = sender.send
+
+        async def encoded(codec):
+            frame = await next_encoded_frame(codec)
+            if frame is not None:
+                self._start_frame(frame)
+            return frame
+
+        async def negotiated(parameters):
+            await send(parameters)
+            self._pace(sender.transport)
+
+        sender._next_encoded_frame = encoded
+        sender.send = negotiated
+
+    def _start_frame(self, frame):
+        track = self.track
+        now = time.monotonic()
+        if track.returned is not None:
+            track.encode_time += SMOOTHING * (now - track.returned - track.encode_time)
+        encoder = getattr(self.sender, "_RTCRtpSender__encoder", None)
+        bitrate = getattr(encoder, "target_bitrate", None) or DEFAULT_BITRATE
+        size = sum(len(payload) for payload in frame.payloads)
+        spread = min(size * 8 / (PACING_FACTOR * bitrate), MAX_SPREAD)
+        self._gap = spread / len(frame.payloads)
+        self._next_send = now
+        self._remaining = len(frame.payloads)
+        self._captured = track.captured
+        # half the round trip from receiver reports, once there is one
+        rtt = getattr(self.sender, "_RTCRtpSender__rtt", None) or 0.0
+        track.send_time += SMOOTHING * (spread + rtt / 2 - track.send_time)
+
+    def _pace(self, transport):
+        # the transport is shared with the other senders of the connection
+        # and with RTCP, so only this sender's media packets are paced
+        send_rtp = transport._send_rtp
+        ssrc = self.sender._ssrc.to_bytes(4, "big")
+
+        async def paced(data):
+            if is_rtcp(data) or data[8:12] != ssrc or not self._remaining:
+                await send_rtp(data)
+                return
+            delay = self._next_send - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self._next_send += self._gap
+            await send_rtp(data)
+            self._remaining -= 1
+            if not self._remaining and self._captured is not None:
+                CAPTURE_TO_SEND_SECONDS.observe(time.monotonic() - self._captured)
+
+        transport._send_rtp = paced
+
+
+class MarkerJitterBuffer(JitterBuffer):
+    """
+    A video jitter buffer that hands on a frame once the packet with the
+    marker bit, the last of the frame, is in. Frames whose last packet is
+    lost are still handed on when the next frame starts, as before.
+    """
+
+    def _remove_frame(self, sequence_number):
+        packets = []
+        for count in range(self.capacity):
+            packet = self._packets[(self._origin + count) % self.capacity]
+            if packet is None or (packets and packet.timestamp != packets[0].timestamp):
+                break
+            packets.append(packet)
+            if packet.marker:
+                self.remove(count + 1)
+                return JitterFrame(data=b"".join(p._data for p in packets), timestamp=packet.timestamp)
+        return super()._remove_frame(sequence_number)
+
+
+def tune_receiver(receiver):
+    """
+    Make a video RTCRtpReceiver decode frames as soon as they are complete.
+    Call it before the first packet is received, e.g. on the "track" event.
+    """
+    if receiver.track is None or receiver.track.kind != "video":
+        return
+    capacity = receiver._RTCRtpReceiver__jitter_buffer.capacity
+    receiver._RTCRtpReceiver__jitter_buffer = MarkerJitterBuffer(capacity=capacity, is_video=True)
@@ -0,0 +1,313 @@
+"""
+Pre-indexed, zero-decode file streaming.
+
+Indexing demuxes a media file once and writes two sidecar files next to it:
+the video elementary stream in Annex B form (<file>.es) and a JSON index of
+packet offsets, timestamps and keyframes (<file>.idx). Sidecars are written
+to temporary files and renamed into place, so a stream already memory-mapped
+by this or another process is never truncated under it. Streaming then reads
+packets straight out of a memory map of the elementary stream, so any number
+of peers can play the file, start at the nearest keyframe and loop without
+touching the demuxer or a decoder.
+
+    python media_index.py big_buck_bunny_720p_1mb.mp4
+"""
+import asyncio
+import bisect
+import fractions
+import json
+import logging
+import mmap
+import os
+import sys
+import tempfile
+import threading
+import time
+import av
+from aiortc import MediaStreamTrack
+from aiortc.mediastreams import MediaStreamError
+
+INDEX_VERSION = 2
+START_CODE = b"\x00\x00\x00\x01"
+# codecs whose packets aiortc can send as they are
+CODECS = {"h264": "video/H264", "vp8": "video/VP8"}
+
+_sources = {}
+# path -> future of a source being opened in the executor
+_opening = {}
+# one lock per path, so concurrent opens of a file share one build
+_locks = {}
+_locks_lock = threading.Lock()
+
+
+def _index_path(path):
+    return path + ".idx"
+
+
+def _stream_path(path):
+    return path + ".es"
+
+
+def _avcc_parameter_sets(extradata):
+    """
+    Read the NAL length size and the SPS/PPS from an avcC record.
+    """
+    length_size = (extradata[4] & 0x03) + 1
+    parameter_sets = []
+    offset = 5
+    for count_mask in (0x1F, 0xFF):
+        count = extradata[offset] & count_mask
+        offset += 1
+        for _ in range(count):
+            size = int.from_bytes(extradata[offset:offset + 2], "big")
+            offset += 2
+            parameter_sets.append(extradata[offset:offset + size])
+            offset += size
+    return length_size, parameter_sets
+
+
+def _avcc_to_annexb(data, length_size):
+    nal_units = []
+    offset = 0
+    while offset + length_size <= len(data):
+        size = int.from_bytes(data[offset:offset + length_size], "big")
+        offset += length_size
+        nal_units.append(START_CODE + data[offset:offset + size])
+        offset += size
+    return b"".join(nal_units)
+
+
+def _write_atomic(path, write):
+    """
+    Write a file through a temporary file in the same directory and rename
+    it over path, so readers see either the old file or the new one.
+    """
+    fd, temp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=os.path.basename(path) + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            result = write(f)
+        # mkstemp creates the file readable by its owner only
+        os.chmod(temp, 0o644)
+        os.replace(temp, path)
+    except BaseException:
+        os.unlink(temp)
+        raise
+    return result
+
+
+def build_index(path):
+    """
+    Demux the video of a file and write its Annex B stream and index sidecars.
+    """
+    with av.open(path) as container:
+        stream = container.streams.video[0]
+        codec = stream.codec_context.name
+        if codec not in CODECS:
+            raise Exception(f"Cannot stream {codec} without decoding")
+        extradata = stream.codec_context.extradata or b""
+        # MP4/MKV store H.264 as length-prefixed NAL units, MPEGTS as Annex B
+        avcc = codec == "h264" and extradata[:1] == b"\x01"
+        if avcc:
+            length_size, parameter_sets = _avcc_parameter_sets(extradata)
+            parameter_sets = b"".join(START_CODE + ps for ps in parameter_sets)
+
+        def write_stream(es):
+            packets = []
+            offset = 0
+            for packet in container.demux(stream):
+                if packet.size == 0 or packet.dts is None:
+                    continue
+                data = bytes(packet)
+                if avcc:
+                    data = _avcc_to_annexb(data, length_size)
+                    if packet.is_keyframe:
+                        data = parameter_sets + data
+                es.write(data)
+                pts = packet.pts if packet.pts is not None else packet.dts
+                packets.append([offset, len(data), pts, packet.dts, int(packet.is_keyframe)])
+                offset += len(data)
+            return packets, offset
+
+        packets, stream_size = _write_atomic(_stream_path(path), write_stream)
+
+    if not packets:
+        raise Exception(f"No video packets found in {path}")
+    time_base = stream.time_base
+    # one frame past the last packet, so looping keeps a steady cadence
+    frame_duration = (packets[-1][3] - packets[0][3]) // max(len(packets) - 1, 1)
+    stat = os.stat(path)
+    index = {
+        "version": INDEX_VERSION,
+        "source": {"size": stat.st_size, "mtime": stat.st_mtime},
+        "codec": codec,
+        "time_base": [time_base.numerator, time_base.denominator],
+        "frame_duration": frame_duration,
+        "stream_size": stream_size,
+        "packets": packets,
+    }
+    _write_atomic(_index_path(path), lambda f: f.write(json.dumps(index, separators=(",", ":")).encode()))
+    logging.info(f"Indexed {len(packets)} packets of {path}")
+    return index
+
+
+def load_index(path):
+    """
+    Load the index of a file, rebuilding it if it is missing or stale.
+    """
+    try:
+        with open(_index_path(path)) as f:
+            index = json.load(f)
+        stat = os.stat(path)
+        if (index.get("version") == INDEX_VERSION
+                and index["source"] == {"size": stat.st_size, "mtime": stat.st_mtime}
+                and os.path.getsize(_stream_path(path)) == index["stream_size"]):
+            return index
+    except (OSError, ValueError, KeyError):
+        pass
+    return build_index(path)
+
+
+class IndexedSource:
+    """
+    A memory-mapped elementary stream and its index, shared by every track
+    playing the same file.
+    """
+
+    def __init__(self, path):
+        index = load_index(path)
+        self._file = open(_stream_path(path), "rb")
+        if os.fstat(self._file.fileno()).st_size != index["stream_size"]:
+            # another process rebuilt the sidecars between reading the index
+            # and opening the stream
+            self._file.close()
+            index = build_index(path)
+            self._file = open(_stream_path(path), "rb")
+        self.path = path
+        self.codec = CODECS[index["codec"]]
+        self.time_base = fractions.Fraction(*index["time_base"])
+        self.frame_duration = index["frame_duration"]
+        self.packets = index["packets"]
+        self.keyframes = [i for i, p in enumerate(self.packets) if p[4]]
+        self._keyframe_dts = [self.packets[i][3] for i in self.keyframes]
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return len(self.packets)
+
+    def keyframe_at(self, seconds):
+        """
+        Index of the last keyframe at or before the given position.
+        """
+        dts = self.packets[0][3] + int(seconds / self.time_base)
+        i = bisect.bisect_right(self._keyframe_dts, dts) - 1
+        return self.keyframes[max(i, 0)]
+
+    def packet(self, i):
+        offset, size, pts, dts, keyframe = self.packets[i]
+        packet = av.Packet(self._mmap[offset:offset + size])
+        packet.time_base = self.time_base
+        return packet, pts, dts
+
+    def close(self):
+        self._mmap.close()
+        self._file.close()
+
+
+def open_source(path):
+    """
+    The IndexedSource of a file, indexing it first if needed. Safe to call
+    from several threads: the file is indexed and mapped once, and a source
+    once open is never rebuilt.
+    """
+    path = os.path.abspath(path)
+    with _locks_lock:
+        lock = _locks.setdefault(path, threading.Lock())
+    with lock:
+        source = _sources.get(path)
+        if source is None:
+            source = _sources[path] = IndexedSource(path)
+    return source
+
+
+async def open_source_async(path):
+    """
+    open_source in the executor, so indexing never blocks the event loop.
+    Concurrent calls for the same file share one open, decided on the loop
+    before anything is handed to the executor.
+    """
+    path = os.path.abspath(path)
+    source = _sources.get(path)
+    if source is not None:
+        return source
+    opening = _opening.get(path)
+    if opening is None:
+        opening = _opening[path] = asyncio.get_running_loop().run_in_executor(None, open_source, path)
+    try:
+        return await asyncio.shield(opening)
+    finally:
+        if _opening.get(path) is opening:
+            del _opening[path]
+
+
+class IndexedPacketTrack(MediaStreamTrack):
+    """
+    A video track that paces pre-encoded packets out of an IndexedSource in
+    real time.
+
+    start: position in seconds, rounded down to the nearest keyframe
+    loop: restart from the beginning when the end is reached
+    """
+
+    kind = "video"
+
+    def __init__(self, source, start=0, loop=True):
+        super().__init__()
+        self.codec = source.codec
+        self._source = source
+        self._loop = loop
+        self._start_time = None
+        self._next_dts = 0
+        self._offset = 0
+        self._position = 0
+        self.seek(start)
+
+    def seek(self, seconds):
+        """
+        Continue from the keyframe at or before the given position without a
+        jump in the outgoing timestamps.
+        """
+        self._reposition(self._source.keyframe_at(seconds))
+
+    def _reposition(self, i):
+        self._position = i
+        self._offset = self._next_dts - self._source.packets[i][3]
+
+    async def recv(self):
+        if self.readyState != "live":
+            raise MediaStreamError
+
+        if self._position >= len(self._source):
+            if not self._loop:
+                self.stop()
+                raise MediaStreamError
+            self._reposition(0)
+
+        packet, pts, dts = self._source.packet(self._position)
+        self._position += 1
+        packet.pts = pts + self._offset
+        packet.dts = dts + self._offset
+        self._next_dts = packet.dts + self._source.frame_duration
+
+        # send packets at the rate they were recorded at
+        if self._start_time is None:
+            self._start_time = time.time() - float(packet.dts * self._source.time_base)
+        wait = self._start_time + float(packet.dts * self._source.time_base) - time.time()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return packet
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    for path in sys.argv[1:]:
+        build_index(path)
@@ -0,0 +1,282 @@
+"""
+Process-wide metrics in the Prometheus text format, without depending on
+prometheus_client.
+
+Counters and summaries are updated inline and only cost a dict update, so
+they can sit on per-message and per-frame paths. Anything that has to be
+collected, such as getStats() of every peer connection, is sampled in the
+background by StatsSampler or read by collectors when /metrics is scraped.
+"""
+import asyncio
+import logging
+import threading
+import time
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+SAMPLE_INTERVAL = 5
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Metric:
+    """
+    A metric family. Values are kept per tuple of label values, in the
+    order of labelnames.
+    """
+
+    type = "untyped"
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._values = {}
+
+    def clear(self):
+        self._values = {}
+
+    def _format_labels(self, labels):
+        if not labels:
+            return ""
+        return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in zip(self.labelnames, labels)) + "}"
+
+    def samples(self):
+        for labels, value in self._values.items():
+            yield self.name, self._format_labels(labels), value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        lines += [f"{name}{labels} {value}" for name, labels, value in self.samples()]
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, labels=(), amount=1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value, labels=()):
+        self._values[labels] = value
+
+
+class Summary(Metric):
+    """
+    Count and sum of observations, e.g. durations in seconds, from which
+    Prometheus derives averages over any window. Observations may come from
+    any thread, such as aiortc's encoder and decoder threads.
+    """
+
+    type = "summary"
+
+    def __init__(self, name, help, labelnames=()):
+        super().__init__(name, help, labelnames)
+        self._lock = threading.Lock()
+
+    def observe(self, value, labels=()):
+        with self._lock:
+            count, total = self._values.get(labels, (0, 0.0))
+            self._values[labels] = (count + 1, total + value)
+
+    def samples(self):
+        # new labels may be added by another thread while rendering
+        with self._lock:
+            values = list(self._values.items())
+        for labels, (count, total) in values:
+            formatted = self._format_labels(labels)
+            yield self.name + "_count", formatted, count
+            yield self.name + "_sum", formatted, total
+
+
+class Registry:
+    """
+    Metrics to render on /metrics, and collectors called just before
+    rendering to refresh gauges that are cheaper to read on demand.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._collectors = []
+
+    def _add(self, cls, name, help, labelnames):
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = self._metrics[name] = cls(name, help, labelnames)
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self._add(Counter, name, help, labelnames)
+
+    def gauge(self, name, help, labelnames=()):
+        return self._add(Gauge, name, help, labelnames)
+
+    def summary(self, name, help, labelnames=()):
+        return self._add(Summary, name, help, labelnames)
+
+    def add_collector(self, collector):
+        self._collectors.append(collector)
+
+    def render(self):
+        for collector in self._collectors:
+            try:
+                collector()
+            except Exception as e:
+                logging.error(f"Metrics collector failed: {e}")
+        return "\n".join(metric.render() for metric in self._metrics.values()) + "\n"
+
+
+registry = Registry()
+
+SIGNALING_MESSAGES = registry.counter(
+    "tom_signaling_messages_total", "Signaling messages handled by peer connections", ("direction", "type"))
+SESSIONS = registry.gauge("tom_sessions", "Sessions currently open")
+ENCODE_SECONDS = registry.summary("tom_encode_seconds", "Time spent encoding a frame", ("codec",))
+DECODE_SECONDS = registry.summary("tom_decode_seconds", "Time spent decoding a frame", ("codec",))
+SIGNALING_QUEUE_DEPTH = registry.gauge(
+    "tom_signaling_queue_depth", "Signaling messages received but not handled yet", ("peer",))
+BROADCAST_QUEUE_DEPTH = registry.gauge(
+    "tom_broadcast_queue_depth", "Packets waiting in the deepest subscriber queue of a broadcast", ("source", "codec"))
+SFU_PACKETS_FORWARDED = registry.counter(
+    "tom_sfu_packets_forwarded_total", "RTP packets forwarded to subscribers", ("kind",))
+SFU_KEYFRAME_REQUESTS = registry.counter(
+    "tom_sfu_keyframe_requests_total", "Keyframe requests from subscribers, sent on or aggregated", ("result",))
+SFU_RETRANSMISSIONS = registry.counter(
+    "tom_sfu_retransmissions_total", "NACKed packets resent from the cache or missing from it", ("result",))
+CAPTURE_TO_SEND_SECONDS = registry.summary(
+    "tom_capture_to_send_seconds", "Time from capture to the last packet of a frame sent, in low latency mode")
+LOW_LATENCY_FRAMES_SKIPPED = registry.counter(
+    "tom_low_latency_frames_skipped_total", "Frames not encoded, replaced by a newer one or too late", ("reason",))
+
+# from getStats(), per peer and track kind
+PACKETS_SENT = registry.gauge("tom_rtp_packets_sent", "RTP packets sent", ("peer", "kind"))
+BYTES_SENT = registry.gauge("tom_rtp_bytes_sent", "RTP payload bytes sent", ("peer", "kind"))
+PACKETS_RECEIVED = registry.gauge("tom_rtp_packets_received", "RTP packets received", ("peer", "kind"))
+PACKETS_LOST = registry.gauge("tom_rtp_packets_lost", "RTP packets lost, as seen by the receiving end", ("peer", "kind", "direction"))
+JITTER = registry.gauge("tom_rtp_jitter", "Interarrival jitter in RTP timestamp units", ("peer", "kind", "direction"))
+ROUND_TRIP_TIME = registry.gauge("tom_rtp_round_trip_time_seconds", "Round trip time from receiver reports", ("peer", "kind"))
+FRACTION_LOST = registry.gauge("tom_rtp_fraction_lost", "Fraction of packets lost in the last receiver report", ("peer", "kind"))
+
+SAMPLED_GAUGES = (SIGNALING_QUEUE_DEPTH, PACKETS_SENT, BYTES_SENT, PACKETS_RECEIVED, PACKETS_LOST, JITTER,
+                  ROUND_TRIP_TIME, FRACTION_LOST)
+
+
+def record_stats(peer, report):
+    """
+    Set the getStats() gauges of one peer from its RTCStatsReport.
+    """
+    for stats in report.values():
+        labels = (peer, getattr(stats, "kind", ""))
+        if stats.type == "outbound-rtp":
+            PACKETS_SENT.set(stats.packetsSent, labels)
+            BYTES_SENT.set(stats.bytesSent, labels)
+        elif stats.type == "inbound-rtp":
+            PACKETS_RECEIVED.set(stats.packetsReceived, labels)
+            PACKETS_LOST.set(stats.packetsLost, labels + ("inbound",))
+            JITTER.set(stats.jitter, labels + ("inbound",))
+        elif stats.type == "remote-inbound-rtp":
+            PACKETS_LOST.set(stats.packetsLost, labels + ("outbound",))
+            JITTER.set(stats.jitter, labels + ("outbound",))
+            ROUND_TRIP_TIME.set(stats.roundTripTime, labels)
+            # receiver reports carry the fraction as 8 bit fixed point
+            FRACTION_LOST.set(stats.fractionLost / 256, labels)
+
+
+class StatsSampler:
+    """
+    Samples getStats() of every session every interval seconds, in the
+    background, so scraping /metrics never waits on peer connections.
+
+    sessions: SessionManager whose connections are sampled
+    interval: seconds between samples
+    """
+
+    def __init__(self, sessions, interval=SAMPLE_INTERVAL):
+        self._sessions = sessions
+        self._interval = interval
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+        self._task = None
+
+    async def sample(self):
+        peer_ids = self._sessions.peer_ids
+        connections = [self._sessions.get(peer_id) for peer_id in peer_ids]
+        reports = await asyncio.gather(*[c.get_stats() for c in connections], return_exceptions=True)
+        # peers that have gone drop out of the gauges
+        for gauge in SAMPLED_GAUGES:
+            gauge.clear()
+        for peer_id, connection, report in zip(peer_ids, connections, reports):
+            SIGNALING_QUEUE_DEPTH.set(connection.signaling_queue_depth, (peer_id,))
+            if isinstance(report, Exception) or report is None:
+                continue
+            record_stats(peer_id, report)
+        SESSIONS.set(len(self._sessions))
+
+    async def _run(self):
+        while True:
+            start = time.perf_counter()
+            try:
+                await self.sample()
+            except Exception as e:
+                logging.error(f"Sampling stats failed: {e}")
+            await asyncio.sleep(max(0, self._interval - (time.perf_counter() - start)))
+
+
+class _TimedCodec:
+    """
+    Wraps an aiortc encoder or decoder to time encode or decode, and passes
+    everything else, including target_bitrate, to the wrapped object.
+    """
+
+    def __init__(self, codec, method, summary, label):
+        object.__setattr__(self, "_codec", codec)
+        original = getattr(codec, method)
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                summary.observe(time.perf_counter() - start, (label,))
+
+        object.__setattr__(self, method, timed)
+
+    def __getattr__(self, name):
+        return getattr(self._codec, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._codec, name, value)
+
+
+def instrument_codecs():
+    """
+    Time every encoder and decoder aiortc creates from now on. aiortc has no
+    hook for this, so the factories its sender and receiver use are wrapped.
+    """
+    from aiortc import rtcrtpreceiver, rtcrtpsender
+    if getattr(rtcrtpsender.get_encoder, "instrumented", False):
+        return
+    get_encoder = rtcrtpsender.get_encoder
+    get_decoder = rtcrtpreceiver.get_decoder
+
+    def timed_encoder(codec):
+        return _TimedCodec(get_encoder(codec), "encode", ENCODE_SECONDS, codec.mimeType)
+
+    def timed_decoder(codec):
+        return _TimedCodec(get_decoder(codec), "decode", DECODE_SECONDS, codec.mimeType)
+
+    timed_encoder.instrumented = True
+    rtcrtpsender.get_encoder = timed_encoder
+    rtcrtpreceiver.get_decoder = timed_decoder
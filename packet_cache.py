@@ -0,0 +1,182 @@
+"""
+A shared store of recently sent or forwarded RTP packets, for answering
+NACKs.
+
+Every stream, by SSRC, gets a ring of size slots, and a packet goes to
+the slot of its sequence number modulo size, so storing and looking one
+up are a dict lookup and one struct pack or unpack in a preallocated
+table. Payloads are copied one after the other
+into a single preallocated buffer of capacity bytes, wrapping around, so
+storing never allocates and memory stays bounded however many streams
+there are. A packet is gone once its slot is reused, its bytes are
+overwritten or it is older than max_age seconds, which bounds the window
+in packets, bytes and time.
+
+aiortc keeps the last 128 packets of every sender as RtpPacket objects,
+well under a second of 720p video. cache_sent_packets makes a sender use
+this store instead.
+"""
+import array
+import struct
+import time
+from aiortc import clock
+from aiortc.rtp import RtpPacket, wrap_rtx
+
+# packets kept per stream, a power of two, about two seconds of 2 Mbps video
+SIZE = 1024
+# seconds a packet can be retransmitted for
+MAX_AGE = 2.0
+# payload bytes kept across all streams, about two seconds of 32 Mbps
+CAPACITY = 8 * 1024 * 1024
+# streams kept at once, the least recently written is replaced beyond that
+MAX_STREAMS = 128
+
+# sequence number plus one, 0 for an empty slot, timestamp, offset of the
+# payload, its length, payload type with the marker bit in 0x80, and when
+# the packet was stored
+SLOT = struct.Struct("<IIqHBd")
+
+
+class PacketCache:
+    """
+    The latest packets of up to max_streams RTP streams.
+
+    size: packets kept per stream, a power of two so that sequence
+        numbers wrap onto the same slots
+    max_age: seconds after which a packet is no longer returned
+    capacity: payload bytes kept across all streams
+    max_streams: streams kept at once
+    """
+
+    def __init__(self, size=SIZE, max_age=MAX_AGE, capacity=CAPACITY, max_streams=MAX_STREAMS):
+        if size & (size - 1) or size > 65536:
+            raise Exception(f"Packet cache size {size} is not a power of two up to 65536")
+        self.size = size
+        self.max_age = max_age
+        self.capacity = capacity
+        slots = size * max_streams
+        self._payloads = bytearray(capacity)
+        self._view = memoryview(self._payloads)
+        # bytes written so far; payload offsets count from the first byte
+        # ever written, so an offset more than capacity behind is overwritten
+        self._head = 0
+        self._slots = bytearray(SLOT.size * slots)
+        # ssrc -> stream number, and when each stream was last written
+        self._streams = {}
+        self._stream_times = array.array("d", [0.0]) * max_streams
+        self._free = list(range(max_streams - 1, -1, -1))
+
+    def _add_stream(self, ssrc):
+        if not self._free:
+            # replace the stream written to least recently
+            self.remove(min(self._streams, key=lambda s: self._stream_times[self._streams[s]]))
+        stream = self._streams[ssrc] = self._free.pop()
+        return stream
+
+    def put(self, packet):
+        """
+        Store a copy of an RtpPacket.
+        """
+        payload = packet.payload
+        length = len(payload)
+        capacity = self.capacity
+        if length > capacity // 2:
+            return
+        stream = self._streams.get(packet.ssrc)
+        if stream is None:
+            stream = self._add_stream(packet.ssrc)
+        now = time.monotonic()
+        self._stream_times[stream] = now
+        head = self._head
+        position = head % capacity
+        if position + length > capacity:
+            # payloads are never split, so skip to the start
+            head += capacity - position
+            position = 0
+        self._view[position:position + length] = payload
+        slot = stream * self.size + (packet.sequence_number & (self.size - 1))
+        SLOT.pack_into(self._slots, slot * SLOT.size, packet.sequence_number + 1, packet.timestamp, head, length,
+                       packet.payload_type | (0x80 if packet.marker else 0), now)
+        self._head = head + length
+
+    def get(self, ssrc, sequence_number):
+        """
+        A new RtpPacket with the stored header fields and payload, or None
+        if the packet was never stored, was overwritten or is too old.
+        """
+        stream = self._streams.get(ssrc)
+        if stream is None:
+            return None
+        slot = stream * self.size + (sequence_number & (self.size - 1))
+        stored, timestamp, offset, length, kind, stored_at = SLOT.unpack_from(self._slots, slot * SLOT.size)
+        if (stored != sequence_number + 1
+                or self._head - offset > self.capacity
+                or time.monotonic() - stored_at > self.max_age):
+            return None
+        position = offset % self.capacity
+        return RtpPacket(
+            payload_type=kind & 0x7F,
+            marker=kind >> 7,
+            sequence_number=sequence_number,
+            timestamp=timestamp,
+            ssrc=ssrc,
+            payload=bytes(self._view[position:position + length]),
+        )
+
+    def remove(self, ssrc):
+        """
+        Forget the packets of a stream and free its slots.
+        """
+        stream = self._streams.pop(ssrc, None)
+        if stream is None:
+            return
+        start = stream * self.size * SLOT.size
+        self._slots[start:start + self.size * SLOT.size] = bytes(self.size * SLOT.size)
+        self._free.append(stream)
+
+
+class _History:
+    """
+    Stands in for the history dict of a RTCRtpSender, storing what it
+    sends in a PacketCache.
+    """
+
+    def __init__(self, cache):
+        self._cache = cache
+
+    def __setitem__(self, key, packet):
+        self._cache.put(packet)
+
+    def get(self, key, default=None):
+        return default
+
+
+def cache_sent_packets(sender, store=None):
+    """
+    Keep the packets sender sends in store, the shared cache by default,
+    and answer NACKs from it instead of from aiortc's own history.
+    """
+    if store is None:
+        store = cache
+    sender._RTCRtpSender__rtp_history = _History(store)
+
+    async def retransmit(sequence_number):
+        packet = store.get(sender._ssrc, sequence_number)
+        if packet is None:
+            return
+        packet.extensions.abs_send_time = (clock.current_ntp_time() >> 14) & 0x00FFFFFF
+        packet.extensions.mid = sender._RTCRtpSender__mid
+        rtx_payload_type = sender._RTCRtpSender__rtx_payload_type
+        if rtx_payload_type is not None:
+            packet = wrap_rtx(packet, payload_type=rtx_payload_type,
+                              sequence_number=sender._RTCRtpSender__rtx_sequence_number, ssrc=sender._rtx_ssrc)
+            sender._RTCRtpSender__rtx_sequence_number = (sender._RTCRtpSender__rtx_sequence_number + 1) & 0xFFFF
+        try:
+            await sender.transport._send_rtp(packet.serialize(sender._RTCRtpSender__rtp_header_extensions_map))
+        except ConnectionError:
+            pass
+
+    sender._retransmit = retransmit
+
+
+cache = PacketCache()
@@ -0,0 +1,255 @@
+"""
+Records received tracks to Matroska or fragmented MP4 without decoding or
+re-encoding them.
+
+A Recorder taps the encoded frames a RTCRtpReceiver reassembles from RTP
+and hands to its decoder, so the recording never reads from the live
+track or a MediaRelay subscription and cannot slow either down. Frames
+are queued, up to a limit, for a writer thread that muxes them in
+batches and starts a new file every segment_seconds, at a keyframe.
+When the writer falls behind, frames are dropped until the next
+keyframe, so the recording skips ahead rather than holding back the
+live path. Keyframes needed to start a segment or resume are requested
+from the sender with a PLI.
+"""
+import asyncio
+import fractions
+import logging
+import os
+import queue
+import threading
+import av
+
+SEGMENT_SECONDS = 60
+# encoded frames waiting for the writer, a few seconds of video
+QUEUE_SIZE = 256
+RTP_TIMESTAMP_RANGE = 1 << 32
+
+# codec name in the SDP -> codec name for PyAV's muxer
+CODECS = {
+    "H264": "h264",
+    "VP8": "vp8",
+    "opus": "opus",
+}
+
+CONTAINERS = {
+    ".mkv": ("matroska", {}),
+    # fragments start at keyframes so an interrupted recording still plays
+    ".mp4": ("mp4", {"movflags": "frag_keyframe+empty_moov+default_base_moof"}),
+}
+
+
+def is_keyframe(codec_name, data):
+    """
+    Whether an encoded frame can be decoded on its own.
+    """
+    if codec_name == "VP8":
+        return len(data) > 0 and not data[0] & 0x01
+    if codec_name == "H264":
+        # IDR slice in the Annex B stream aiortc reassembles
+        start = data.find(b"\x00\x00\x01")
+        while start != -1 and start + 3 < len(data):
+            if data[start + 3] & 0x1F == 5:
+                return True
+            start = data.find(b"\x00\x00\x01", start + 3)
+        return False
+    return True
+
+
+def frame_size(codec_name, data):
+    # the muxers need the dimensions up front, so decode the keyframe once
+    context = av.CodecContext.create(CODECS[codec_name], "r")
+    for frame in context.decode(av.Packet(data)):
+        return frame.width, frame.height
+    return None
+
+
+class Recorder:
+    """
+    Records one received track to a series of segment files.
+
+    path: file name pattern, with a "{segment}" field for the segment
+        number, e.g. "recording-video-{segment:03}.mkv"; the extension picks
+        the container, one of CONTAINERS
+    segment_seconds: length of a segment before the next keyframe starts a
+        new one, 0 for a single file
+    queue_size: most frames waiting to be written before frames are dropped
+    """
+
+    def __init__(self, path, segment_seconds=SEGMENT_SECONDS, queue_size=QUEUE_SIZE):
+        extension = os.path.splitext(path)[1]
+        if extension not in CONTAINERS:
+            raise Exception(f"Cannot record to {extension} files, use one of {', '.join(CONTAINERS)}")
+        self.path = path
+        self.segment_seconds = segment_seconds
+        self.written = 0
+        self.dropped = 0
+        self.segments = []
+        self._format, self._options = CONTAINERS[extension]
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._waiting_for_keyframe = True
+        self._keyframe_requested = False
+        # RTP timestamps are 32 bits and start anywhere, so they are unwrapped
+        # into a count that keeps growing past 2**32
+        self._last_timestamp = None
+        self._extended_timestamp = None
+        # extended timestamp from which the next keyframe starts a new segment
+        self._next_segment = None
+        self._receiver = None
+        # PLIs being sent, kept until done so their failures are seen
+        self._pli_tasks = set()
+        self._thread = None
+        self._container = None
+        self._stream = None
+        self._segment_start = None
+
+    def tap(self, receiver):
+        """
+        Start recording the frames of receiver, before they are decoded.
+        """
+        # the decoder thread only ever gets from this queue, so wrapping put
+        # on the instance is enough to see every frame it is given
+        decoder_queue = receiver._RTCRtpReceiver__decoder_queue
+        put = decoder_queue.put
+
+        def tee(task, *args, **kwargs):
+            if task is not None:
+                codec, encoded_frame = task
+                self.write(codec, encoded_frame.data, encoded_frame.timestamp)
+            put(task, *args, **kwargs)
+
+        decoder_queue.put = tee
+        self._receiver = receiver
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="recorder", daemon=True)
+            self._thread.start()
+
+    def write(self, codec, data, timestamp):
+        """
+        Queue an encoded frame without ever blocking.
+
+        codec: RTCRtpCodecParameters of the frame
+        timestamp: RTP timestamp of the frame, in codec.clockRate units
+        """
+        if codec.name not in CODECS:
+            return
+        timestamp = self._unwrap(timestamp)
+        keyframe = is_keyframe(codec.name, data)
+        if self._waiting_for_keyframe and not keyframe:
+            self.dropped += 1
+            self._request_keyframe()
+            return
+        self._waiting_for_keyframe = False
+        new_segment = False
+        if keyframe:
+            self._keyframe_requested = False
+            if self._next_segment is None or (self.segment_seconds and timestamp >= self._next_segment):
+                new_segment = True
+                self._next_segment = timestamp + self.segment_seconds * codec.clockRate
+        elif self.segment_seconds and timestamp >= self._next_segment:
+            self._request_keyframe()
+        try:
+            self._queue.put_nowait((codec.name, codec.clockRate, data, timestamp, keyframe, new_segment))
+        except queue.Full:
+            # resume at a keyframe so the recording never has a broken picture
+            self.dropped += 1
+            self._waiting_for_keyframe = True
+            # the segment it would have started starts at the next keyframe
+            if new_segment:
+                self._next_segment = timestamp
+
+    def _unwrap(self, timestamp):
+        if self._last_timestamp is None:
+            self._extended_timestamp = timestamp
+        else:
+            # the shorter way round from the last timestamp, backwards for
+            # frames completed out of order
+            delta = (timestamp - self._last_timestamp) % RTP_TIMESTAMP_RANGE
+            if delta >= RTP_TIMESTAMP_RANGE // 2:
+                delta -= RTP_TIMESTAMP_RANGE
+            self._extended_timestamp += delta
+        self._last_timestamp = timestamp
+        return self._extended_timestamp
+
+    def _request_keyframe(self):
+        if self._keyframe_requested or self._receiver is None:
+            return
+        self._keyframe_requested = True
+        for ssrc in list(self._receiver._RTCRtpReceiver__remote_streams):
+            task = asyncio.ensure_future(self._receiver._send_rtcp_pli(ssrc))
+            self._pli_tasks.add(task)
+            task.add_done_callback(self._pli_sent)
+
+    def _pli_sent(self, task):
+        self._pli_tasks.discard(task)
+        if not task.cancelled() and task.exception():
+            logging.error(f"Requesting keyframe for recording failed: {task.exception()}")
+            # the next frame that needs one asks again
+            self._keyframe_requested = False
+
+    def stop(self):
+        """
+        Write out the queued frames and close the current segment.
+        """
+        if self._thread:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def _open(self, codec_name, clock_rate, data, timestamp):
+        path = self.path.format(segment=len(self.segments))
+        container = av.open(path, "w", format=self._format, options=self._options)
+        if codec_name == "opus":
+            stream = container.add_stream("opus", rate=clock_rate)
+        else:
+            size = frame_size(codec_name, data)
+            if size is None:
+                container.close()
+                return False
+            stream = container.add_stream(CODECS[codec_name])
+            stream.width, stream.height = size
+        stream.time_base = fractions.Fraction(1, clock_rate)
+        self._container, self._stream = container, stream
+        self._segment_start = timestamp
+        self.segments.append(path)
+        logging.info(f"Recording to {path}")
+        return True
+
+    def _close(self):
+        if self._container:
+            self._container.close()
+        self._container = None
+        self._stream = None
+
+    def _mux(self, codec_name, clock_rate, data, timestamp, keyframe, new_segment):
+        if new_segment:
+            self._close()
+            if not self._open(codec_name, clock_rate, data, timestamp):
+                return
+        if self._container is None:
+            return
+        packet = av.Packet(data)
+        packet.pts = packet.dts = timestamp - self._segment_start
+        packet.time_base = self._stream.time_base
+        packet.is_keyframe = keyframe
+        packet.stream = self._stream
+        self._container.mux(packet)
+        self.written += 1
+
+    def _run(self):
+        try:
+            while True:
+                # everything queued since the last wakeup is muxed in one go
+                batch = [self._queue.get()]
+                while not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+                for item in batch:
+                    if item is None:
+                        return
+                    try:
+                        self._mux(*item)
+                    except (av.FFmpegError, ValueError) as e:
+                        logging.error(f"Recording frame failed: {e}")
+        finally:
+            self._close()
+            logging.info(f"Recording stopped, {self.written} frames written, {self.dropped} dropped")
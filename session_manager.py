@@ -0,0 +1,141 @@
+import asyncio
+import logging
+import time
+from aiortc_connection import AiortcConnection
+
+DEFAULT_MAX_SESSIONS = 32
+
+
+class SessionLimitError(Exception):
+    pass
+
+
+class SessionExistsError(Exception):
+    pass
+
+
+class SessionNotFoundError(Exception):
+    pass
+
+
+class SessionManager:
+    """
+    Owns one AiortcConnection per peer so that a single process can serve
+    many Unity peers at once.
+
+    max_sessions: maximum number of concurrent calls admitted
+    connection_factory: callable taking the peer id and returning a new
+        AiortcConnection-like object
+    pool: optional WarmPool supplying prepared connections for calls made
+        without media options
+    """
+
+    def __init__(self, max_sessions=DEFAULT_MAX_SESSIONS, connection_factory=None, pool=None):
+        self._max_sessions = max_sessions
+        self._pool = pool
+        self._connection_factory = connection_factory or (
+            lambda peer_id: AiortcConnection(uid=peer_id))
+        if pool is not None and pool.connection_factory is None:
+            # pooled calls are made by the same factory as the others
+            pool.connection_factory = self._connection_factory
+        self._sessions = {}
+        # peers whose call is still being set up, counted against the limit
+        self._pending = set()
+        # websocket disconnects of sessions pruned in the background
+        self._disconnecting = set()
+
+    def __len__(self):
+        return len(self._sessions) + len(self._pending)
+
+    def __contains__(self, peer_id):
+        return peer_id in self._sessions or peer_id in self._pending
+
+    @property
+    def peer_ids(self):
+        return list(self._sessions)
+
+    def get(self, peer_id):
+        connection = self._sessions.get(peer_id)
+        if connection is None:
+            raise SessionNotFoundError(f"No session for peer {peer_id}")
+        return connection
+
+    def _prune(self):
+        # sessions cleared by the remote side (pcnull) free their slot
+        for peer_id, connection in list(self._sessions.items()):
+            if not connection.is_active:
+                del self._sessions[peer_id]
+                connection.stop_signaling()
+                task = asyncio.create_task(connection.disconnect_from_websocket())
+                self._disconnecting.add(task)
+                task.add_done_callback(self._disconnected)
+                logging.info(f"Session {peer_id} closed by remote peer")
+
+    def _disconnected(self, task):
+        self._disconnecting.discard(task)
+        if not task.cancelled() and task.exception():
+            logging.error(f"Disconnecting a pruned session failed: {task.exception()}")
+
+    def _admit(self, peer_id):
+        self._prune()
+        if peer_id in self:
+            raise SessionExistsError(f"Peer {peer_id} is already calling")
+        if len(self) >= self._max_sessions:
+            raise SessionLimitError(
+                f"Session limit of {self._max_sessions} reached")
+        self._pending.add(peer_id)
+
+    async def call(self, peer_id, **media_options):
+        """
+        Open a new session for the peer and send it an offer.
+
+        media_options: keyword arguments passed to AiortcConnection.get_media
+        """
+        self._admit(peer_id)
+        start = time.perf_counter()
+        connection = None
+        try:
+            if self._pool is not None and not media_options:
+                connection = await self._pool.acquire(peer_id)
+            else:
+                connection = self._connection_factory(peer_id)
+            await connection.connect_to_websocket()
+            connection.start_signaling()
+            if not connection.is_active:
+                connection.create_peer_connection()
+                connection.create_data_channel()
+                await connection.get_media(**media_options)
+            await connection.send_offer()
+        except Exception:
+            if connection:
+                await self._close(connection)
+            raise
+        finally:
+            self._pending.discard(peer_id)
+        self._sessions[peer_id] = connection
+        logging.info(
+            f"Session {peer_id} started, offer sent in {(time.perf_counter() - start) * 1000:.0f} ms ({len(self)} active)")
+        return connection
+
+    async def hangup(self, peer_id):
+        connection = self._sessions.pop(peer_id, None)
+        if connection is None:
+            raise SessionNotFoundError(f"No session for peer {peer_id}")
+        await self._close(connection)
+        logging.info(f"Session {peer_id} ended ({len(self)} active)")
+
+    def send_message(self, peer_id, message):
+        self.get(peer_id).send_message(message)
+
+    async def close_all(self):
+        connections = list(self._sessions.values())
+        self._sessions.clear()
+        await asyncio.gather(*[self._close(c) for c in connections])
+        await asyncio.gather(*self._disconnecting, return_exceptions=True)
+        logging.info("All sessions closed")
+
+    @staticmethod
+    async def _close(connection):
+        connection.stop_signaling()
+        await connection.disconnect_from_websocket()
+        await connection.clear()
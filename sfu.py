@@ -0,0 +1,377 @@
+"""
+Selective forwarding of received RTP packets to other peer connections,
+without decoding or encoding them.
+
+A Publisher taps the RTP packets a RTCRtpReceiver gets, after unwrapping
+retransmissions, keeps them in a PacketCache and hands each to its
+Subscribers. The receiver still sends NACKs, receiver reports and REMB to
+the publishing peer, but nothing it receives is decoded.
+
+A Subscriber sends the packets through a RTCRtpSender whose track never
+yields frames, rewriting their SSRC, payload type, sequence number and
+timestamp to its own, so a subscriber sees one continuous stream even
+when the publisher changes. Keyframe requests from all subscribers of a
+publisher are aggregated into at most one PLI per
+KEYFRAME_REQUEST_INTERVAL, and NACKs are answered from the PacketCache
+of the publisher, so subscribers share one copy of every packet.
+"""
+import asyncio
+import logging
+import time
+from aiortc import MediaStreamTrack, clock
+from aiortc.mediastreams import MediaStreamError
+from aiortc.rtcpeerconnection import is_codec_compatible
+from aiortc.rtp import RtpPacket, unwrap_rtx, wrap_rtx
+from metrics import SFU_KEYFRAME_REQUESTS, SFU_PACKETS_FORWARDED, SFU_RETRANSMISSIONS
+from packet_cache import cache as packet_cache
+
+# seconds between PLIs sent to a publisher, however many subscribers ask
+KEYFRAME_REQUEST_INTERVAL = 0.5
+# packets waiting to be sent to one subscriber before the oldest are dropped
+SEND_QUEUE_SIZE = 256
+
+
+def is_rtx(codec):
+    return codec.name.lower() == "rtx"
+
+
+class ForwardedTrack(MediaStreamTrack):
+    """
+    The track of a subscriber's sender. Its packets are sent by the
+    Subscriber, so it never yields anything and the sender's own loop just
+    waits until the track is stopped.
+    """
+
+    def __init__(self, kind):
+        super().__init__()
+        self.kind = kind
+        self._stopped = asyncio.Event()
+
+    async def recv(self):
+        await self._stopped.wait()
+        raise MediaStreamError
+
+    def stop(self):
+        super().stop()
+        self._stopped.set()
+
+
+class Publisher:
+    """
+    Forwards the packets received by a RTCRtpReceiver to its subscribers.
+
+    receiver: RTCRtpReceiver of the published track
+    kind: "audio" or "video"
+    cache: PacketCache the packets are kept in for retransmission, the
+        shared one by default
+    """
+
+    def __init__(self, receiver, kind, cache=None):
+        self.receiver = receiver
+        self.kind = kind
+        self.subscribers = set()
+        self.cache = packet_cache if cache is None else cache
+        self.codecs = receiver._RTCRtpReceiver__codecs
+        self.ssrc = None
+        self._last_keyframe_request = None
+        # PLIs being sent, kept until done so their failures are seen
+        self._pli_tasks = set()
+        self._tap()
+
+    def _tap(self):
+        receiver = self.receiver
+        handle_rtp_packet = receiver._handle_rtp_packet
+        codecs = self.codecs
+        rtx_ssrc = receiver._RTCRtpReceiver__rtx_ssrc
+
+        async def forward(packet, arrival_time_ms):
+            # the publisher's own NACKs and jitter buffer come first
+            await handle_rtp_packet(packet, arrival_time_ms)
+            codec = codecs.get(packet.payload_type)
+            if codec is not None and receiver._enabled:
+                original = packet
+                if is_rtx(codec):
+                    apt = codec.parameters.get("apt")
+                    if packet.ssrc in rtx_ssrc and apt in codecs and len(packet.payload) >= 2:
+                        original = unwrap_rtx(packet, payload_type=apt, ssrc=rtx_ssrc[packet.ssrc])
+                        codec = codecs[apt]
+                    else:
+                        original = None
+                if original is not None:
+                    self.ssrc = original.ssrc
+                    self.cache.put(original)
+                    for subscriber in list(self.subscribers):
+                        subscriber.forward(original, codec)
+                    SFU_PACKETS_FORWARDED.inc((self.kind,), len(self.subscribers))
+
+        receiver._handle_rtp_packet = forward
+        # frames are still reassembled for the keyframe detection of the
+        # jitter buffer, but never handed to the decoder
+        decoder_queue = receiver._RTCRtpReceiver__decoder_queue
+        put = decoder_queue.put
+        decoder_queue.put = lambda task, *args, **kwargs: put(task, *args, **kwargs) if task is None else None
+
+    def request_keyframe(self):
+        """
+        Ask the publisher for a keyframe, unless that was done less than
+        KEYFRAME_REQUEST_INTERVAL ago.
+        """
+        if self.kind != "video" or self.ssrc is None:
+            return
+        now = time.monotonic()
+        if self._last_keyframe_request is not None and now - self._last_keyframe_request < KEYFRAME_REQUEST_INTERVAL:
+            SFU_KEYFRAME_REQUESTS.inc(("aggregated",))
+            return
+        self._last_keyframe_request = now
+        SFU_KEYFRAME_REQUESTS.inc(("sent",))
+        task = asyncio.ensure_future(self.receiver._send_rtcp_pli(self.ssrc))
+        self._pli_tasks.add(task)
+        task.add_done_callback(self._pli_sent)
+
+    def _pli_sent(self, task):
+        self._pli_tasks.discard(task)
+        if not task.cancelled() and task.exception():
+            logging.error(f"Requesting keyframe from publisher {self.ssrc} failed: {task.exception()}")
+            # the next request is sent at once instead of being aggregated
+            self._last_keyframe_request = None
+
+
+class Subscriber:
+    """
+    Sends the packets of a Publisher through a sender of another peer
+    connection, as if they were its own. Packets are queued for a writer
+    task of the subscriber, so a slow transport, e.g. TURN over TCP, only
+    holds up its own subscriber. When the queue is full the oldest packet
+    is dropped, and the subscriber NACKs it like any lost packet.
+
+    sender: RTCRtpSender of a ForwardedTrack, not negotiated yet
+    queue_size: packets waiting to be sent before the oldest are dropped
+    """
+
+    def __init__(self, sender, queue_size=SEND_QUEUE_SIZE):
+        self.sender = sender
+        self.publisher = None
+        self.dropped = 0
+        # negotiated media codecs, and publisher payload type -> the
+        # negotiated payload type of the same codec, or None
+        self._codecs = []
+        self._payload_types = {}
+        # media payload type -> payload type of its RTX
+        self._rtx_payload_types = {}
+        self._queue = asyncio.Queue(maxsize=queue_size)
+        self._writer = None
+        self._mid = None
+        self._extensions_map = None
+        # next outgoing sequence number and timestamp, for continuity across publishers
+        self._next_sequence_number = None
+        self._last_timestamp = None
+        self._first_sequence_number = None
+        self._sequence_offset = None
+        self._timestamp_offset = 0
+        self._rtx_sequence_number = 0
+
+        send = sender.send
+
+        async def negotiated(parameters):
+            self._codecs = [codec for codec in parameters.codecs if not is_rtx(codec)]
+            self._payload_types = {}
+            self._rtx_payload_types = {
+                codec.parameters.get("apt"): codec.payloadType for codec in parameters.codecs if is_rtx(codec)}
+            self._mid = parameters.muxId
+            await send(parameters)
+            self._extensions_map = sender._RTCRtpSender__rtp_header_extensions_map
+
+        sender.send = negotiated
+        sender._send_keyframe = self.request_keyframe
+        sender._retransmit = self.retransmit
+
+    def attach(self, publisher):
+        self.detach()
+        self.publisher = publisher
+        # the next packet starts where the last publisher left off
+        self._sequence_offset = None
+        # and its codecs may be numbered differently
+        self._payload_types = {}
+        publisher.subscribers.add(self)
+        publisher.request_keyframe()
+
+    def detach(self):
+        if self.publisher:
+            self.publisher.subscribers.discard(self)
+        self.publisher = None
+
+    def close(self):
+        self.detach()
+        if self._writer:
+            self._writer.cancel()
+        self._writer = None
+
+    def request_keyframe(self):
+        if self.publisher:
+            self.publisher.request_keyframe()
+
+    def _payload_type(self, codec):
+        """
+        The negotiated payload type for packets of a publisher codec, matched
+        on its parameters too, e.g. H264 packetization mode and profile.
+        """
+        try:
+            return self._payload_types[codec.payloadType]
+        except KeyError:
+            payload_type = self._payload_types[codec.payloadType] = next(
+                (ours.payloadType for ours in self._codecs if is_codec_compatible(ours, codec)), None)
+            return payload_type
+
+    def forward(self, packet, codec):
+        """
+        Rewrite a packet of the publisher and queue it for sending, without
+        waiting for it to be sent.
+        """
+        # not negotiated yet, or the publishing peer connection itself
+        if self._extensions_map is None or self.sender.transport is self.publisher.receiver.transport:
+            return
+        payload_type = self._payload_type(codec)
+        if payload_type is None:
+            return
+        if self._sequence_offset is None:
+            if self._next_sequence_number is None:
+                self._next_sequence_number = packet.sequence_number
+                self._last_timestamp = (packet.timestamp - 1) & 0xFFFFFFFF
+            self._sequence_offset = (self._next_sequence_number - packet.sequence_number) & 0xFFFF
+            self._timestamp_offset = (self._last_timestamp + 1 - packet.timestamp) & 0xFFFFFFFF
+            self._first_sequence_number = self._next_sequence_number
+        out = self._rewrite(packet, payload_type)
+        # a retransmission from the publisher can be older than the last packet sent
+        if (out.sequence_number - self._next_sequence_number) & 0xFFFF < 0x8000:
+            self._next_sequence_number = (out.sequence_number + 1) & 0xFFFF
+            self._last_timestamp = out.timestamp
+        if self._writer is None:
+            self._writer = asyncio.ensure_future(self._write())
+        try:
+            self._queue.put_nowait((out, len(packet.payload)))
+        except asyncio.QueueFull:
+            self._queue.get_nowait()
+            self._queue.put_nowait((out, len(packet.payload)))
+            self.dropped += 1
+            if self.dropped % self._queue.maxsize == 1:
+                logging.warning(f"Dropping packets for slow subscriber {self.sender._ssrc} ({self.dropped} so far)")
+
+    async def _write(self):
+        while True:
+            packet, payload_size = await self._queue.get()
+            await self._send(packet, payload_size)
+
+    def _rewrite(self, packet, payload_type):
+        out = RtpPacket(
+            payload_type=payload_type,
+            marker=packet.marker,
+            sequence_number=(packet.sequence_number + self._sequence_offset) & 0xFFFF,
+            timestamp=(packet.timestamp + self._timestamp_offset) & 0xFFFFFFFF,
+            ssrc=self.sender._ssrc,
+            payload=packet.payload,
+        )
+        out.extensions.abs_send_time = (clock.current_ntp_time() >> 14) & 0x00FFFFFF
+        out.extensions.mid = self._mid
+        out.extensions.audio_level = packet.extensions.audio_level
+        return out
+
+    async def _send(self, packet, payload_size):
+        sender = self.sender
+        try:
+            await sender.transport._send_rtp(packet.serialize(self._extensions_map))
+        except ConnectionError:
+            return
+        # what the sender reports in its sender reports and getStats()
+        sender._RTCRtpSender__ntp_timestamp = clock.current_ntp_time()
+        sender._RTCRtpSender__rtp_timestamp = packet.timestamp
+        sender._RTCRtpSender__octet_count += payload_size
+        sender._RTCRtpSender__packet_count += 1
+
+    async def retransmit(self, sequence_number):
+        """
+        Resend a packet the subscriber reported lost, from the publisher's
+        cache.
+        """
+        publisher = self.publisher
+        if publisher is None or self._sequence_offset is None:
+            return
+        # only packets forwarded since the current publisher was attached
+        sent = (self._next_sequence_number - self._first_sequence_number) & 0xFFFF
+        if (sequence_number - self._first_sequence_number) & 0xFFFF >= sent:
+            return
+        packet = publisher.cache.get(publisher.ssrc, (sequence_number - self._sequence_offset) & 0xFFFF)
+        if packet is None:
+            SFU_RETRANSMISSIONS.inc(("miss",))
+            return
+        codec = publisher.codecs.get(packet.payload_type)
+        payload_type = self._payload_type(codec) if codec else None
+        if payload_type is None:
+            return
+        SFU_RETRANSMISSIONS.inc(("hit",))
+        out = self._rewrite(packet, payload_type)
+        rtx_payload_type = self._rtx_payload_types.get(payload_type)
+        if rtx_payload_type is not None:
+            out = wrap_rtx(out, payload_type=rtx_payload_type,
+                           sequence_number=self._rtx_sequence_number, ssrc=self.sender._rtx_ssrc)
+            self._rtx_sequence_number = (self._rtx_sequence_number + 1) & 0xFFFF
+        await self._send(out, len(packet.payload))
+
+
+class ForwardingHub:
+    """
+    Forwards the tracks published under a name to every peer connection
+    subscribed to that name. Subscribers can join before the publisher and
+    stay subscribed when it leaves, picking up the next one.
+    """
+
+    def __init__(self):
+        self._publishers = {}
+        self._subscribers = {}
+
+    def publish(self, name, receiver, kind):
+        """
+        Forward the track received by receiver to the subscribers of name,
+        replacing any track published under it before.
+        """
+        key = (name, kind)
+        publisher = Publisher(receiver, kind)
+        self._publishers[key] = publisher
+        for subscriber in self._subscribers.get(key, ()):
+            subscriber.attach(publisher)
+        logging.info(f"Forwarding {kind} of {name} to {len(publisher.subscribers)} subscribers")
+        return publisher
+
+    def unpublish(self, name, publisher):
+        key = (name, publisher.kind)
+        if self._publishers.get(key) is publisher:
+            del self._publishers[key]
+        for subscriber in list(publisher.subscribers):
+            subscriber.detach()
+        if publisher.ssrc is not None:
+            publisher.cache.remove(publisher.ssrc)
+
+    def subscribe(self, pc, name, kind):
+        """
+        Add a sender for the kind of track published under name to pc,
+        before it is negotiated.
+        """
+        key = (name, kind)
+        track = ForwardedTrack(kind)
+        subscriber = Subscriber(pc.addTrack(track))
+        self._subscribers.setdefault(key, set()).add(subscriber)
+        if key in self._publishers:
+            subscriber.attach(self._publishers[key])
+        # senders stop their track when the peer connection closes
+        track.on("ended", lambda: self._unsubscribe(key, subscriber))
+        return subscriber.sender
+
+    def _unsubscribe(self, key, subscriber):
+        subscriber.close()
+        subscribers = self._subscribers.get(key)
+        if subscribers is not None:
+            subscribers.discard(subscriber)
+            if not subscribers:
+                del self._subscribers[key]
+
+
+hub = ForwardingHub()
@@ -0,0 +1,231 @@
+import asyncio
+import logging
+import struct
+
+# op, topic length, payload length
+HEADER = struct.Struct("!cHI")
+SUBSCRIBE = b"S"
+UNSUBSCRIBE = b"U"
+PUBLISH_TEXT = b"T"
+PUBLISH_BINARY = b"B"
+# bytes waiting to be written to a broker connection before it counts as slow
+MAX_WRITE_BUFFER = 4 * 1024 * 1024
+# seconds between attempts to reconnect to the broker, doubling up to the maximum
+RECONNECT_DELAY = 0.1
+MAX_RECONNECT_DELAY = 5.0
+
+
+def _pack(op, topic, payload=b""):
+    topic = topic.encode("utf-8")
+    return HEADER.pack(op, len(topic), len(payload)) + topic + payload
+
+
+async def _read_frame(reader):
+    header = await reader.readexactly(HEADER.size)
+    op, topic_size, payload_size = HEADER.unpack(header)
+    body = await reader.readexactly(topic_size + payload_size)
+    return op, body[:topic_size].decode("utf-8"), body[topic_size:], header + body
+
+
+class Broker:
+    """
+    Pub/sub interface through which relay workers share routing.
+
+    Callbacks are called with each message published to their topic, by any
+    worker connected to the same broker. publish never blocks the caller.
+    """
+
+    async def start(self):
+        pass
+
+    async def close(self):
+        pass
+
+    def subscribe(self, topic, callback):
+        raise NotImplementedError
+
+    def unsubscribe(self, topic, callback):
+        raise NotImplementedError
+
+    def publish(self, topic, message):
+        raise NotImplementedError
+
+
+class InProcessBroker(Broker):
+    """
+    Delivers messages within the current process only.
+    """
+
+    def __init__(self):
+        self._subscribers = {}
+
+    def has_subscribers(self, topic):
+        return topic in self._subscribers
+
+    def topics(self):
+        return list(self._subscribers)
+
+    def subscribe(self, topic, callback):
+        self._subscribers.setdefault(topic, set()).add(callback)
+
+    def unsubscribe(self, topic, callback):
+        callbacks = self._subscribers.get(topic)
+        if callbacks is None:
+            return
+        callbacks.discard(callback)
+        if not callbacks:
+            del self._subscribers[topic]
+
+    def publish(self, topic, message):
+        for callback in list(self._subscribers.get(topic, ())):
+            callback(message)
+
+
+class UnixSocketBroker(Broker):
+    """
+    Client of a BrokerServer listening on a Unix socket, so relay workers on
+    the same machine share one routing space.
+
+    Messages published while the connection is down, or while more than
+    MAX_WRITE_BUFFER bytes wait to be written to it, are dropped. A lost
+    connection is reopened with backoff and the topics subscribed again.
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._local = InProcessBroker()
+        self.dropped = 0
+        self._dropping = False
+        self._writer = None
+        self._reader_task = None
+
+    async def start(self):
+        reader, self._writer = await asyncio.open_unix_connection(self._path)
+        self._reader_task = asyncio.create_task(self._read(reader))
+        self._reader_task.add_done_callback(self._stopped)
+        logging.info(f"Connected to broker at {self._path}")
+
+    def _stopped(self, task):
+        if not task.cancelled() and task.exception():
+            logging.error(f"Reading from broker at {self._path} failed: {task.exception()}")
+
+    async def close(self):
+        if self._reader_task:
+            self._reader_task.cancel()
+        if self._writer:
+            self._writer.close()
+        self._writer = None
+
+    def subscribe(self, topic, callback):
+        # the server only needs to know about the first local subscriber
+        if not self._local.has_subscribers(topic) and self._writer:
+            self._writer.write(_pack(SUBSCRIBE, topic))
+        self._local.subscribe(topic, callback)
+
+    def unsubscribe(self, topic, callback):
+        self._local.unsubscribe(topic, callback)
+        if not self._local.has_subscribers(topic) and self._writer:
+            self._writer.write(_pack(UNSUBSCRIBE, topic))
+
+    def publish(self, topic, message):
+        writer = self._writer
+        if writer is None or writer.is_closing() or writer.transport.get_write_buffer_size() > MAX_WRITE_BUFFER:
+            self.dropped += 1
+            if not self._dropping:
+                self._dropping = True
+                logging.warning(f"Dropping messages for broker at {self._path} ({self.dropped} so far)")
+            return
+        self._dropping = False
+        if isinstance(message, str):
+            writer.write(_pack(PUBLISH_TEXT, topic, message.encode("utf-8")))
+        else:
+            writer.write(_pack(PUBLISH_BINARY, topic, message))
+
+    async def _read(self, reader):
+        while True:
+            try:
+                while True:
+                    op, topic, payload, _ = await _read_frame(reader)
+                    message = payload.decode("utf-8") if op == PUBLISH_TEXT else payload
+                    self._local.publish(topic, message)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                logging.error(f"Lost connection to broker at {self._path}, reconnecting")
+            self._writer.close()
+            self._writer = None
+            reader = await self._reconnect()
+
+    async def _reconnect(self):
+        delay = RECONNECT_DELAY
+        while True:
+            await asyncio.sleep(delay)
+            try:
+                reader, writer = await asyncio.open_unix_connection(self._path)
+            except OSError as e:
+                delay = min(delay * 2, MAX_RECONNECT_DELAY)
+                logging.warning(f"Reconnecting to broker at {self._path} failed: {e}, retrying in {delay}s")
+                continue
+            # the server forgot this client's topics with the old connection
+            for topic in self._local.topics():
+                writer.write(_pack(SUBSCRIBE, topic))
+            self._writer = writer
+            logging.info(f"Reconnected to broker at {self._path}")
+            return reader
+
+
+class BrokerServer:
+    """
+    Forwards each published message to every client subscribed to its topic,
+    including the publisher itself. A client with more than MAX_WRITE_BUFFER
+    bytes waiting is disconnected, as it would otherwise hold everything
+    published to it in memory.
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._server = None
+        self._subscribers = {}
+
+    async def start(self):
+        self._server = await asyncio.start_unix_server(self._handle_client, self._path)
+        logging.info(f"Broker listening on {self._path}")
+
+    async def close(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def _handle_client(self, reader, writer):
+        topics = set()
+        try:
+            while True:
+                op, topic, _, frame = await _read_frame(reader)
+                if op == SUBSCRIBE:
+                    self._subscribers.setdefault(topic, set()).add(writer)
+                    topics.add(topic)
+                elif op == UNSUBSCRIBE:
+                    self._remove(topic, writer)
+                    topics.discard(topic)
+                else:
+                    for subscriber in list(self._subscribers.get(topic, ())):
+                        if subscriber.is_closing():
+                            continue
+                        if subscriber.transport.get_write_buffer_size() > MAX_WRITE_BUFFER:
+                            logging.warning("Disconnecting slow broker client")
+                            # close would wait for the buffer to be written first
+                            subscriber.transport.abort()
+                            continue
+                        subscriber.write(frame)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            for topic in topics:
+                self._remove(topic, writer)
+            writer.close()
+
+    def _remove(self, topic, writer):
+        writers = self._subscribers.get(topic)
+        if writers is None:
+            return
+        writers.discard(writer)
+        if not writers:
+            del self._subscribers[topic]
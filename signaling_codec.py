@@ -0,0 +1,253 @@
+"""
+Encoding and decoding of the "~"-delimited signaling protocol.
+
+Version 1 is the format the Unity client speaks:
+
+    offer~<sdp>
+    answer~<sdp>
+    candidate~<candidate>~<sdpMid>~<sdpMLineIndex>
+    pcnull
+
+Version 2 frames every field as "<length>:<value>" after a "2~<type>~" header,
+so fields may contain "~", and a single "candidates" message can carry many
+candidates as repeated (candidate, sdpMid, sdpMLineIndex) fields.
+"""
+from aiortc import RTCIceCandidate
+
+VERSION_2 = "2"
+SEPARATOR = "~"
+DESCRIPTION_TYPES = ("offer", "answer")
+
+
+def _extension(fields, name):
+    # extensions are name/value pairs after the type, so names are at even positions
+    if name in fields:
+        i = fields.index(name)
+        if not i % 2 and i + 1 < len(fields):
+            return fields[i + 1]
+    return None
+
+
+def _parse_sdp(sdp, sdp_mid, sdp_mline_index):
+    # the eight fixed fields come from one split, and the extensions
+    # after them are only parsed when one that is kept is there
+    bits = sdp.split(None, 8)
+    extensions = bits.pop() if len(bits) == 9 else None
+    try:
+        foundation, component, protocol, priority, ip, port, typ, type = bits
+    except ValueError:
+        raise ValueError(f"Invalid candidate: {sdp}") from None
+    if typ != "typ":
+        raise ValueError(f"Invalid candidate: {sdp}")
+    if foundation.startswith("a="):
+        foundation = foundation[2:]
+    if foundation.startswith("candidate:"):
+        foundation = foundation[10:]
+    related_address = related_port = tcp_type = None
+    if extensions and ("raddr" in extensions or "tcptype" in extensions):
+        extensions = extensions.split()
+        related_address = _extension(extensions, "raddr")
+        related_port = _extension(extensions, "rport")
+        if related_port is not None:
+            related_port = int(related_port)
+        tcp_type = _extension(extensions, "tcptype")
+    return (foundation, int(component), protocol, int(priority), ip, int(port), type,
+            related_address, related_port, tcp_type, sdp_mid or None,
+            int(sdp_mline_index) if sdp_mline_index else None)
+
+
+class Candidate:
+    """
+    A parsed ICE candidate, including the raddr/rport/tcptype extensions.
+
+    Candidates made with lazy keep the received strings and are only parsed
+    when a field is first read, so decoding a message costs no more than
+    splitting it.
+    """
+
+    FIELDS = ("foundation", "component", "protocol", "priority", "ip", "port", "type",
+              "related_address", "related_port", "tcp_type", "sdp_mid", "sdp_mline_index")
+    __slots__ = FIELDS + ("_unparsed",)
+
+    def __init__(self, foundation, component, protocol, priority, ip, port, type,
+                 related_address=None, related_port=None, tcp_type=None, sdp_mid=None, sdp_mline_index=None):
+        self._unparsed = None
+        self.foundation = foundation
+        self.component = component
+        self.protocol = protocol
+        self.priority = priority
+        self.ip = ip
+        self.port = port
+        self.type = type
+        self.related_address = related_address
+        self.related_port = related_port
+        self.tcp_type = tcp_type
+        self.sdp_mid = sdp_mid
+        self.sdp_mline_index = sdp_mline_index
+
+    def __repr__(self):
+        return f"Candidate({self.to_sdp()!r}, sdp_mid={self.sdp_mid!r}, sdp_mline_index={self.sdp_mline_index!r})"
+
+    def __eq__(self, other):
+        return isinstance(other, Candidate) and all(
+            getattr(self, name) == getattr(other, name) for name in self.FIELDS)
+
+    def __hash__(self):
+        return hash(tuple(getattr(self, name) for name in self.FIELDS))
+
+    def __getattr__(self, name):
+        # only called for fields not set yet, i.e. of a lazy candidate
+        if name == "_unparsed" or self._unparsed is None:
+            raise AttributeError(name)
+        self._parse()
+        return getattr(self, name)
+
+    def _parse(self):
+        (self.foundation, self.component, self.protocol, self.priority, self.ip, self.port, self.type,
+         self.related_address, self.related_port, self.tcp_type, self.sdp_mid,
+         self.sdp_mline_index) = _parse_sdp(*self._unparsed)
+        self._unparsed = None
+
+    @classmethod
+    def lazy(cls, sdp, sdp_mid=None, sdp_mline_index=None):
+        """
+        A candidate parsed by from_sdp when a field is first read, which is
+        when an invalid one raises ValueError.
+        """
+        candidate = cls.__new__(cls)
+        candidate._unparsed = (sdp, sdp_mid, sdp_mline_index)
+        return candidate
+
+    @classmethod
+    def from_sdp(cls, sdp, sdp_mid=None, sdp_mline_index=None):
+        """
+        Parse an "a=candidate" value, with or without its "candidate:" prefix.
+        """
+        return cls(*_parse_sdp(sdp, sdp_mid, sdp_mline_index))
+
+    @classmethod
+    def from_rtc(cls, candidate):
+        return cls(candidate.foundation, candidate.component, candidate.protocol, candidate.priority,
+                   candidate.ip, candidate.port, candidate.type, candidate.relatedAddress,
+                   candidate.relatedPort, candidate.tcpType, candidate.sdpMid, candidate.sdpMLineIndex)
+
+    def to_sdp(self):
+        sdp = (f"candidate:{self.foundation} {self.component} {self.protocol} {self.priority} "
+               f"{self.ip} {self.port} typ {self.type}")
+        if self.related_address is not None:
+            sdp += f" raddr {self.related_address}"
+        if self.related_port is not None:
+            sdp += f" rport {self.related_port}"
+        if self.tcp_type is not None:
+            sdp += f" tcptype {self.tcp_type}"
+        return sdp
+
+    def to_rtc(self):
+        if self._unparsed is not None:
+            self._parse()
+        return RTCIceCandidate(
+            component=self.component, foundation=self.foundation, ip=self.ip, port=self.port,
+            priority=self.priority, protocol=self.protocol, type=self.type,
+            relatedAddress=self.related_address, relatedPort=self.related_port,
+            sdpMid=self.sdp_mid, sdpMLineIndex=self.sdp_mline_index, tcpType=self.tcp_type)
+
+
+class SignalingMessage:
+    """
+    A decoded signaling message. Descriptions carry sdp, candidate messages
+    carry one or more candidates.
+    """
+
+    __slots__ = ("type", "sdp", "candidates", "version")
+
+    def __init__(self, type, sdp=None, candidates=(), version=1):
+        self.type = type
+        self.sdp = sdp
+        self.candidates = candidates
+        self.version = version
+
+    def __repr__(self):
+        return f"SignalingMessage(type={self.type!r}, candidates={len(self.candidates)}, version={self.version})"
+
+
+def _frame(fields):
+    return "".join(f"{len(field)}:{field}" for field in fields)
+
+
+def _unframe(data):
+    fields = []
+    offset = 0
+    while offset < len(data):
+        colon = data.index(":", offset)
+        size = int(data[offset:colon])
+        end = colon + 1 + size
+        if end > len(data):
+            raise ValueError("Truncated signaling field")
+        fields.append(data[colon + 1:end])
+        offset = end
+    return fields
+
+
+def _candidates_from_fields(fields):
+    if len(fields) % 3:
+        raise ValueError("Candidate fields must come in groups of three")
+    return [Candidate.from_sdp(fields[i], fields[i + 1], fields[i + 2]) for i in range(0, len(fields), 3)]
+
+
+def encode_description(type, sdp, version=1):
+    if version == 1:
+        return type + SEPARATOR + sdp
+    return VERSION_2 + SEPARATOR + type + SEPARATOR + _frame([sdp])
+
+
+def encode_candidates(candidates, version=1):
+    """
+    Encode candidates as one version 2 "candidates" message, or as a list of
+    version 1 "candidate" messages since version 1 has no batching.
+    """
+    if version == 1:
+        return [SEPARATOR.join(("candidate", c.to_sdp(), c.sdp_mid or "", str(c.sdp_mline_index or 0)))
+                for c in candidates]
+    fields = []
+    for c in candidates:
+        fields += [c.to_sdp(), c.sdp_mid or "", "" if c.sdp_mline_index is None else str(c.sdp_mline_index)]
+    return VERSION_2 + SEPARATOR + "candidates" + SEPARATOR + _frame(fields)
+
+
+def encode_message(type, version=1):
+    """
+    Encode a message without a payload, such as pcnull.
+    """
+    if version == 1:
+        return type
+    return VERSION_2 + SEPARATOR + type + SEPARATOR
+
+
+def decode_message(message):
+    """
+    Decode a version 1 or version 2 signaling message.
+    """
+    if isinstance(message, bytes):
+        message = message.decode("utf-8")
+    if message.startswith("candidate~"):
+        # the bulk of trickle ICE, so taken with a single split
+        fields = message.split(SEPARATOR)
+        if len(fields) == 4:
+            return SignalingMessage("candidate", candidates=[Candidate.lazy(fields[1], fields[2], fields[3])])
+    if message.startswith(VERSION_2 + SEPARATOR):
+        type, _, data = message[2:].partition(SEPARATOR)
+        fields = _unframe(data)
+        if type in DESCRIPTION_TYPES:
+            return SignalingMessage(type, sdp=fields[0] if fields else "", version=2)
+        if type in ("candidate", "candidates"):
+            return SignalingMessage("candidate", candidates=_candidates_from_fields(fields), version=2)
+        return SignalingMessage(type, version=2)
+
+    type, _, data = message.partition(SEPARATOR)
+    if type in DESCRIPTION_TYPES:
+        # everything after the type is the SDP, even if it contains "~"
+        return SignalingMessage(type, sdp=data)
+    if type == "candidate":
+        candidate, sdp_mid, sdp_mline_index = data.rsplit(SEPARATOR, 2)
+        return SignalingMessage(type, candidates=[Candidate.lazy(candidate, sdp_mid, sdp_mline_index)])
+    return SignalingMessage(type)
@@ -0,0 +1,281 @@
+"""
+Publishes a capture device as several spatial layers and lets each peer
+receive the layer its link can carry.
+
+A SimulcastSource reads the device once, scales every frame once per
+layer in use, each from the next larger layer, and feeds every layer to
+its own EncodedBroadcast, so peers on the same layer share one encoder.
+Each peer gets a SimulcastTrack, which a BitrateController moves between
+layers as the peer's bandwidth estimate changes. A switch takes effect at
+the first keyframe of the new layer, so the remote decoder only ever sees
+a resolution change on a keyframe.
+
+aiortc sends a single encoding per sender, so the layers reach a peer one
+at a time over its one video stream rather than as RTP simulcast streams.
+"""
+import asyncio
+import logging
+from aiortc import MediaStreamTrack
+from aiortc.mediastreams import MediaStreamError
+from bitrate_controller import LossBasedPolicy, START_BITRATE
+from broadcast import DEFAULT_CODEC, EncodedBroadcast
+from capture_hub import hub as capture_hub
+
+# (resolution scale, encoder bitrate), best first; a layer is sent once
+# the estimate reaches its bitrate
+LAYERS = [
+    (1.0, 900000),
+    (0.5, 300000),
+    (0.25, 100000),
+]
+# samples a better layer has to be allowed before switching up to it
+UPGRADE_AFTER = 3
+
+
+def layer_for(bitrate, layers=LAYERS):
+    """
+    Index of the best layer a bitrate can carry, the last one if none.
+    """
+    return next((index for index, (_, minimum) in enumerate(layers) if bitrate >= minimum), len(layers) - 1)
+
+
+def policy(layers=LAYERS):
+    """
+    LossBasedPolicy bounded by the bitrates of the layers.
+    """
+    return LossBasedPolicy(min_bitrate=layers[-1][1], max_bitrate=layers[0][1] * 2)
+
+
+class _LayerTrack(MediaStreamTrack):
+    """
+    The frames of one layer, fed by the SimulcastSource. Only the latest
+    frame is kept, so a slow encoder skips frames instead of lagging.
+    """
+
+    kind = "video"
+
+    def __init__(self):
+        super().__init__()
+        self._queue = asyncio.Queue(maxsize=1)
+
+    def _put(self, frame):
+        if self._queue.full():
+            self._queue.get_nowait()
+        self._queue.put_nowait(frame)
+
+    async def recv(self):
+        if self.readyState != "live":
+            raise MediaStreamError
+        frame = await self._queue.get()
+        if frame is None:
+            self.stop()
+            raise MediaStreamError
+        return frame
+
+
+class SimulcastTrack(MediaStreamTrack):
+    """
+    Yields the packets of one layer of a SimulcastSource, switching layers
+    when apply is given settings for a different bitrate.
+    """
+
+    kind = "video"
+
+    def __init__(self, source, layer):
+        super().__init__()
+        self.layer = layer
+        self._source = source
+        self._current = source._broadcast(layer).subscribe()
+        self._pending = None
+        self._pending_layer = None
+        self._upgrade_count = 0
+
+    def apply(self, settings):
+        """
+        Switch to the best layer settings.bitrate allows, at once when
+        switching down and after UPGRADE_AFTER samples when switching up.
+        """
+        if self._source is None:
+            return
+        layer = layer_for(settings.bitrate, self._source.layers)
+        if layer < self.layer:
+            self._upgrade_count += 1
+            if self._upgrade_count < UPGRADE_AFTER:
+                return
+        self._upgrade_count = 0
+        if layer == (self.layer if self._pending is None else self._pending_layer):
+            return
+        if self._pending:
+            self._pending.stop()
+            self._pending = None
+        if layer != self.layer:
+            logging.info(f"Switching simulcast layer {self.layer} -> {layer} at {settings.bitrate} bps")
+            # the new layer's packets start at a keyframe, which subscribe requests
+            self._pending = self._source._broadcast(layer).subscribe()
+            self._pending_layer = layer
+
+    def request_keyframe(self):
+        if self._current:
+            self._current.request_keyframe()
+
+    async def recv(self):
+        if self.readyState != "live":
+            raise MediaStreamError
+        if self._pending is not None and self._pending.pending:
+            self._current.stop()
+            self._current, self.layer = self._pending, self._pending_layer
+            self._pending = None
+        return await self._current.recv()
+
+    def stop(self):
+        super().stop()
+        for track in (self._current, self._pending):
+            if track:
+                track.stop()
+        self._current = self._pending = None
+        if self._source:
+            self._source._unsubscribe(self)
+            self._source = None
+
+
+class SimulcastSource:
+    """
+    Scales a decoded video track into layers and encodes each layer in use
+    once, for any number of SimulcastTrack subscribers.
+
+    source: decoded video track to read
+    codec: mime type of the codec, one of broadcast.ENCODERS
+    layers: (scale, bitrate) of each layer, best first
+    """
+
+    def __init__(self, source, codec=DEFAULT_CODEC, layers=LAYERS, on_close=None):
+        self.codec = codec
+        self.layers = layers
+        self._source = source
+        self._on_close = on_close
+        self._layer_tracks = {}
+        self._broadcasts = {}
+        self._subscribers = set()
+        self._task = None
+        self._closed = False
+
+    def subscribe(self, bitrate=START_BITRATE):
+        """
+        A track starting on the best layer bitrate allows.
+        """
+        track = SimulcastTrack(self, layer_for(bitrate, self.layers))
+        self._subscribers.add(track)
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+        return track
+
+    def _broadcast(self, index):
+        broadcast = self._broadcasts.get(index)
+        if broadcast is None:
+            self._layer_tracks[index] = _LayerTrack()
+            broadcast = EncodedBroadcast(
+                self._layer_tracks[index], codec=self.codec, bitrate=self.layers[index][1],
+                on_close=lambda b: self._close_layer(index, b))
+            self._broadcasts[index] = broadcast
+        return broadcast
+
+    def _close_layer(self, index, broadcast):
+        # the layer lost its last subscriber, so it is no longer scaled
+        if self._broadcasts.get(index) is broadcast:
+            del self._broadcasts[index]
+            del self._layer_tracks[index]
+
+    def _unsubscribe(self, track):
+        self._subscribers.discard(track)
+        if not self._subscribers:
+            self.close()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        if self._source:
+            self._source.stop()
+            self._source = None
+        for broadcast in list(self._broadcasts.values()):
+            broadcast.close()
+        if self._on_close:
+            self._on_close(self)
+
+    def _scale(self, frame, indexes):
+        scaled = {}
+        previous = frame
+        for index in indexes:
+            scale = self.layers[index][0]
+            if scale == 1.0:
+                scaled[index] = frame
+                continue
+            # even sizes, as yuv420p needs; swscale scales each plane with SIMD
+            width = int(frame.width * scale) & ~1
+            height = int(frame.height * scale) & ~1
+            previous = scaled[index] = previous.reformat(width=width, height=height, format="yuv420p")
+        return scaled
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        logging.info(f"Simulcast started: {self.codec} {len(self.layers)} layers")
+        try:
+            while True:
+                frame = await self._source.recv()
+                indexes = sorted(self._layer_tracks)
+                if not indexes:
+                    continue
+                scaled = await loop.run_in_executor(None, self._scale, frame, indexes)
+                for index, layer_frame in scaled.items():
+                    track = self._layer_tracks.get(index)
+                    if track:
+                        track._put(layer_frame)
+        except MediaStreamError:
+            pass
+        except Exception as e:
+            logging.error(f"Simulcast failed: {e}")
+            # later subscribers get a new source instead of this dead one
+            self._task = None
+            self.close()
+        finally:
+            # ending the layers ends their encoders and so every subscriber
+            for track in list(self._layer_tracks.values()):
+                track._put(None)
+        logging.info("Simulcast stopped")
+
+
+class SimulcastHub:
+    """
+    Keeps one SimulcastSource per (device, codec, layers) so that peers
+    watching the same device share its scaling and per-layer encoders.
+    """
+
+    def __init__(self):
+        self._sources = {}
+
+    def __len__(self):
+        return len(self._sources)
+
+    async def subscribe(self, file, format=None, options=None, codec=DEFAULT_CODEC, layers=LAYERS, bitrate=START_BITRATE):
+        key = (file, format, tuple(sorted((options or {}).items())), codec, tuple(layers))
+        source = self._sources.get(key)
+        if source is None:
+            capture = await capture_hub.subscribe(file, "video", format=format, options=options)
+            if capture is None:
+                return None
+            # another call may have started the source while the device opened
+            source = self._sources.get(key)
+            if source is not None:
+                capture_hub.release(capture)
+                return source.subscribe(bitrate)
+            source = SimulcastSource(
+                capture, codec=codec, layers=layers,
+                on_close=lambda s: self._sources.pop(key, None))
+            self._sources[key] = source
+        return source.subscribe(bitrate)
+
+
+hub = SimulcastHub()
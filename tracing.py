@@ -0,0 +1,167 @@
+"""
+Per-frame trace points for the media pipeline.
+
+Each stage a video frame passes through records (time, stage, pts) into a
+ring buffer, from the capture in MediaPlayer to the RTP send, and the
+buffer can be dumped as Chrome trace JSON, which chrome://tracing and
+https://ui.perfetto.dev open, with one row per frame showing how long it
+spent between stages.
+
+Tracing is off unless enable() is called, e.g. by setting TRACE_FRAMES for
+aiortc_aiohttp. Tracks are only wrapped while it is on, so when it is off
+the pipeline runs without any trace point at all.
+"""
+import itertools
+import json
+import threading
+import time
+from aiortc import MediaStreamTrack
+
+RING_SIZE = 65536
+
+enabled = False
+buffer = None
+
+
+class TraceBuffer:
+    """
+    Keeps the last size trace points. Writers never take a lock: the slot
+    comes from an itertools.count, whose next() is atomic, so encoder and
+    decoder threads can record alongside the event loop.
+    """
+
+    def __init__(self, size=RING_SIZE):
+        self.size = size
+        self._events = [None] * size
+        self._counter = itertools.count()
+
+    def record(self, stage, pts, stream=None):
+        self._events[next(self._counter) % self.size] = (
+            time.perf_counter_ns(), stage, pts, stream, threading.get_ident())
+
+    def events(self):
+        """
+        The recorded points, oldest first.
+        """
+        return sorted((event for event in self._events if event is not None), key=lambda event: event[0])
+
+
+def enable(size=RING_SIZE):
+    global enabled, buffer
+    buffer = TraceBuffer(size)
+    enabled = True
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+def point(stage, pts, stream=None):
+    """
+    Record that the frame with this pts reached the stage.
+
+    stream: tells frames with the same pts apart, e.g. the same captured
+        frame sent to several peers. Points without one, like captures
+        shared by all peers, belong to every stream.
+    """
+    if enabled and pts is not None:
+        buffer.record(stage, pts, stream)
+
+
+class TracedTrack(MediaStreamTrack):
+    """
+    Passes the frames of another track through, recording a trace point
+    for each as it is returned.
+    """
+
+    def __init__(self, track, stage, stream=None):
+        super().__init__()
+        self.kind = track.kind
+        self.last_pts = None
+        self._track = track
+        self._stage = stage
+        self._stream = stream
+
+    async def recv(self):
+        frame = await self._track.recv()
+        self.last_pts = frame.pts
+        point(self._stage, frame.pts, self._stream)
+        return frame
+
+    def stop(self):
+        super().stop()
+        self._track.stop()
+
+
+def trace_sender(sender, track, stream=None):
+    """
+    Record "rtp_send" when the sender has encoded a frame of track, a
+    TracedTrack, and is about to packetize and send it. The sender reads
+    one frame at a time, so the frame is the last one track returned.
+    """
+    next_encoded_frame = sender._next_encoded_frame
+
+    async def traced(codec):
+        encoded = await next_encoded_frame(codec)
+        if encoded is not None:
+            point("rtp_send", track.last_pts, stream)
+        return encoded
+
+    sender._next_encoded_frame = traced
+
+
+def _frames(events):
+    # [(stream, pts, [(ns, stage)])], shared points included in every stream
+    shared = {}
+    current = {}
+    frames = []
+    for timestamp, stage, pts, stream, _ in events:
+        if stream is None:
+            shared[pts] = (timestamp, stage)
+            continue
+        frame = current.get((stream, pts))
+        # a looping source repeats its pts, which starts a new frame
+        if frame is None or any(seen == stage for _, seen in frame[2]):
+            frame = current[stream, pts] = (stream, pts, [shared[pts]] if pts in shared else [])
+            frames.append(frame)
+        frame[2].append((timestamp, stage))
+    return frames
+
+
+def chrome_trace(events=None):
+    """
+    Convert trace points to the Chrome trace event format. Every point is an
+    instant event, and every frame an async track of the intervals between
+    its stages, named after the stage it ends in.
+    """
+    if events is None:
+        events = buffer.events() if buffer else []
+    trace = [{"name": stage, "ph": "i", "s": "t", "ts": timestamp / 1000, "pid": 0, "tid": thread,
+              "args": {"pts": pts, "stream": stream}}
+             for timestamp, stage, pts, stream, thread in events]
+    for index, (stream, pts, stages) in enumerate(_frames(events)):
+        for (start, _), (end, stage) in zip(stages, stages[1:]):
+            common = {"name": stage, "cat": stream, "id": index, "pid": 0, "args": {"pts": pts}}
+            trace.append({**common, "ph": "b", "ts": start / 1000})
+            trace.append({**common, "ph": "e", "ts": end / 1000})
+    return {"traceEvents": trace, "displayTimeUnit": "ms"}
+
+
+def stage_summary(events=None):
+    """
+    Mean milliseconds frames spent reaching each stage from the one before.
+    """
+    if events is None:
+        events = buffer.events() if buffer else []
+    totals = {}
+    for _, _, stages in _frames(events):
+        for (start, _), (end, stage) in zip(stages, stages[1:]):
+            count, total = totals.get(stage, (0, 0))
+            totals[stage] = (count + 1, total + end - start)
+    return {stage: round(total / count / 1e6, 3) for stage, (count, total) in totals.items()}
+
+
+def dump(path):
+    with open(path, "w") as f:
+        json.dump(chrome_trace(), f)
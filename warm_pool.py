@@ -0,0 +1,127 @@
+import asyncio
+import logging
+import time
+from aiortc_connection import AiortcConnection
+
+DEFAULT_POOL_SIZE = 2
+# gathered candidates and TURN allocations go stale, so old entries are rebuilt
+MAX_IDLE_SECONDS = 300
+# preparing a connection competes with the call for CPU, so replacements wait for it to be set up
+REFILL_DELAY_SECONDS = 1
+
+
+class WarmPool:
+    """
+    Keeps connections whose peer connection, data channel, media and offer,
+    including ICE gathering, are already prepared, so a call only has to open
+    the websocket and send the offer. Taken connections are replaced in the
+    background.
+
+    size: number of prepared connections to keep
+    media_options: keyword arguments passed to AiortcConnection.get_media
+    connection_factory: callable taking the peer id, None for connections
+        prepared before their peer is known, and returning a new
+        AiortcConnection-like object. A SessionManager given the pool sets
+        its own if this is None
+    """
+
+    def __init__(self, size=DEFAULT_POOL_SIZE, media_options=None, connection_factory=None):
+        self._size = size
+        self._media_options = media_options or {}
+        self.connection_factory = connection_factory
+        # (prepared at, connection), oldest first
+        self._ready = []
+        self._filling = 0
+        self._closed = False
+        # fills and clears running in the background, the fills among them,
+        # and the pending refill
+        self._tasks = set()
+        self._fills = set()
+        self._refill_handle = None
+
+    def __len__(self):
+        return len(self._ready)
+
+    async def _prepare(self, uid=None):
+        factory = self.connection_factory or (lambda peer_id: AiortcConnection(uid=peer_id))
+        connection = factory(uid)
+        try:
+            connection.create_peer_connection()
+            connection.create_data_channel()
+            await connection.get_media(**self._media_options)
+            await connection.prepare_offer()
+        except BaseException:
+            # also when cancelled, so the capture devices and sockets are released
+            await connection.clear()
+            raise
+        return connection
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._finished)
+        return task
+
+    def _finished(self, task):
+        self._tasks.discard(task)
+        self._fills.discard(task)
+        if not task.cancelled() and task.exception():
+            logging.error(f"Warm pool task failed: {task.exception()}")
+
+    async def _fill_one(self):
+        self._filling += 1
+        try:
+            start = time.perf_counter()
+            connection = await self._prepare()
+            if self._closed:
+                await connection.clear()
+                return
+            self._ready.append((time.monotonic(), connection))
+            logging.info(f"Warm connection ready in {(time.perf_counter() - start) * 1000:.0f} ms ({len(self)} in pool)")
+        except Exception as e:
+            logging.error(f"Preparing warm connection failed: {e}")
+        finally:
+            self._filling -= 1
+
+    def refill(self):
+        self._refill_handle = None
+        if self._closed:
+            return
+        for _ in range(self._size - len(self._ready) - self._filling):
+            self._fills.add(self._spawn(self._fill_one()))
+
+    async def start(self):
+        await asyncio.gather(*[self._fill_one() for _ in range(self._size)])
+
+    async def acquire(self, uid):
+        """
+        Take a prepared connection for the peer, or prepare one now if the
+        pool is empty.
+        """
+        connection = None
+        while self._ready:
+            prepared_at, candidate = self._ready.pop(0)
+            if time.monotonic() - prepared_at < MAX_IDLE_SECONDS and candidate.has_prepared_offer:
+                connection = candidate
+                break
+            self._spawn(candidate.clear())
+        if self._refill_handle is None:
+            self._refill_handle = asyncio.get_running_loop().call_later(REFILL_DELAY_SECONDS, self.refill)
+        if connection is None:
+            logging.info("Warm pool empty, preparing connection on demand")
+            connection = await self._prepare(uid)
+        connection.uid = uid
+        return connection
+
+    async def close(self):
+        self._closed = True
+        if self._refill_handle:
+            self._refill_handle.cancel()
+        # fills clear their half prepared connection when cancelled, and
+        # clears of stale connections are left to finish
+        for task in self._fills:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        connections = [connection for _, connection in self._ready]
+        self._ready.clear()
+        await asyncio.gather(*[connection.clear() for connection in connections])
@@ -1,69 +1,254 @@
+import argparse
 import asyncio
+import functools
+import logging
+import multiprocessing
+import os
 import websockets
+from http import HTTPStatus
+from metrics import CONTENT_TYPE, registry
+from signaling_broker import BrokerServer, InProcessBroker, UnixSocketBroker
 from urllib.parse import urlparse, parse_qs
 
 IP_ADDRESS = "0.0.0.0"
 PORT = 5011
+# messages waiting to be written to one client before it counts as slow
+SEND_QUEUE_SIZE = 256
+# "drop": discard the oldest queued message, "disconnect": close the slow client
+SLOW_CONSUMER_POLICY = "drop"
 
-map_unity_users = {}
-map_web_users = {}
+BROKER_PATH = "/tmp/tom-signaling.sock"
+
+# room -> {"u": {user id: Peer}, "w": {user id: Peer}}, for clients of this worker
+rooms = {}
+# topic -> delivery callback registered with the broker
+subscriptions = {}
+broker = InProcessBroker()
+worker_id = ""
 id_counter = 0
 
+MESSAGES_ROUTED = registry.counter("tom_relay_messages_routed_total", "Messages received from clients and routed", ("worker",))
+MESSAGES_DROPPED = registry.counter("tom_relay_messages_dropped_total", "Messages dropped for slow clients", ("worker",))
+CLIENTS = registry.gauge("tom_relay_clients", "Connected clients", ("worker", "type"))
+QUEUED_MESSAGES = registry.gauge("tom_relay_queued_messages", "Messages waiting in all client send queues", ("worker",))
+MAX_QUEUE_DEPTH = registry.gauge("tom_relay_max_queue_depth", "Messages waiting in the longest client send queue", ("worker",))
+# every worker serves its own /metrics, so the worker tells their series apart
+worker_labels = ("main",)
+
 # 1. Start all Python Server, Websocket Server, Unity Client
 # 2. Press Call on Unity Client
 # 3. Press Start on Python Server
 
 
+class Peer:
+    """
+    A connected client with its own bounded send queue and writer task, so a
+    slow client never holds up delivery to anyone else.
+    """
+
+    def __init__(self, websocket, user_id, usertype, room, queue_size=None, policy=None):
+        self.websocket = websocket
+        self.user_id = user_id
+        self.usertype = usertype
+        self.room = room
+        self.policy = policy or SLOW_CONSUMER_POLICY
+        self.dropped = 0
+        self._closing = False
+        self._closer = None
+        self._queue = asyncio.Queue(maxsize=queue_size or SEND_QUEUE_SIZE)
+        self._writer = asyncio.create_task(self._write())
+
+    def send(self, message):
+        try:
+            self._queue.put_nowait(message)
+        except asyncio.QueueFull:
+            if self.policy == "disconnect":
+                if not self._closing:
+                    self._closing = True
+                    logging.warning(f"Disconnecting slow user {self.user_id}")
+                    self._closer = asyncio.create_task(self.websocket.close(code=1008, reason="Too slow"))
+                    self._closer.add_done_callback(self._closed)
+                return
+            self._queue.get_nowait()
+            self._queue.put_nowait(message)
+            self.dropped += 1
+            MESSAGES_DROPPED.inc(worker_labels)
+            if self.dropped % self._queue.maxsize == 1:
+                logging.warning(f"Dropping messages for slow user {self.user_id} ({self.dropped} so far)")
+
+    def _closed(self, task):
+        if not task.cancelled() and task.exception():
+            logging.error(f"Closing slow user {self.user_id} failed: {task.exception()}")
+
+    async def _write(self):
+        try:
+            while True:
+                message = await self._queue.get()
+                await self.websocket.send(message)
+        except websockets.ConnectionClosed:
+            pass
+
+    @property
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def close(self):
+        self._writer.cancel()
+
+
+def topic(room, usertype):
+    return f"{room}/{usertype}"
+
+
+def deliver(room, usertype, message):
+    for peer in rooms.get(room, {}).get(usertype, {}).values():
+        peer.send(message)
+
+
+def join(peer):
+    users = rooms.setdefault(peer.room, {"u": {}, "w": {}})[peer.usertype]
+    if not users:
+        # receive messages for this room/type published by any worker
+        name = topic(peer.room, peer.usertype)
+        subscriptions[name] = functools.partial(deliver, peer.room, peer.usertype)
+        broker.subscribe(name, subscriptions[name])
+    users[peer.user_id] = peer
+
+
+def leave(peer):
+    room = rooms.get(peer.room)
+    if room is None:
+        return
+    room[peer.usertype].pop(peer.user_id, None)
+    if not room[peer.usertype]:
+        name = topic(peer.room, peer.usertype)
+        broker.unsubscribe(name, subscriptions.pop(name))
+    if not room["u"] and not room["w"]:
+        del rooms[peer.room]
+
+
+def route(peer, message):
+    # Unity users talk to web users in the same room and vice versa
+    broker.publish(topic(peer.room, "w" if peer.usertype == "u" else "u"), message)
+
+
+def collect_metrics():
+    depths = {"u": [], "w": []}
+    for room in rooms.values():
+        for usertype, users in room.items():
+            depths[usertype] += [peer.queue_depth for peer in users.values()]
+    for usertype, queues in depths.items():
+        CLIENTS.set(len(queues), worker_labels + (usertype,))
+    queues = depths["u"] + depths["w"]
+    QUEUED_MESSAGES.set(sum(queues), worker_labels)
+    MAX_QUEUE_DEPTH.set(max(queues, default=0), worker_labels)
+
+
+registry.add_collector(collect_metrics)
+
+
+async def process_request(path, headers):
+    # plain HTTP requests for /metrics are answered before the websocket handshake
+    if urlparse(path).path == "/metrics":
+        return HTTPStatus.OK, [("Content-Type", CONTENT_TYPE)], registry.render().encode("utf-8")
+    return None
+
+
 async def handle_connection(websocket, path):
     global id_counter
-    print('User connected!')
-
     queryparams = parse_qs(urlparse(path).query)
     usertype = queryparams.get('type', [''])[0]
     accesstoken = queryparams.get('token', [''])[0]
     uid = queryparams.get('uid', [''])[0]
-    is_unity_user = False
+    # peers meet in the room named after their uid unless one is given
+    room = queryparams.get('room', [uid])[0]
 
-    user_id_with_id = f"{uid}{id_counter}"
+    if usertype not in ("u", "w"):
+        logging.info(f"Rejecting user with unknown type {usertype!r}")
+        await websocket.close(code=1008, reason="Unknown user type")
+        return
+
+    user_id_with_id = f"{worker_id}{uid}{id_counter}"
     id_counter += 1
 
-    if usertype == "u":
-        print('UNITY USER! ', user_id_with_id)
-        map_unity_users[user_id_with_id] = websocket
-        is_unity_user = True
-    elif usertype == "w":
-        print('WEB USER! ', user_id_with_id)
-        map_web_users[user_id_with_id] = websocket
-
-    print('usertype: ', usertype)
-    print('accesstoken: ', accesstoken)
-    while True:
-        try:
-            print("Waiting for message...")
-            message = await websocket.recv()
-            print(f'Received from {usertype}: {message}')
-            if is_unity_user:
-                # Send to web users
-                for ws in map_web_users.values():
-                    await ws.send(message)
-                    print("Sent to web users")
-            else:
-                # Send to unity users
-                for ws in map_unity_users.values():
-                    await ws.send(message)
-                    print("Sent to unity users")
-        except websockets.ConnectionClosed:
-            print(f"Connection closed for user {user_id_with_id}")
-            if is_unity_user:
-                del map_unity_users[user_id_with_id]
-            else:
-                del map_web_users[user_id_with_id]
-            break
+    peer = Peer(websocket, user_id_with_id, usertype, room)
+    join(peer)
+    logging.info(f"{'UNITY' if usertype == 'u' else 'WEB'} USER {user_id_with_id} joined room {room}")
+    logging.debug(f"accesstoken: {accesstoken}")
+    try:
+        async for message in websocket:
+            route(peer, message)
+            MESSAGES_ROUTED.inc(worker_labels)
+            logging.debug("Routed message from %s", user_id_with_id)
+    except websockets.ConnectionClosed:
+        pass
+    finally:
+        logging.info(f"Connection closed for user {user_id_with_id}")
+        leave(peer)
+        peer.close()
 
 
-async def main():
-    async with websockets.serve(handle_connection, IP_ADDRESS, PORT):
-        print(f"Server started on ws://{IP_ADDRESS}:{PORT}")
+async def main(host=IP_ADDRESS, port=PORT, broker_path=None, reuse_port=False):
+    global broker, worker_labels
+    if broker_path:
+        broker = UnixSocketBroker(broker_path)
+    if worker_id:
+        worker_labels = (worker_id.rstrip("-"),)
+    await broker.start()
+    async with websockets.serve(handle_connection, host, port, reuse_port=reuse_port, process_request=process_request):
+        logging.info(f"Server started on ws://{host}:{port}")
         await asyncio.Future()  # run forever
 
-asyncio.run(main())
+
+def run_worker(index, host, port, broker_path, queue_size, policy, level):
+    global worker_id, SEND_QUEUE_SIZE, SLOW_CONSUMER_POLICY
+    worker_id = f"w{index}-"
+    SEND_QUEUE_SIZE = queue_size
+    SLOW_CONSUMER_POLICY = policy
+    logging.basicConfig(level=level, format=f"[worker {index}] %(levelname)s %(message)s", force=True)
+    asyncio.run(main(host, port, broker_path, reuse_port=True))
+
+
+async def run_broker(broker_path, workers):
+    if os.path.exists(broker_path):
+        os.unlink(broker_path)
+    server = BrokerServer(broker_path)
+    await server.start()
+    # workers connect to the broker on start, so it has to be listening first
+    for worker in workers:
+        worker.start()
+    await asyncio.Future()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Websocket signaling relay")
+    parser.add_argument("--host", default=IP_ADDRESS)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--queue-size", type=int, default=SEND_QUEUE_SIZE,
+                        help="Messages buffered per client before the slow consumer policy applies")
+    parser.add_argument("--policy", choices=["drop", "disconnect"], default=SLOW_CONSUMER_POLICY,
+                        help="What to do with clients that cannot keep up")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Relay processes sharing the port through a Unix socket broker (Linux only)")
+    parser.add_argument("--broker-path", default=BROKER_PATH,
+                        help="Unix socket of the broker used when running several workers")
+    parser.add_argument("--verbose", "-v", action="count")
+    args = parser.parse_args()
+    SEND_QUEUE_SIZE = args.queue_size
+    SLOW_CONSUMER_POLICY = args.policy
+    level = logging.DEBUG if args.verbose else logging.INFO
+
+    if args.workers > 1:
+        # spawn rather than fork so workers do not inherit the broker's event loop
+        context = multiprocessing.get_context("spawn")
+        workers = [
+            context.Process(target=run_worker, args=(
+                i, args.host, args.port, args.broker_path, args.queue_size, args.policy, level), daemon=True)
+            for i in range(args.workers)
+        ]
+        logging.basicConfig(level=level, format="[broker] %(levelname)s %(message)s")
+
+        asyncio.run(run_broker(args.broker_path, workers))
+    else:
+        logging.basicConfig(level=level)
+        asyncio.run(main(args.host, args.port))